@@ -1,7 +1,12 @@
 from directed_exploration.logging_ops import init_logging, get_logger
 from directed_exploration.curiosity_wrapper import CuriosityWrapper
 from directed_exploration.frame_predict_rnn.frame_predict_rnn_sim import FramePredictRNNSim
+from directed_exploration.ensemble_frame_predict_rnn.ensemble_frame_predict_rnn_sim import EnsembleFramePredictRNNSim
 from directed_exploration.utils.env_util import make_record_write_subproc_env, make_subproc_env
+from directed_exploration.utils.tf_util import LSTM_BACKENDS
+from directed_exploration.utils.cpu_topology import parse_cpu_list, apply_cpu_layout, make_session_config, \
+    cpu_topology_report
+from directed_exploration.utils.validation_cache import open_or_build_validation_cache
 from directed_exploration.utils.data_util import none_or_str, str_as_bool, convert_scientific_str_to_int, pretty_print_dict, ensure_dir
 
 import datetime
@@ -22,7 +27,14 @@ import logging
 
 
 def main(args):
-    curiosity_source = FramePredictRNNSim
+    if args.curiosity_ensemble_size > 0:
+        curiosity_source = EnsembleFramePredictRNNSim
+        curiosity_source_kwargs = {'num_heads': args.curiosity_ensemble_size,
+                                   'error_reward_weight': args.curiosity_ensemble_error_weight,
+                                   'disagreement_reward_weight': args.curiosity_ensemble_disagreement_weight}
+    else:
+        curiosity_source = FramePredictRNNSim
+        curiosity_source_kwargs = {'lstm_backend': args.curiosity_lstm_backend}
 
     if args.working_dir is None:
         args.working_dir = 'runs/A2C_{}_'.format(curiosity_source.__name__)
@@ -52,24 +64,57 @@ def main(args):
 
     logger.info(pretty_print_dict(args.__dict__, 'Arguments:'))
 
-    config = tf.ConfigProto(allow_soft_placement=True)
-    config.gpu_options.allow_growth = True
+    # Pin before the session's thread pools and the env worker processes exist, so that both start out pinned.
+    env_worker_cpus = apply_cpu_layout(main_cpus=args.main_process_cpus, env_cpus=args.env_worker_cpus,
+                                       num_env_workers=args.num_env, cpus_per_env_worker=args.cpus_per_env_worker)
+    logger.info(cpu_topology_report(main_cpus=args.main_process_cpus, env_worker_cpus=env_worker_cpus,
+                                    intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads))
+
+    config = make_session_config(intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
     sess = tf.Session(config=config)
 
     summary_writer = tf.summary.FileWriter(args.working_dir)
 
     if args.create_heatmaps:
-        env = make_record_write_subproc_env(env_id=args.env_id, num_env=args.num_env)
+        env = make_record_write_subproc_env(env_id=args.env_id, num_env=args.num_env,
+                                            env_worker_cpus=env_worker_cpus)
     else:
         env = make_subproc_env(env_id=args.env_id, num_env=args.num_env, width=args.frame_size[0],
-                               height=args.frame_size[1], seed=42, monitor_to_dir=a2c_dir)
+                               height=args.frame_size[1], seed=42, monitor_to_dir=a2c_dir,
+                               env_worker_cpus=env_worker_cpus)
 
     if args.intrinsic_reward_coefficient != 0:
+        if args.validation_data_dir is not None and args.validation_cache:
+            open_or_build_validation_cache(args.validation_data_dir, env.action_space.n)
+
         sim = curiosity_source(
             observation_space=env.observation_space, action_dim=env.action_space.n,
             working_dir=args.working_dir,
-            sess=sess, summary_writer=summary_writer
+            sess=sess, summary_writer=summary_writer,
+            stateful_inference=args.curiosity_stateful_inference,
+            **curiosity_source_kwargs
         )
+        sim.set_summary_schedule(every_n_steps=args.curiosity_summary_every_n_steps,
+                                 every_n_seconds=args.curiosity_summary_every_n_seconds)
+        sim.set_async_checkpointing(args.curiosity_async_checkpoints)
+
+        observation_space, action_space = env.observation_space, env.action_space
+
+        def make_validation_sim():
+            # Validation runs on its own graph and session so it never competes with training for the sim's.
+            validation_graph = tf.Graph()
+            validation_sim = curiosity_source(
+                observation_space=observation_space, action_dim=action_space.n,
+                working_dir=args.working_dir,
+                sess=tf.Session(graph=validation_graph, config=config), graph=validation_graph,
+                summary_writer=tf.summary.FileWriter(os.path.join(args.working_dir, 'validation_sim')),
+                **curiosity_source_kwargs
+            )
+            if args.curiosity_finalize_validation_graph:
+                # Any op created after this point, e.g. by validation rounds growing the graph, raises.
+                validation_sim.prepare_validation(action_space)
+                validation_graph.finalize()
+            return validation_sim
 
         env = CuriosityWrapper(
             sim=sim,
@@ -79,10 +124,20 @@ def main(args):
             intrinsic_reward_coefficient=args.intrinsic_reward_coefficient,
             train_seq_length=args.curiosity_train_sequence_length,
             validation_data_dir=args.validation_data_dir,
+            validation_sim_factory=make_validation_sim,
             heatmaps=args.create_heatmaps,
             do_train=not args.demo_debug,
             summary_writer=summary_writer,
-            return_generated_frames_in_info=args.demo_debug
+            return_generated_frames_in_info=args.demo_debug,
+            async_train=args.curiosity_async_train,
+            async_train_queue_size=args.curiosity_async_train_queue_size,
+            pipelined=args.curiosity_pipelined,
+            pipeline_group_size=args.curiosity_pipeline_group_size,
+            timing_summary_interval=args.curiosity_timing_summary_interval,
+            replay_capacity=args.curiosity_replay_capacity,
+            replay_ratio=args.curiosity_replay_ratio,
+            replay_batch_size=args.curiosity_replay_batch_size,
+            replay_prioritized=args.curiosity_replay_prioritized
         )
     elif args.extrinsic_reward_coefficient != 1:
         logger.warning(
@@ -167,6 +222,11 @@ if __name__ == '__main__':
                         help="Directory with validation rollouts to test curiosity model accuracy. "
                              "Pass \'None\' for no validation",
                         type=none_or_str)
+    parser.add_argument("--validation-cache",
+                        help="Decode the validation tfrecords once, at startup, into a memory-mapped cache in the "
+                             "validation data dir that validation then reads instead. An up to date cache is used "
+                             "even without this",
+                        type=str_as_bool, default=False)
     parser.add_argument("--num-env",
                         help="Number of environment processes to work with simultaneously",
                         type=int, required=True)
@@ -176,6 +236,87 @@ if __name__ == '__main__':
     parser.add_argument("--curiosity-train-sequence-length",
                         help="Training batch sequence length",
                         type=int, required=True)
+    parser.add_argument("--curiosity-async-train",
+                        help="Train the curiosity model on a background thread while env stepping continues",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--curiosity-async-train-queue-size",
+                        help="Max number of completed curiosity minibatches waiting for the background trainer",
+                        type=int, default=2)
+    parser.add_argument("--curiosity-pipelined",
+                        help="Overlap the curiosity model's forward pass with env stepping",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--curiosity-pipeline-group-size",
+                        help="In pipelined mode, score curiosity losses for groups of this many envs as they finish "
+                             "stepping. Defaults to all envs at once.",
+                        type=int, default=None)
+    parser.add_argument("--curiosity-timing-summary-interval",
+                        help="Write p50/p95/p99 timings of each curiosity step loop phase every this many env steps",
+                        type=int, default=1000)
+    parser.add_argument("--curiosity-replay-capacity",
+                        help="Number of per-env training sequences to keep in the on-disk curiosity replay store. "
+                             "0 disables replay, otherwise it must be at least --num-env.",
+                        type=int, default=0)
+    parser.add_argument("--curiosity-replay-ratio",
+                        help="Average number of replay train steps per on-policy curiosity train step "
+                             "(may be fractional)",
+                        type=float, default=0.0)
+    parser.add_argument("--curiosity-replay-batch-size",
+                        help="Number of sequences per replay train step. Defaults to the number of envs.",
+                        type=int, default=None)
+    parser.add_argument("--curiosity-replay-prioritized",
+                        help="Sample replay sequences in proportion to their own last training loss instead of "
+                             "uniformly",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--curiosity-lstm-backend",
+                        help="LSTM implementation for the curiosity model: 'scan' (tf.scan step) or "
+                             "'block_fused' (fused BlockLSTM kernel, same variables). Only 'scan' with "
+                             "--curiosity-ensemble-size.",
+                        type=str, choices=LSTM_BACKENDS, default='scan')
+    parser.add_argument("--curiosity-stateful-inference",
+                        help="Keep per-env curiosity model rnn states in the graph instead of feeding them every step",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--curiosity-ensemble-size",
+                        help="Use an ensemble of this many frame prediction heads, evaluated together in one graph, "
+                             "for disagreement based curiosity. 0 uses a single FramePredictRNN.",
+                        type=int, default=0)
+    parser.add_argument("--curiosity-ensemble-error-weight",
+                        help="Weight of the heads' mean prediction error in the ensemble's intrinsic reward",
+                        type=float, default=1.0)
+    parser.add_argument("--curiosity-ensemble-disagreement-weight",
+                        help="Weight of the variance across heads in the ensemble's intrinsic reward",
+                        type=float, default=1.0)
+    parser.add_argument("--curiosity-summary-every-n-steps",
+                        help="Write curiosity model train summaries once every this many train steps",
+                        type=int, default=100)
+    parser.add_argument("--curiosity-summary-every-n-seconds",
+                        help="Also write curiosity model train summaries once this many seconds have passed since "
+                             "they were last written",
+                        type=float, default=None)
+    parser.add_argument("--curiosity-async-checkpoints",
+                        help="Snapshot curiosity model weights when checkpointing and write them on a background "
+                             "thread instead of blocking training on the save",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--curiosity-finalize-validation-graph",
+                        help="Finalize the validation sim's graph once it is built, so that accidentally creating "
+                             "ops while validating raises instead of slowly growing the graph",
+                        type=str_as_bool, default=False)
+    parser.add_argument("--intra-op-threads",
+                        help="TensorFlow intra op thread pool size. 0 lets TensorFlow pick (one per visible cpu)",
+                        type=int, default=0)
+    parser.add_argument("--inter-op-threads",
+                        help="TensorFlow inter op thread pool size. 0 lets TensorFlow pick (one per visible cpu)",
+                        type=int, default=0)
+    parser.add_argument("--main-process-cpus",
+                        help="Cpu list (e.g. '0-15') to pin the main process, and so its TensorFlow threads, to",
+                        type=parse_cpu_list, default=None)
+    parser.add_argument("--env-worker-cpus",
+                        help="Cpu list (e.g. '16-63') to pin env worker processes to. Defaults to the cpus "
+                             "available at startup",
+                        type=parse_cpu_list, default=None)
+    parser.add_argument("--cpus-per-env-worker",
+                        help="Give each env worker its own slice of this many env worker cpus (wrapping around "
+                             "when there are more workers than cpus). 0 lets every worker use all of them",
+                        type=int, default=0)
     parser.add_argument("--create-heatmaps",
                         help="Create heatmap images of agent movement. Use only with GymBoxPush.",
                         type=str_as_bool, required=True)
@@ -197,4 +338,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.curiosity_ensemble_size > 0 and args.curiosity_lstm_backend != 'scan':
+        parser.error("--curiosity-lstm-backend {} isn't supported with --curiosity-ensemble-size, the ensemble always "
+                     "uses its own scan LSTM".format(args.curiosity_lstm_backend))
+
     main(args)
@@ -1,20 +1,26 @@
-from directed_exploration.utils.heatmap_gen import generate_boxpush_heatmap_from_npy_records
+from directed_exploration.utils.heatmap_gen import generate_boxpush_heatmap_from_npy_records, delete_npy_records
+from directed_exploration.utils.sequence_buffer import SequenceRingBuffer
+from directed_exploration.utils.env_util import step_wait_in_groups
+from directed_exploration.utils.background_worker import CoalescingWorker
+from directed_exploration.utils.timing import PhaseTimer
+from directed_exploration.utils.replay_store import SequenceReplayStore
 
 import tensorflow as tf
 import numpy as np
 import os
+import queue
+import sys
+import threading
+import time
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 HEATMAP_FOLDER_NAME = 'heatmap_records'
+REPLAY_FOLDER_NAME = 'curiosity_replay'
 
 
-def convert_to_one_hot(Y, C):
-    Y = np.eye(C)[Y.reshape(-1)]
-    return Y
-
 def pretty_dict_keys_with_values(dictonary):
     pretty_str = ""
     for key in dictonary.keys():
@@ -31,9 +37,19 @@ class CuriosityWrapper:
                  intrinsic_reward_coefficient,
                  heatmaps=False,
                  validation_data_dir=None,
+                 validation_sim_factory=None,
                  return_generated_frames_in_info=False,
                  do_train=True,
-                 summary_writer=None):
+                 summary_writer=None,
+                 async_train=False,
+                 async_train_queue_size=2,
+                 pipelined=False,
+                 pipeline_group_size=None,
+                 timing_summary_interval=1000,
+                 replay_capacity=0,
+                 replay_ratio=0.0,
+                 replay_batch_size=None,
+                 replay_prioritized=False):
 
         self.sim = sim
 
@@ -52,7 +68,13 @@ class CuriosityWrapper:
         self.action_space = self.subproc_env.action_space
         self.observation_space = self.subproc_env.observation_space
 
+        # In pipelined mode, env stepping is split into step_async/step_wait and the sim's forward pass runs
+        # in between. Envs are scored in groups of pipeline_group_size as they finish (all at once if None).
+        self.pipelined = pipelined
+        self.pipeline_group_size = pipeline_group_size if pipeline_group_size else self.num_envs
+
         self.loss_accumulators = None
+        self._num_accumulated_losses = 0
 
         self.t_obs = self.subproc_env.reset()
         self.t_dones = [True for _ in range(self.num_envs)]
@@ -60,58 +82,123 @@ class CuriosityWrapper:
         self.train_states = None
         self.t_states = None
 
+        # Sims in stateful inference mode keep t_states in the graph, so self.t_states stays None.
+        self.stateful_inference = getattr(self.sim, 'stateful_inference', False)
+        if self.stateful_inference:
+            self.sim.reset_states(self.num_envs)
+
         self.current_step = 1
 
         self.summary_writer = summary_writer
 
+        # Wall clock time spent in each phase of the step loop (and the background jobs it starts).
+        # Rolling percentiles are written every timing_summary_interval env steps and reported at close().
+        self.timer = PhaseTimer()
+        self.timing_summary_interval = timing_summary_interval
+
+        # Heatmaps are rendered on a background worker. If rendering falls behind, windows still waiting to be
+        # rendered are dropped (and their records deleted) in favour of the latest one.
+        self._heatmap_worker = None
         if heatmaps:
             self.set_heatmap_record_write_to_current_step()
             self.old_prefix = self.get_current_heatmap_record_prefix()
+            self._heatmap_worker = CoalescingWorker(name='curiosity_heatmap_render')
+
+        # In async mode, completed minibatches are handed to a background thread that trains the sim on them
+        # while the env loop keeps stepping and predicting with the latest weights.
+        # The queue is bounded so that the trainer falling behind blocks the env loop instead of dropping
+        # minibatches (consecutive minibatches share an rnn state chain through train_states).
+        self.async_train = async_train and do_train
+        self.async_train_queue_size = async_train_queue_size
+        self._train_queue = None
+        self._train_thread = None
+        self._train_thread_exc_info = None
+        self._async_queue_depth_accumulator = 0
+        self._async_staleness_accumulator = 0
+        self._async_stats_count = 0
+
+        # Minibatches are written straight into preallocated batch-major slots.
+        # In async mode, up to async_train_queue_size slots can be queued and one more can be training
+        # while the next one is being written.
+        self.minibatch_buffer = SequenceRingBuffer(
+            num_slots=self.async_train_queue_size + 2 if self.async_train else 1,
+            num_envs=self.num_envs,
+            seq_length=self.train_seq_length,
+            obs_shape=self.observation_space.shape,
+            action_dim=self.action_space.n,
+            obs_dtype=self.observation_space.dtype
+        )
 
-        self.minibatch_observations = []
-        self.minibatch_actions = []
-        self.minibatch_dones = []
+        # If a validation_sim_factory is given, validation runs on a background thread against a separate sim
+        # (its own graph and session) restored from the checkpoint that was just saved, so training never waits
+        # on it. If validation falls behind, only the newest checkpoint is validated.
+        self.validation_sim_factory = validation_sim_factory
+        self._validation_sim = None
+        self._validation_worker = None
+        if self.validation_data_dir is not None and self.validation_sim_factory is not None:
+            self._validation_worker = CoalescingWorker(name='curiosity_sim_validation')
+        elif self.validation_data_dir is not None:
+            # Build the validation input pipeline in the training graph now rather than during the first checkpoint.
+            self.sim.prepare_validation(self.action_space)
+
+        # Every trained minibatch is also kept in a disk-backed replay store (if replay_capacity > 0), and each
+        # on-policy train step is followed by replay_ratio train steps on sequences sampled from it on average.
+        # Replayed sequences start from their stored initial states and never touch the train_states chain.
+        self.replay_store = None
+        self.replay_ratio = replay_ratio
+        self.replay_batch_size = replay_batch_size if replay_batch_size else self.num_envs
+        self._replay_credit = 0.0
+        if replay_capacity > 0 and do_train:
+            if replay_capacity < self.num_envs:
+                # Every train step adds one sequence per env.
+                raise ValueError("replay_capacity ({}) must be at least the number of envs ({})".format(
+                    replay_capacity, self.num_envs))
+            self.replay_store = SequenceReplayStore(
+                directory=os.path.join(self.working_dir, REPLAY_FOLDER_NAME),
+                capacity=replay_capacity,
+                seq_length=self.train_seq_length,
+                obs_shape=self.observation_space.shape,
+                action_dim=self.action_space.n,
+                obs_dtype=self.observation_space.dtype,
+                prioritized=replay_prioritized
+            )
+
+        if self.async_train:
+            self._train_queue = queue.Queue(maxsize=self.async_train_queue_size)
+            self._train_thread = threading.Thread(target=self._async_train_loop, name='curiosity_sim_trainer')
+            self._train_thread.daemon = True
+            self._train_thread.start()
 
     def step(self, actions):
-        t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, _ = self.subproc_env.step(actions)
+        step_start = time.perf_counter()
 
-        predict_vals = self.sim.predict_on_batch(
-            t_obs=self.t_obs,
-            t_actions=actions,
-            t_states=self.t_states,
-            t_dones=self.t_dones,
-            t_plus_1_dones=t_plus_1_dones,
-            actual_t_plus_one_obs=t_plus_1_obs,
-            return_t_plus_one_predictions=self.return_generated_frames_in_info
-        )
+        self._raise_if_train_thread_failed()
 
-        if self.return_generated_frames_in_info:
-            t_plus_1_predictions, losses, t_plus_1_states = predict_vals
+        if self.pipelined:
+            step_vals = self._pipelined_env_step_and_predict(actions)
         else:
-            losses, t_plus_1_states = predict_vals
-            t_plus_1_predictions = None
+            step_vals = self._env_step_and_predict(actions)
 
-        self.minibatch_observations.append(self.t_obs)
-        self.minibatch_actions.append(convert_to_one_hot(actions, self.action_space.n))
-        self.minibatch_dones.append(self.t_dones)
+        t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, losses, t_plus_1_predictions, t_plus_1_states = step_vals
 
-        # print("batch: {}".format(np.asarray(self.minibatch_observations)[:,:,0,0,0]))
+        with self.timer.time('bookkeeping'):
+            self.minibatch_buffer.write_step(self.t_obs, actions, self.t_dones)
 
-        if len(self.minibatch_actions) >= self.train_seq_length:
-            self.minibatch_observations.append(t_plus_1_obs)
-            self.minibatch_dones.append(t_plus_1_dones)
+            minibatch = None
+            if self.minibatch_buffer.is_full():
+                minibatch = self.minibatch_buffer.finish(t_plus_1_obs, t_plus_1_dones)
 
-            if self.do_train:
-                self.train()
+        if minibatch is not None and self.do_train:
+            if self.async_train:
+                with self.timer.time('train_queue_wait'):
+                    self._enqueue_minibatch(minibatch)
+            else:
+                self._train_on_minibatch(*minibatch)
 
         if self.heatmaps and self.current_step % 20000 == 0:
+            # set_record_write returns once every env has flushed its records for the old window.
             self.set_heatmap_record_write_to_current_step()
-            logger.debug("Creating Heatmap...")
-            heatmap_save_location = generate_boxpush_heatmap_from_npy_records(
-                directory=os.path.join(self.working_dir, HEATMAP_FOLDER_NAME),
-                file_prefix=self.old_prefix,
-                delete_records=True)
-            logger.debug("Heatmap saved to {}".format(heatmap_save_location))
+            self._submit_heatmap(self.old_prefix, self.current_step)
             self.old_prefix = self.get_current_heatmap_record_prefix()
 
         # Move iteration forward
@@ -119,6 +206,11 @@ class CuriosityWrapper:
         self.t_dones = t_plus_1_dones
         self.t_states = t_plus_1_states
 
+        self.timer.record('step_total', time.perf_counter() - step_start)
+
+        if self.summary_writer is not None and self.current_step % self.timing_summary_interval == 0:
+            self.timer.write_summaries(self.summary_writer, self.current_step, tag_prefix='curiosity_timing')
+
         self.current_step += 1
 
         out_rewards = self.extrinsic_reward_coefficient * extrinsic_rewards + self.intrinsic_reward_coefficient * losses
@@ -127,18 +219,106 @@ class CuriosityWrapper:
 
         return np.copy(t_plus_1_obs), out_rewards, np.copy(t_plus_1_dones), {'generated_frames': t_plus_1_predictions}
 
+    def _env_step_and_predict(self, actions):
+        with self.timer.time('env_wait'):
+            t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, _ = self.subproc_env.step(actions)
+
+        if not self.return_generated_frames_in_info:
+            with self.timer.time('predict'):
+                losses, t_plus_1_states = self.sim.predict_losses_on_batch(
+                    t_obs=self.t_obs,
+                    t_actions=actions,
+                    t_states=self.t_states,
+                    t_dones=self.t_dones,
+                    t_plus_1_dones=t_plus_1_dones,
+                    actual_t_plus_one_obs=t_plus_1_obs
+                )
+
+            return t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, losses, None, t_plus_1_states
+
+        with self.timer.time('predict'):
+            t_plus_1_predictions, losses, t_plus_1_states = self.sim.predict_on_batch(
+                t_obs=self.t_obs,
+                t_actions=actions,
+                t_states=self.t_states,
+                t_dones=self.t_dones,
+                t_plus_1_dones=t_plus_1_dones,
+                actual_t_plus_one_obs=t_plus_1_obs,
+                return_t_plus_one_predictions=True
+            )
+
+        return t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, losses, t_plus_1_predictions, t_plus_1_states
+
+    def _pipelined_env_step_and_predict(self, actions):
+        # The forward pass for step t only needs t_obs, so it runs while the env workers are stepping.
+        # Losses against the actual t+1 observations are then computed for groups of envs as they finish.
+        self.subproc_env.step_async(actions)
+
+        predict_start = time.perf_counter()
+        predict_vals = self.sim.begin_predict_on_batch(
+            t_obs=self.t_obs,
+            t_actions=actions,
+            t_states=self.t_states,
+            t_dones=self.t_dones,
+            return_t_plus_one_predictions=self.return_generated_frames_in_info
+        )
+
+        if self.return_generated_frames_in_info:
+            t_plus_1_predictions, t_plus_1_states = predict_vals
+        else:
+            t_plus_1_states, = predict_vals
+            t_plus_1_predictions = None
+
+        t_plus_1_obs = np.empty_like(self.t_obs)
+        extrinsic_rewards = np.empty(shape=self.num_envs, dtype=np.float32)
+        t_plus_1_dones = np.empty(shape=self.num_envs, dtype=np.bool_)
+        losses = np.empty(shape=self.num_envs, dtype=np.float32)
+
+        # Time blocked on envs that are still stepping counts as env_wait, scoring finished groups as predict.
+        predict_seconds = time.perf_counter() - predict_start
+        env_wait_seconds = 0.0
+        wait_start = time.perf_counter()
+
+        for env_indexes, obs, rews, dones, _ in step_wait_in_groups(self.subproc_env, self.pipeline_group_size):
+            score_start = time.perf_counter()
+            env_wait_seconds += score_start - wait_start
+
+            t_plus_1_obs[env_indexes] = obs
+            extrinsic_rewards[env_indexes] = rews
+            t_plus_1_dones[env_indexes] = dones
+
+            losses[env_indexes] = self.sim.finish_predict_on_batch(
+                env_indexes=env_indexes,
+                actual_t_plus_one_obs=obs,
+                t_plus_1_dones=dones
+            )
+
+            wait_start = time.perf_counter()
+            predict_seconds += wait_start - score_start
+
+        self.timer.record('env_wait', env_wait_seconds)
+        self.timer.record('predict', predict_seconds)
+
+        return t_plus_1_obs, extrinsic_rewards, t_plus_1_dones, losses, t_plus_1_predictions, t_plus_1_states
+
     def reset(self):
         logger.info("RESET WAS CALLED")
 
+        if self.async_train:
+            # Let the trainer finish the current state chain before it is reset.
+            self._train_queue.join()
+            self._raise_if_train_thread_failed()
+
         self.t_obs = self.subproc_env.reset()
         self.t_dones = [True for _ in range(self.num_envs)]
 
         self.t_states = None
         self.train_states = None
 
-        self.minibatch_observations = []
-        self.minibatch_actions = []
-        self.minibatch_dones = []
+        if self.stateful_inference:
+            self.sim.reset_states(self.num_envs)
+
+        self.minibatch_buffer.clear()
 
         return self.t_obs
 
@@ -152,47 +332,202 @@ class CuriosityWrapper:
         self.subproc_env.set_record_write(write_dir=os.path.join(self.working_dir, HEATMAP_FOLDER_NAME),
                                           prefix=self.get_current_heatmap_record_prefix())
 
-    def train(self):
-        # print("minibatch_obs shape: {}".format(np.asarray(self.minibatch_observations).shape))
-        # print("minibatch_obs: {}".format(np.asarray(self.minibatch_observations)[:,:,0,0,0]))
-        step, losses, states_out = self.sim.train_on_batch(self.minibatch_observations, self.minibatch_actions, self.minibatch_dones, self.train_states)
+    def close(self):
+        if self._train_thread is not None:
+            self._train_queue.put(None)
+            self._train_thread.join()
+            self._train_thread = None
+
+        if self._heatmap_worker is not None:
+            self._heatmap_worker.close(wait=False)
+            self._heatmap_worker = None
+
+        if self._validation_worker is not None:
+            # A validation that is already running is finished, one still waiting for it is dropped.
+            self._validation_worker.close(wait=False)
+            self._validation_worker = None
+
+        # Make sure the last checkpoint is complete on disk.
+        self.sim.wait_for_pending_saves()
+
+        self.subproc_env.close()
+
+        logger.info("Curiosity step loop timing:\n{}".format(self.timer.report()))
+
+        self._raise_if_train_thread_failed()
+
+    def _submit_heatmap(self, record_prefix, step):
+        heatmap_dir = os.path.join(self.working_dir, HEATMAP_FOLDER_NAME)
+
+        def discard():
+            logger.info("Heatmap rendering fell behind, skipping window {}".format(record_prefix))
+            delete_npy_records(directory=heatmap_dir, file_prefix=record_prefix)
+
+        self._heatmap_worker.submit(self._render_heatmap, heatmap_dir, record_prefix, step, on_discard=discard)
+
+    def _render_heatmap(self, heatmap_dir, record_prefix, step):
+        # Runs on the heatmap worker thread.
+        start = time.perf_counter()
+        heatmap_save_location = generate_boxpush_heatmap_from_npy_records(
+            directory=heatmap_dir,
+            file_prefix=record_prefix,
+            delete_records=True)
+        render_seconds = time.perf_counter() - start
+        self.timer.record('heatmap', render_seconds)
+
+        logger.info("Heatmap for env step {} saved to {} (rendered in {:.2f}s)".format(
+            step, heatmap_save_location, render_seconds))
+
+    def _enqueue_minibatch(self, minibatch):
+        # Blocks if the trainer is async_train_queue_size minibatches behind.
+        self._train_queue.put((self.current_step, self._train_queue.qsize(), minibatch))
+
+    def _async_train_loop(self):
+        while True:
+            item = self._train_queue.get()
+            try:
+                if item is None:
+                    return
+
+                if self._train_thread_exc_info is not None:
+                    # Keep draining so that the env loop never blocks on a dead trainer;
+                    # the failure is re-raised on the next step().
+                    continue
+
+                enqueued_at_step, queue_depth, minibatch = item
+
+                self._async_queue_depth_accumulator += queue_depth
+                self._async_staleness_accumulator += self.current_step - enqueued_at_step
+                self._async_stats_count += 1
+
+                self._train_on_minibatch(*minibatch)
+
+            except Exception:
+                logger.exception("Curiosity sim training thread failed")
+                self._train_thread_exc_info = sys.exc_info()
+            finally:
+                self._train_queue.task_done()
+
+    def _raise_if_train_thread_failed(self):
+        if self._train_thread_exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._train_thread_exc_info
+            raise RuntimeError("Curiosity sim training thread failed: {}".format(exc_value)).with_traceback(exc_traceback)
+
+    def _log_async_train_stats(self, step):
+        if self._async_stats_count == 0:
+            return
+
+        avg_queue_depth = self._async_queue_depth_accumulator / self._async_stats_count
+        avg_staleness = self._async_staleness_accumulator / self._async_stats_count
+
+        logger.info("sim train step {} - async queue depth: {:.2f} staleness (env steps): {:.2f}".format(
+            step, avg_queue_depth, avg_staleness))
+
+        if self.summary_writer is not None:
+            summary = tf.Summary()
+            summary.value.add(tag='curiosity_async_train/queue_depth', simple_value=avg_queue_depth)
+            summary.value.add(tag='curiosity_async_train/staleness_env_steps', simple_value=avg_staleness)
+            self.summary_writer.add_summary(summary, step)
+
+        self._async_queue_depth_accumulator = 0
+        self._async_staleness_accumulator = 0
+        self._async_stats_count = 0
+
+    def _train_on_minibatch(self, minibatch_observations, minibatch_actions, minibatch_dones):
+        if self.replay_store is not None:
+            with self.timer.time('replay_add'):
+                self.replay_store.add(minibatch_observations, minibatch_actions, minibatch_dones, self.train_states)
+
+        with self.timer.time('train'):
+            step, losses, states_out = self.sim.train_on_batch(minibatch_observations, minibatch_actions,
+                                                               minibatch_dones, self.train_states)
         # print(losses)
 
         if self.loss_accumulators is None:
             self.loss_accumulators = losses
+            self._num_accumulated_losses = 1
         else:
             for key in self.loss_accumulators.keys():
                 self.loss_accumulators[key] += losses[key]
+            self._num_accumulated_losses += 1
 
+        # Counted in on-policy train steps, since replay train steps also advance the sim step.
         print_loss_every = 100
-        if step == 1 or step % print_loss_every == 0:
+        if step == 1 or self._num_accumulated_losses >= print_loss_every:
             for key in self.loss_accumulators.keys():
-                self.loss_accumulators[key] /= print_loss_every
+                self.loss_accumulators[key] /= self._num_accumulated_losses
             logger.info("sim train step {} - {}".format(step, pretty_dict_keys_with_values(self.loss_accumulators)))
 
             # reset accumulators
             self.loss_accumulators = None
 
+            if self.async_train:
+                self._log_async_train_stats(step)
+
         self.train_states = states_out
 
-        self.minibatch_observations = []
-        self.minibatch_actions = []
-        self.minibatch_dones = []
+        self._maybe_checkpoint(step)
+
+        if self.replay_store is not None:
+            self._replay_credit += self.replay_ratio
+            while self._replay_credit >= 1:
+                self._replay_credit -= 1
+                with self.timer.time('replay_train'):
+                    self._maybe_checkpoint(self._train_on_replay())
 
+    def _maybe_checkpoint(self, step):
         if step == 1 or step % 2000 == 0:
 
-            self.sim.save_model()
+            with self.timer.time('checkpoint'):
+                checkpoint_path = self.sim.save_model()
             if self.validation_data_dir is not None:
-                val_losses = self.sim.validate(validation_data_dir=self.validation_data_dir,
-                                  allowed_action_space=self.action_space)
+                if self._validation_worker is not None:
+                    self._validation_worker.submit(self._validate_checkpoint, checkpoint_path,
+                                                   on_discard=lambda: logger.info(
+                                                       "Skipping validation of sim step {}, "
+                                                       "a newer checkpoint is waiting".format(step)))
+                else:
+                    with self.timer.time('validation'):
+                        val_losses = self.sim.validate(validation_data_dir=self.validation_data_dir,
+                                                       allowed_action_space=self.action_space)
+                    self._write_validation_results(val_losses, self.sim.get_current_step())
+
+    def _train_on_replay(self):
+        indexes, observations, actions, dones, initial_states = self.replay_store.sample(self.replay_batch_size)
+
+        if self.replay_store.prioritized:
+            step, _, _, sequence_losses = self.sim.train_on_batch(observations, actions, dones, initial_states,
+                                                                  return_sequence_losses=True)
+            self.replay_store.update_priorities(indexes, sequence_losses)
+        else:
+            step, _, _ = self.sim.train_on_batch(observations, actions, dones, initial_states)
+
+        return step
+
+    def _validate_checkpoint(self, checkpoint_path):
+        # Runs on the validation worker thread.
+        if self._validation_sim is None:
+            self._validation_sim = self.validation_sim_factory()
+
+        # With async checkpointing the checkpoint may still be being written.
+        self.sim.wait_for_checkpoint(checkpoint_path)
+        self._validation_sim.restore_model(checkpoint_path)
+        validated_step = self._validation_sim.get_current_step()
+
+        with self.timer.time('validation'):
+            val_losses = self._validation_sim.validate(validation_data_dir=self.validation_data_dir,
+                                                       allowed_action_space=self.action_space)
+
+        self._write_validation_results(val_losses, validated_step)
 
-                summary = tf.Summary()
-                for key in val_losses.keys():
-                    summary.value.add(tag=key, simple_value=val_losses[key])
-                self.summary_writer.add_summary(summary, self.sim.get_current_step())
-                self.summary_writer.flush()
+    def _write_validation_results(self, val_losses, step):
+        summary = tf.Summary()
+        for key in val_losses.keys():
+            summary.value.add(tag=key, simple_value=val_losses[key])
+        self.summary_writer.add_summary(summary, step)
+        self.summary_writer.flush()
 
-                logger.info(pretty_dict_keys_with_values(val_losses))
+        logger.info("validation at sim step {} - {}".format(step, pretty_dict_keys_with_values(val_losses)))
 
 
 
@@ -0,0 +1,71 @@
+"""
+Writes random validation tfrecords (same format as vae_datagen) and validates a FramePredictRNN on them with the
+per frame validate_full_rnn_on_tf_records and with validate_full_rnn_on_tf_records_batched. Reports both average
+losses, their difference and the time each took.
+"""
+
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import FramePredictRNN
+from directed_exploration.validation import validate_full_rnn_on_tf_records, validate_full_rnn_on_tf_records_batched
+from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.utils.frame_records import frame_features
+
+import argparse
+import os
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def write_random_validation_records(data_dir, num_files, frames_per_file, observation_space, action_dim,
+                                    frame_compression=''):
+    for file_index in range(num_files):
+        with tf.python_io.TFRecordWriter(os.path.join(data_dir, 'val_{}.tfrecords'.format(file_index))) as writer:
+            for _ in range(frames_per_file):
+                frame = np.random.randint(0, 256, size=observation_space.shape, dtype=np.uint8)
+                action = np.random.randint(0, action_dim)
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'action_at_frame': tf.train.Feature(float_list=tf.train.FloatList(
+                        value=convertToOneHot(action, num_classes=action_dim))),
+                    **frame_features(frame, frame_compression)
+                }))
+                writer.write(example.SerializeToString())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-files", type=int, default=8)
+    parser.add_argument("--frames-per-file", type=int, default=1500)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--sequences-per-batch", type=int, default=16)
+    parser.add_argument("--chunk-length", type=int, default=64)
+    args = parser.parse_args()
+
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(84, 84, 3), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(args.action_dim)
+
+    data_dir = tempfile.mkdtemp()
+    write_random_validation_records(data_dir, args.num_files, args.frames_per_file, observation_space,
+                                    args.action_dim)
+
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph)
+    rnn = FramePredictRNN(observation_space=observation_space, action_dim=args.action_dim,
+                          working_dir=tempfile.mkdtemp(), sess=sess, graph=graph)
+
+    start = time.perf_counter()
+    per_frame_loss = validate_full_rnn_on_tf_records(data_dir, rnn, sess, action_space)
+    per_frame_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched_loss = validate_full_rnn_on_tf_records_batched(data_dir, rnn, sess, action_space,
+                                                           sequences_per_batch=args.sequences_per_batch,
+                                                           chunk_length=args.chunk_length)
+    batched_seconds = time.perf_counter() - start
+
+    print("{:>10s} | {:>14s} {:>10s}".format('', 'avg loss', 'seconds'))
+    print("{:>10s} | {:>14.6f} {:>10.2f}".format('per frame', per_frame_loss, per_frame_seconds))
+    print("{:>10s} | {:>14.6f} {:>10.2f}".format('batched', batched_loss, batched_seconds))
+    print("relative difference {:.2e}, speedup {:.1f}x".format(abs(batched_loss - per_frame_loss) / per_frame_loss,
+                                                              per_frame_seconds / batched_seconds))
@@ -0,0 +1,88 @@
+"""
+Compares the cost of scoring a step with K frame prediction heads: one FramePredictRNNSim, K separate
+FramePredictRNNSims (K session runs), and one EnsembleFramePredictRNNSim with K heads batched in one graph.
+Reports predict_losses_on_batch time per step and train_on_batch time per step for each at each batch size.
+"""
+
+from directed_exploration.frame_predict_rnn.frame_predict_rnn_sim import FramePredictRNNSim
+from directed_exploration.ensemble_frame_predict_rnn.ensemble_frame_predict_rnn_sim import EnsembleFramePredictRNNSim
+
+import argparse
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def make_sim(sim_class, observation_space, action_dim, **kwargs):
+    graph = tf.Graph()
+    return sim_class(observation_space=observation_space, action_dim=action_dim, working_dir=tempfile.mkdtemp(),
+                     sess=tf.Session(graph=graph), graph=graph,
+                     summary_writer=tf.summary.FileWriter(tempfile.mkdtemp()), **kwargs)
+
+
+def seconds_per_call(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark(sims, observation_space, action_dim, batch_size, sequence_length, iterations):
+    obs = np.random.randint(0, 256, size=(batch_size, *observation_space.shape), dtype=np.uint8)
+    next_obs = np.random.randint(0, 256, size=(batch_size, *observation_space.shape), dtype=np.uint8)
+    actions = np.random.randint(0, action_dim, size=batch_size)
+    dones = np.zeros(batch_size)
+
+    obs_sequences = np.random.randint(0, 256, size=(batch_size, sequence_length + 1, *observation_space.shape),
+                                      dtype=np.uint8)
+    action_sequences = np.eye(action_dim, dtype=np.float32)[np.random.randint(0, action_dim,
+                                                                              size=(batch_size, sequence_length))]
+    dones_sequences = np.zeros((batch_size, sequence_length + 1), dtype=np.float32)
+
+    def predict():
+        for sim in sims:
+            sim.predict_losses_on_batch(obs, actions, dones, next_obs, dones)
+
+    def train():
+        for sim in sims:
+            sim.train_on_batch(obs_sequences, action_sequences, dones_sequences, None)
+
+    return seconds_per_call(predict, iterations), seconds_per_call(train, max(1, iterations // 10))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-heads", type=int, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 16, 48])
+    parser.add_argument("--sequence-length", type=int, default=5)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(84, 84, 3), dtype=np.uint8)
+
+    separate_sims = [make_sim(FramePredictRNNSim, observation_space, args.action_dim)
+                     for _ in range(args.num_heads)]
+    ensemble_sim = make_sim(EnsembleFramePredictRNNSim, observation_space, args.action_dim,
+                            num_heads=args.num_heads)
+
+    configurations = [('1 head', separate_sims[:1]),
+                      ('{} separate'.format(args.num_heads), separate_sims),
+                      ('{} ensemble'.format(args.num_heads), [ensemble_sim])]
+
+    print("{:>6s} {:>12s} | {:>14s} {:>14s} {:>10s}".format('batch', 'sims', 'predict ms', 'train ms',
+                                                             'vs 1 head'))
+
+    for batch_size in args.batch_sizes:
+        one_head_seconds = None
+        for name, sims in configurations:
+            predict_seconds, train_seconds = benchmark(sims, observation_space, args.action_dim, batch_size,
+                                                       args.sequence_length, args.iterations)
+            if one_head_seconds is None:
+                one_head_seconds = predict_seconds
+
+            print("{:>6d} {:>12s} | {:>14.3f} {:>14.3f} {:>9.2f}x".format(
+                batch_size, name, predict_seconds * 1000, train_seconds * 1000, predict_seconds / one_head_seconds))
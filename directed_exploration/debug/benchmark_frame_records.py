@@ -0,0 +1,84 @@
+"""
+Writes the same random validation frames as version 1 (pickled) frame records and as version 2 (raw uint8) frame
+records, uncompressed and ZLIB compressed, then reads each back through the tfrecord validation input pipeline.
+Reports disk usage, write throughput and read throughput of each.
+"""
+
+from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.utils.frame_records import frame_features
+from directed_exploration.validation import iterate_validation_sequences
+
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def pickled_frame_features(frame, compression):
+    return {'frame_bytes': tf.train.Feature(bytes_list=tf.train.BytesList(value=[pickle.dumps(frame)]))}
+
+
+def write_records(data_dir, frames, actions, action_dim, frames_per_file, make_frame_features, compression):
+    for file_index, start in enumerate(range(0, len(frames), frames_per_file)):
+        with tf.python_io.TFRecordWriter(os.path.join(data_dir, 'val_{}.tfrecords'.format(file_index))) as writer:
+            for frame, action in zip(frames[start:start + frames_per_file], actions[start:start + frames_per_file]):
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'action_at_frame': tf.train.Feature(float_list=tf.train.FloatList(
+                        value=convertToOneHot(action, num_classes=action_dim))),
+                    **make_frame_features(frame, compression)
+                }))
+                writer.write(example.SerializeToString())
+
+
+def directory_megabytes(data_dir):
+    return sum(os.path.getsize(os.path.join(data_dir, f)) for f in os.listdir(data_dir)) / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-frames", type=int, default=8000)
+    parser.add_argument("--frames-per-file", type=int, default=1000)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--frame-shape", type=int, nargs=3, default=[84, 84, 3])
+    args = parser.parse_args()
+
+    action_space = gym.spaces.Discrete(args.action_dim)
+
+    # Smooth rather than uniformly random frames, so that compression sees something like real observations.
+    frames = np.random.randint(0, 256, size=(args.num_frames, 1, 1, args.frame_shape[2]), dtype=np.uint8)
+    frames = np.broadcast_to(frames, (args.num_frames, *args.frame_shape)).copy()
+    actions = np.random.randint(0, args.action_dim, size=args.num_frames)
+
+    formats = [('v1 pickle', pickled_frame_features, ''),
+               ('v2 raw', frame_features, ''),
+               ('v2 zlib', frame_features, 'ZLIB')]
+
+    print("{:>10s} | {:>10s} {:>14s} {:>14s}".format('format', 'MB', 'write frames/s', 'read frames/s'))
+
+    for name, make_frame_features, compression in formats:
+        data_dir = tempfile.mkdtemp()
+
+        start = time.perf_counter()
+        write_records(data_dir, frames, actions, args.action_dim, args.frames_per_file, make_frame_features,
+                      compression)
+        write_seconds = time.perf_counter() - start
+
+        sess = tf.Session(graph=tf.Graph())
+        frames_read = 0
+        start = time.perf_counter()
+        for _, read_frames, _ in iterate_validation_sequences(data_dir, sess, action_space):
+            frames_read += len(read_frames)
+        read_seconds = time.perf_counter() - start
+        assert frames_read == args.num_frames
+
+        print("{:>10s} | {:>10.1f} {:>14.0f} {:>14.0f}".format(name, directory_megabytes(data_dir),
+                                                               args.num_frames / write_seconds,
+                                                               args.num_frames / read_seconds))
+
+        sess.close()
+        shutil.rmtree(data_dir)
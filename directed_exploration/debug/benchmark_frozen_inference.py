@@ -0,0 +1,97 @@
+"""
+Compares each model's predict method on its full training graph against the same method served from a frozen
+graph written by export_frozen_inference_graph. Reports startup time (building / restoring the training graph vs
+loading the frozen one), the max absolute difference between the two outputs and latency per call at each batch size.
+With --working-dir, models are restored from checkpoints there, otherwise freshly initialised weights are exported.
+"""
+
+from directed_exploration.frozen_model import MODEL_NAMES, build_model, export_frozen_inference_graph, \
+    load_frozen_model
+
+import argparse
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def time_per_call(predict_fn, iterations):
+    predict_fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        outputs = predict_fn()
+    return (time.perf_counter() - start) / iterations, outputs
+
+
+def make_predict_fn(model_name, model, batch_size, latent_dim, action_dim, obs_shape):
+    """Returns a deterministic predict call on random inputs, given the training or the frozen model."""
+    actions = np.random.randint(0, action_dim, size=batch_size)
+    states_mask = np.ones(batch_size)
+
+    if model_name == 'vae':
+        z_codes = np.random.randn(batch_size, latent_dim)
+        return lambda: model.decode_frames(z_codes)
+
+    if model_name == 'state_rnn':
+        z_codes = np.random.randn(batch_size, latent_dim)
+        return lambda: model.predict_on_frames(z_codes, actions, states_mask)[0]
+
+    frames = np.random.randint(0, 256, size=(batch_size, *obs_shape), dtype=np.uint8)
+
+    if model_name == 'frame_predict_rnn':
+        targets = np.random.randint(0, 256, size=(batch_size, *obs_shape), dtype=np.uint8)
+        return lambda: model.predict_losses_on_frame_batch(frames, actions, states_mask, targets, states_mask)[0]
+
+    return lambda: model.predict_on_obs_batch(frames)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs='+', choices=MODEL_NAMES, default=list(MODEL_NAMES))
+    parser.add_argument("--working-dir", type=str, default=None)
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 16, 48, 128])
+    parser.add_argument("--latent-dim", type=int, default=4)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--obs-shape", type=int, nargs=3, default=[84, 84, 3])
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    working_dir = args.working_dir or tempfile.mkdtemp()
+
+    for model_name in args.models:
+        obs_shape = [64, 64, 3] if model_name == 'vae' else args.obs_shape
+
+        start = time.perf_counter()
+        graph = tf.Graph()
+        model = build_model(model_name, working_dir, tf.Session(graph=graph), graph, args.latent_dim,
+                            args.action_dim, obs_shape)
+        training_startup_seconds = time.perf_counter() - start
+
+        export_dir = export_frozen_inference_graph(model, tempfile.mkdtemp())
+
+        start = time.perf_counter()
+        frozen_model = load_frozen_model(export_dir)
+        frozen_startup_seconds = time.perf_counter() - start
+
+        print("\n{}: startup {:.2f}s training graph, {:.2f}s frozen graph".format(
+            model_name, training_startup_seconds, frozen_startup_seconds))
+        print("{:>6s} {:>10s} | {:>12s} {:>12s} {:>8s}".format('batch', 'max diff', 'training ms', 'frozen ms',
+                                                                 'speedup'))
+
+        for batch_size in args.batch_sizes:
+            np.random.seed(batch_size)
+            training_seconds, training_out = time_per_call(
+                make_predict_fn(model_name, model, batch_size, args.latent_dim, args.action_dim, obs_shape),
+                args.iterations)
+
+            np.random.seed(batch_size)
+            frozen_seconds, frozen_out = time_per_call(
+                make_predict_fn(model_name, frozen_model, batch_size, args.latent_dim, args.action_dim, obs_shape),
+                args.iterations)
+
+            print("{:>6d} {:>10.2e} | {:>12.3f} {:>12.3f} {:>7.2f}x".format(
+                batch_size, np.max(np.abs(training_out - frozen_out)), training_seconds * 1000,
+                frozen_seconds * 1000, training_seconds / frozen_seconds))
+
+        frozen_model.close()
+        model.sess.close()
@@ -0,0 +1,58 @@
+"""
+Compares SeparateVaeRnnSim.train_on_batch with joint_training (VAE and StateRNN updated in one session run) against
+the two run version (VAE train step, codes fetched to numpy, StateRNN train step). Reports training throughput in
+frames per second for each at each batch size and sequence length.
+"""
+
+from directed_exploration.sep_vae_rnn.sep_vae_rnn_sim import SeparateVaeRnnSim
+
+import argparse
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def frames_per_second(sim, batch_size, sequence_length, action_dim, iterations):
+    obs = np.random.randint(0, 256, size=(batch_size, sequence_length + 1, 64, 64, 3), dtype=np.uint8)
+    actions = np.eye(action_dim, dtype=np.float32)[np.random.randint(0, action_dim,
+                                                                     size=(batch_size, sequence_length))]
+    dones = (np.random.rand(batch_size, sequence_length + 1) < 0.05).astype(np.float32)
+
+    states = None
+    _, _, states = sim.train_on_batch(obs, actions, dones, states)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _, _, states = sim.train_on_batch(obs, actions, dones, states)
+    seconds = time.perf_counter() - start
+
+    return iterations * batch_size * (sequence_length + 1) / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[16, 48])
+    parser.add_argument("--sequence-lengths", type=int, nargs='+', default=[5, 20])
+    parser.add_argument("--latent-dim", type=int, default=4)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    sims = {}
+    for joint_training in [False, True]:
+        graph = tf.Graph()
+        sims[joint_training] = SeparateVaeRnnSim(latent_dim=args.latent_dim, action_dim=args.action_dim,
+                                                 working_dir=tempfile.mkdtemp(), sess=tf.Session(graph=graph),
+                                                 graph=graph, joint_training=joint_training)
+
+    print("{:>8s} {:>6s} | {:>14s} {:>14s} {:>8s}".format('seq len', 'batch', 'two run fps', 'joint fps', 'speedup'))
+
+    for sequence_length in args.sequence_lengths:
+        for batch_size in args.batch_sizes:
+            two_run_fps, joint_fps = (frames_per_second(sims[joint_training], batch_size, sequence_length,
+                                                        args.action_dim, args.iterations)
+                                      for joint_training in [False, True])
+
+            print("{:>8d} {:>6d} | {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                sequence_length, batch_size, two_run_fps, joint_fps, joint_fps / two_run_fps))
@@ -0,0 +1,61 @@
+"""
+Compares FramePredictRNN.predict_on_frame_batch_with_loss (fetches predicted frames, losses and states)
+against predict_losses_on_frame_batch (fetches only losses and states).
+Reports latency per step and bytes copied out of TensorFlow per step.
+"""
+
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import FramePredictRNN
+
+import argparse
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def time_per_call(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        outputs = fn()
+    return (time.perf_counter() - start) / iterations, outputs
+
+
+def fetched_nbytes(outputs):
+    return sum(output.nbytes for output in outputs if output is not None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-envs", type=int, default=48)
+    parser.add_argument("--action-dim", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(84, 84, 3), dtype=np.uint8)
+
+    sess = tf.Session()
+    rnn = FramePredictRNN(observation_space=observation_space, action_dim=args.action_dim,
+                          working_dir=tempfile.mkdtemp(), sess=sess)
+
+    frames = np.random.randint(0, 256, size=(args.num_envs, *observation_space.shape), dtype=np.uint8)
+    targets = np.random.randint(0, 256, size=(args.num_envs, *observation_space.shape), dtype=np.uint8)
+    actions = np.random.randint(0, args.action_dim, size=args.num_envs)
+    states_mask = np.ones(args.num_envs)
+    valid_prediction_mask = np.ones(args.num_envs)
+
+    def with_predictions():
+        return rnn.predict_on_frame_batch_with_loss(frames=frames, actions=actions, states_mask=states_mask,
+                                                    target_predictions=targets,
+                                                    valid_prediction_mask=valid_prediction_mask)
+
+    def losses_only():
+        return rnn.predict_losses_on_frame_batch(frames=frames, actions=actions, states_mask=states_mask,
+                                                 target_predictions=targets,
+                                                 valid_prediction_mask=valid_prediction_mask)
+
+    for name, fn in [('with predictions', with_predictions), ('losses only', losses_only)]:
+        seconds, outputs = time_per_call(fn, args.iterations)
+        print("{:16s} {:8.2f} ms/step | {:10.1f} KB fetched/step".format(
+            name, seconds * 1000, fetched_nbytes(outputs) / 1024))
@@ -0,0 +1,98 @@
+"""
+Compares the tf.scan and fused BlockLSTM backends of frame_predict_rnn.dynamic_lstm.
+Both backends share the same wx/wh/b variables. For each done rate, sequence length and batch size this reports the
+max absolute difference between their outputs, the fraction of batches the block_fused backend runs the fused
+kernel on, and the time per forward pass and per forward + backward pass.
+
+The done rate is the chance of each env being done at each step after the first. The fused kernel only handles
+resets at the start of a sequence, so any batch with a done later in the sequence falls back to scan.
+"""
+
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import dynamic_lstm
+
+import argparse
+import itertools
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def time_per_run(sess, fetches, feed_dicts, iterations):
+    sess.run(fetches, feed_dicts[0])
+    feed_dict_cycle = itertools.cycle(feed_dicts)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        sess.run(fetches, next(feed_dict_cycle))
+    return (time.perf_counter() - start) / iterations
+
+
+def random_retain_state_mask(batch_size, sequence_length, done_rate):
+    mask = (np.random.rand(batch_size, sequence_length) >= done_rate).astype(np.float32)
+    # Reset some states at the start of the sequence, which the fused path handles without falling back.
+    mask[::2, 0] = 0
+    return mask
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-size", type=int, default=516)
+    parser.add_argument("--num-hidden", type=int, default=256)
+    parser.add_argument("--sequence-lengths", type=int, nargs='+', default=[1, 5, 20, 50])
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 16, 48, 128])
+    parser.add_argument("--done-rates", type=float, nargs='+', default=[0.0, 0.001, 0.01, 0.05])
+    parser.add_argument("--masks-per-config", help="Number of random done masks each config cycles through",
+                        type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    inputs = tf.placeholder(tf.float32, shape=[None, None, args.input_size])
+    retain_state_mask = tf.placeholder(tf.float32, shape=[None, None])
+    initial_states = tf.placeholder(tf.float32, shape=[None, args.num_hidden * 2])
+
+    outputs = {}
+    train_ops = {}
+    for backend, reuse in [('scan', False), ('block_fused', True)]:
+        with tf.variable_scope('benchmark', reuse=reuse):
+            sequence_out, _ = dynamic_lstm(input_sequence_batch=inputs,
+                                           retain_state_mask_sequence_batch=retain_state_mask,
+                                           initial_states_batch=initial_states,
+                                           scope='lstm1',
+                                           num_hidden=args.num_hidden,
+                                           backend=backend)
+        outputs[backend] = sequence_out
+        train_ops[backend] = tf.gradients(tf.reduce_sum(tf.square(sequence_out)), tf.trainable_variables())
+
+    # The 0/1 summary block_fused_lstm writes for whether it took the fused path.
+    fused_taken = [t for t in tf.get_default_graph().get_collection(tf.GraphKeys.SUMMARIES)
+                   if 'block_lstm_fused' in t.name]
+    fused_taken_input = fused_taken[0].op.inputs[1]
+
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+
+    print("{:>9s} {:>8s} {:>6s} {:>10s} {:>7s} | {:>12s} {:>12s} | {:>12s} {:>12s}".format(
+        'done rate', 'seq len', 'batch', 'max diff', 'fused', 'scan fwd ms', 'fused fwd ms', 'scan f+b ms',
+        'fused f+b ms'))
+
+    for done_rate in args.done_rates:
+        for sequence_length in args.sequence_lengths:
+            for batch_size in args.batch_sizes:
+                feed_dicts = [{
+                    inputs: np.random.randn(batch_size, sequence_length, args.input_size),
+                    retain_state_mask: random_retain_state_mask(batch_size, sequence_length, done_rate),
+                    initial_states: np.random.randn(batch_size, args.num_hidden * 2)
+                } for _ in range(args.masks_per_config)]
+
+                max_diff = 0.0
+                fused_count = 0
+                for feed_dict in feed_dicts:
+                    scan_out, fused_out, taken = sess.run([outputs['scan'], outputs['block_fused'],
+                                                           fused_taken_input], feed_dict)
+                    max_diff = max(max_diff, np.max(np.abs(scan_out - fused_out)))
+                    fused_count += int(taken)
+
+                results = [time_per_run(sess, fetches[backend], feed_dicts, args.iterations) * 1000
+                           for fetches in [outputs, train_ops] for backend in ['scan', 'block_fused']]
+
+                print("{:>9.3f} {:>8d} {:>6d} {:>10.2e} {:>7.0%} | {:>12.2f} {:>12.2f} | {:>12.2f} {:>12.2f}".format(
+                    done_rate, sequence_length, batch_size, max_diff, fused_count / len(feed_dicts), *results))
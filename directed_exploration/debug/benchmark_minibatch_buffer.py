@@ -0,0 +1,95 @@
+"""
+Compares collecting curiosity training minibatches in Python lists (converted with np.asarray(...).swapaxes(1, 0))
+against writing them into a preallocated SequenceRingBuffer.
+Reports time per minibatch, peak traced numpy allocations and process peak RSS.
+
+Each mode is run in a fresh subprocess so peak RSS is not shared between them.
+"""
+
+from directed_exploration.utils.sequence_buffer import SequenceRingBuffer
+
+import argparse
+import multiprocessing
+import resource
+import time
+import tracemalloc
+import numpy as np
+
+
+def fake_env_step(num_envs, obs_shape, rng):
+    obs = rng.randint(0, 256, size=(num_envs, *obs_shape), dtype=np.uint8)
+    dones = rng.rand(num_envs) < 0.01
+    return obs, dones
+
+
+def run_lists(args, rng):
+    obs, dones = fake_env_step(args.num_envs, args.obs_shape, rng)
+    mb_obs, mb_actions, mb_dones = [], [], []
+
+    for _ in range(args.num_minibatches):
+        for _ in range(args.seq_length):
+            actions = rng.randint(0, args.action_dim, size=args.num_envs)
+            mb_obs.append(obs)
+            mb_actions.append(np.eye(args.action_dim)[actions])
+            mb_dones.append(dones)
+            obs, dones = fake_env_step(args.num_envs, args.obs_shape, rng)
+
+        mb_obs.append(obs)
+        mb_dones.append(dones)
+
+        batch_obs = np.asarray(mb_obs).swapaxes(1, 0)
+        batch_actions = np.asarray(mb_actions).swapaxes(1, 0)
+        batch_dones = np.asarray(mb_dones).swapaxes(1, 0)
+        assert batch_obs.shape[1] == batch_actions.shape[1] + 1 == batch_dones.shape[1]
+
+        mb_obs, mb_actions, mb_dones = [], [], []
+
+
+def run_ring_buffer(args, rng):
+    obs, dones = fake_env_step(args.num_envs, args.obs_shape, rng)
+    buffer = SequenceRingBuffer(num_slots=1, num_envs=args.num_envs, seq_length=args.seq_length,
+                                obs_shape=args.obs_shape, action_dim=args.action_dim)
+
+    for _ in range(args.num_minibatches):
+        for _ in range(args.seq_length):
+            actions = rng.randint(0, args.action_dim, size=args.num_envs)
+            buffer.write_step(obs, actions, dones)
+            obs, dones = fake_env_step(args.num_envs, args.obs_shape, rng)
+
+        batch_obs, batch_actions, batch_dones = buffer.finish(obs, dones)
+        assert batch_obs.shape[1] == batch_actions.shape[1] + 1 == batch_dones.shape[1]
+
+
+def run_mode(mode, args, result_queue):
+    rng = np.random.RandomState(42)
+    run_fn = {'lists': run_lists, 'ring_buffer': run_ring_buffer}[mode]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    run_fn(args, rng)
+    elapsed = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((mode, elapsed / args.num_minibatches, traced_peak, max_rss_kb))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-envs", type=int, default=48)
+    parser.add_argument("--seq-length", type=int, default=5)
+    parser.add_argument("--action-dim", type=int, default=4)
+    parser.add_argument("--obs-shape", type=int, nargs=3, default=[84, 84, 3])
+    parser.add_argument("--num-minibatches", type=int, default=200)
+    args = parser.parse_args()
+    args.obs_shape = tuple(args.obs_shape)
+
+    result_queue = multiprocessing.Queue()
+    for mode in ['lists', 'ring_buffer']:
+        p = multiprocessing.Process(target=run_mode, args=(mode, args, result_queue))
+        p.start()
+        p.join()
+        mode, seconds_per_minibatch, traced_peak, max_rss_kb = result_queue.get()
+        print("{:12s} {:8.2f} ms/minibatch | traced peak {:8.1f} MB | peak RSS {:8.1f} MB".format(
+            mode, seconds_per_minibatch * 1000, traced_peak / 2**20, max_rss_kb / 2**10))
@@ -0,0 +1,105 @@
+"""
+Compares one step FramePredictRNN / StateRNN inference through the single step subgraph (used by
+predict_on_frame_batch* / predict_on_frames) against feeding a length 1 sequence through the tf.scan training graph.
+Reports the max absolute difference between the two paths' outputs and latency per step at each batch size.
+"""
+
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import FramePredictRNN
+from directed_exploration.sep_vae_rnn.state_rnn import StateRNN
+
+import argparse
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def time_per_run(sess, fetches, feed_dict, iterations):
+    sess.run(fetches, feed_dict)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        outputs = sess.run(fetches, feed_dict)
+    return (time.perf_counter() - start) / iterations, outputs
+
+
+def benchmark_frame_predict_rnn(batch_size, action_dim, iterations):
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph)
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(84, 84, 3), dtype=np.uint8)
+    rnn = FramePredictRNN(observation_space=observation_space, action_dim=action_dim,
+                          working_dir=tempfile.mkdtemp(), sess=sess, graph=graph)
+
+    frames = np.random.randint(0, 256, size=(batch_size, *observation_space.shape), dtype=np.uint8)
+    actions = np.eye(action_dim)[np.random.randint(0, action_dim, size=batch_size)]
+    states = np.random.randn(batch_size, rnn.states_in.shape[1].value)
+    states_mask = np.ones(batch_size)
+
+    scan_feed_dict = {
+        rnn.sequence_frame_inputs: np.expand_dims(frames, axis=1),
+        rnn.sequence_action_inputs: np.expand_dims(actions, axis=1),
+        rnn.state_reset_before_prediction_mask: np.expand_dims(states_mask, axis=1),
+        rnn.states_in: states
+    }
+    step_feed_dict = {
+        rnn.step_frame_inputs: frames,
+        rnn.step_action_inputs: actions,
+        rnn.step_state_reset_before_prediction_mask: states_mask,
+        rnn.step_states_in: states
+    }
+
+    scan_seconds, (scan_output, _) = time_per_run(sess, [rnn.output, rnn.states_out], scan_feed_dict, iterations)
+    step_seconds, (step_output, _) = time_per_run(sess, [rnn.step_output, rnn.step_states_out], step_feed_dict,
+                                                  iterations)
+
+    return np.max(np.abs(scan_output[:, 0] - step_output)), scan_seconds, step_seconds
+
+
+def benchmark_state_rnn(batch_size, latent_dim, action_dim, iterations):
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph)
+    rnn = StateRNN(latent_dim=latent_dim, action_dim=action_dim, working_dir=tempfile.mkdtemp(), sess=sess,
+                   graph=graph)
+
+    inputs = np.random.randn(batch_size, latent_dim + action_dim)
+    states = np.random.randn(batch_size, rnn.states_in.shape[1].value)
+    states_mask = np.ones(batch_size)
+
+    scan_feed_dict = {
+        rnn.sequence_inputs: np.expand_dims(inputs, axis=1),
+        rnn.state_reset_before_prediction_mask: np.expand_dims(states_mask, axis=1),
+        rnn.states_in: states
+    }
+    step_feed_dict = {
+        rnn.step_inputs: inputs,
+        rnn.step_state_reset_before_prediction_mask: states_mask,
+        rnn.step_states_in: states
+    }
+
+    scan_seconds, (scan_output, _) = time_per_run(sess, [rnn.output, rnn.states_out], scan_feed_dict, iterations)
+    step_seconds, (step_output, _) = time_per_run(sess, [rnn.step_output, rnn.step_states_out], step_feed_dict,
+                                                  iterations)
+
+    return np.max(np.abs(scan_output[:, 0] - step_output)), scan_seconds, step_seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 16, 48, 128])
+    parser.add_argument("--action-dim", type=int, default=4)
+    parser.add_argument("--latent-dim", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    print("{:>16s} {:>6s} {:>10s} | {:>10s} {:>10s} {:>8s}".format(
+        'model', 'batch', 'max diff', 'scan ms', 'step ms', 'speedup'))
+
+    for batch_size in args.batch_sizes:
+        results = [
+            ('FramePredictRNN', benchmark_frame_predict_rnn(batch_size, args.action_dim, args.iterations)),
+            ('StateRNN', benchmark_state_rnn(batch_size, args.latent_dim, args.action_dim, args.iterations))
+        ]
+        for model_name, (max_diff, scan_seconds, step_seconds) in results:
+            print("{:>16s} {:>6d} {:>10.2e} | {:>10.3f} {:>10.3f} {:>7.2f}x".format(
+                model_name, batch_size, max_diff, scan_seconds * 1000, step_seconds * 1000,
+                scan_seconds / step_seconds))
@@ -0,0 +1,62 @@
+"""
+Writes random validation tfrecords (same format as vae_datagen) and reads every validation sequence from them with
+iterate_validation_sequences, first through the tfrecord input pipeline and then through a validation cache built
+from them. Reports the time to build the cache and the frames per second of each read.
+"""
+
+from directed_exploration.debug.benchmark_batched_validation import write_random_validation_records
+from directed_exploration.utils.validation_cache import build_validation_cache, default_cache_dir
+from directed_exploration.validation import iterate_validation_sequences
+
+import argparse
+import shutil
+import tempfile
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+
+def frames_per_second(data_dir, sess, action_space, rounds):
+    frame_count = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _, frames, _ in iterate_validation_sequences(data_dir, sess, action_space):
+            # Copies the frames out, as feeding them to a model would.
+            frame_count += len(np.array(frames))
+    return frame_count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-files", type=int, default=8)
+    parser.add_argument("--frames-per-file", type=int, default=1500)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    observation_space = gym.spaces.Box(low=0, high=255, shape=(84, 84, 3), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(args.action_dim)
+
+    data_dir = tempfile.mkdtemp()
+    write_random_validation_records(data_dir, args.num_files, args.frames_per_file, observation_space,
+                                    args.action_dim)
+
+    sess = tf.Session(graph=tf.Graph())
+
+    tfrecord_fps = frames_per_second(data_dir, sess, action_space, args.rounds)
+
+    start = time.perf_counter()
+    build_validation_cache(data_dir, args.action_dim)
+    build_seconds = time.perf_counter() - start
+
+    cache_fps = frames_per_second(data_dir, sess, action_space, args.rounds)
+
+    print("cache built in {:.2f}s".format(build_seconds))
+    print("{:>10s} | {:>14s}".format('', 'frames/s'))
+    print("{:>10s} | {:>14.0f}".format('tfrecords', tfrecord_fps))
+    print("{:>10s} | {:>14.0f}".format('cache', cache_fps))
+    print("speedup {:.1f}x".format(cache_fps / tfrecord_fps))
+
+    shutil.rmtree(default_cache_dir(data_dir))
+    shutil.rmtree(data_dir)
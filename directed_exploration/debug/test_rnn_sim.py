@@ -44,7 +44,10 @@ class TestRNNSim:
         #                                                                          self.state_rnn2.return_all_variables_with_values_in_dict())))
 
     def save_model(self):
-        self.state_rnn.save_model()
+        return self.state_rnn.save_model()
+
+    def restore_model(self, checkpoint_path):
+        self.state_rnn.restore_checkpoint(checkpoint_path)
 
     def get_current_step(self):
         return self.state_rnn.sess.run([self.state_rnn.local_step])[0]
@@ -84,15 +87,8 @@ class TestRNNSim:
 
     def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch):
 
-        assert len(obs_sequence_batch) == len(action_sequence_batch) + 1
-        assert len(obs_sequence_batch) == len(dones_sequence_batch)
-
-        obs_sequence_batch = np.asarray(obs_sequence_batch).swapaxes(1, 0)
-        action_sequence_batch = np.asarray(action_sequence_batch).swapaxes(1, 0)
-        dones_sequence_batch = np.asarray(dones_sequence_batch).swapaxes(1, 0)
-
-        assert obs_sequence_batch.shape[0] == action_sequence_batch.shape[0]
-        assert obs_sequence_batch.shape[0] == dones_sequence_batch.shape[0]
+        assert obs_sequence_batch.shape[1] == action_sequence_batch.shape[1] + 1
+        assert obs_sequence_batch.shape[:2] == dones_sequence_batch.shape
 
         mask = 1 - dones_sequence_batch
 
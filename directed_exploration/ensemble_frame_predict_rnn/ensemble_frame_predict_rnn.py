@@ -0,0 +1,652 @@
+import numpy as np
+import tensorflow as tf
+from directed_exploration.model import Model
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import ortho_init, mask_non_zero_counts
+from directed_exploration.utils.data_util import convertToOneHot
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def stacked_initializer(initializer):
+    """Initializes a [num_heads, ...] variable with an independent draw of initializer for each head's [...] shape,
+    so fan in/out are those of one head's weights."""
+    def _stacked_initializer(shape, dtype=tf.float32, partition_info=None):
+        return tf.stack([tf.convert_to_tensor(initializer(list(shape[1:]), dtype=dtype, partition_info=partition_info),
+                                              dtype=dtype)
+                         for _ in range(shape[0])])
+
+    return _stacked_initializer
+
+
+def ensemble_conv2d(inputs, filters, kernel_size, strides, num_heads, activation, kernel_initializer, name,
+                    shared_inputs=False):
+    """Valid padded conv of every head's inputs with its own kernel, as one patch extraction and one matmul.
+
+    Args:
+        inputs: [num_heads, batch, height, width, channels], or [batch, height, width, channels] with shared_inputs
+            when every head sees the same inputs (the patches are then extracted once for all heads).
+
+    Returns:
+        [num_heads, batch, out_height, out_width, filters]
+    """
+    with tf.variable_scope(name):
+        in_height, in_width, in_channels = [d.value for d in inputs.shape[-3:]]
+
+        kernel = tf.get_variable('kernel', [num_heads, kernel_size, kernel_size, in_channels, filters],
+                                 initializer=stacked_initializer(kernel_initializer))
+        bias = tf.get_variable('bias', [num_heads, filters], initializer=tf.zeros_initializer())
+
+        if not shared_inputs:
+            inputs = tf.reshape(inputs, shape=[-1, in_height, in_width, in_channels])
+
+        # Patch depth is ordered (row, column, channel), like a flattened [kernel, kernel, in_channels] kernel.
+        patches = tf.extract_image_patches(inputs, ksizes=[1, kernel_size, kernel_size, 1],
+                                           strides=[1, strides, strides, 1], rates=[1, 1, 1, 1], padding='VALID')
+        out_height, out_width, patch_size = [d.value for d in patches.shape[1:]]
+
+        kernel = tf.reshape(kernel, shape=[num_heads, patch_size, filters])
+
+        if shared_inputs:
+            # All heads' kernels side by side, so every head is computed by a single 2D matmul.
+            kernel = tf.reshape(tf.transpose(kernel, [1, 0, 2]), shape=[patch_size, num_heads * filters])
+            outputs = tf.matmul(tf.reshape(patches, shape=[-1, patch_size]), kernel)
+            outputs = tf.transpose(tf.reshape(outputs, shape=[-1, num_heads, filters]), [1, 0, 2])
+        else:
+            outputs = tf.matmul(tf.reshape(patches, shape=[num_heads, -1, patch_size]), kernel)
+
+        outputs = activation(outputs + tf.expand_dims(bias, axis=1))
+
+        return tf.reshape(outputs, shape=[num_heads, -1, out_height, out_width, filters])
+
+
+def ensemble_conv2d_transpose(inputs, filters, kernel_size, strides, num_heads, activation, kernel_initializer, name,
+                              bias_initializer=tf.zeros_initializer()):
+    """Valid padded transposed conv of every head's inputs with its own kernel.
+
+    The kernel x kernel output patch of each input pixel is computed for all heads in one batched matmul. The
+    overlapping patches are then summed by padding the taps to a multiple of strides and placing each
+    strides x strides block of taps with depth_to_space, which takes the same number of ops for any num_heads.
+
+    Args:
+        inputs: [num_heads, batch, height, width, channels]
+
+    Returns:
+        [num_heads, batch, (height - 1) * strides + kernel_size, (width - 1) * strides + kernel_size, filters]
+    """
+    with tf.variable_scope(name):
+        in_height, in_width, in_channels = [d.value for d in inputs.shape[-3:]]
+
+        # Same per-head layout as a Conv2DTranspose kernel.
+        kernel = tf.get_variable('kernel', [num_heads, kernel_size, kernel_size, filters, in_channels],
+                                 initializer=stacked_initializer(kernel_initializer))
+        bias = tf.get_variable('bias', [num_heads, filters], initializer=stacked_initializer(bias_initializer))
+
+        kernel = tf.reshape(tf.transpose(kernel, [0, 4, 1, 2, 3]),
+                            shape=[num_heads, in_channels, kernel_size * kernel_size * filters])
+        patches = tf.matmul(tf.reshape(inputs, shape=[num_heads, -1, in_channels]), kernel)
+
+        blocks = -(-kernel_size // strides)
+        padded_kernel_size = blocks * strides
+
+        patches = tf.reshape(patches, shape=[-1, in_height, in_width, kernel_size, kernel_size, filters])
+        patches = tf.pad(patches, [[0, 0], [0, 0], [0, 0], [0, padded_kernel_size - kernel_size],
+                                   [0, padded_kernel_size - kernel_size], [0, 0]])
+        patches = tf.reshape(patches, shape=[-1, in_height, in_width, blocks, strides, blocks, strides, filters])
+
+        block_outputs = []
+        for block_row in range(blocks):
+            for block_col in range(blocks):
+                block = tf.reshape(patches[:, :, :, block_row, :, block_col, :, :],
+                                   shape=[-1, in_height, in_width, strides * strides * filters])
+                block = tf.depth_to_space(block, block_size=strides)
+                block_outputs.append(tf.pad(block, [[0, 0],
+                                                    [block_row * strides, (blocks - 1 - block_row) * strides],
+                                                    [block_col * strides, (blocks - 1 - block_col) * strides],
+                                                    [0, 0]]))
+
+        out_height = (in_height - 1) * strides + kernel_size
+        out_width = (in_width - 1) * strides + kernel_size
+        outputs = tf.add_n(block_outputs)[:, :out_height, :out_width, :]
+        outputs = tf.reshape(outputs, shape=[num_heads, -1, out_height, out_width, filters])
+
+        return activation(outputs + tf.reshape(bias, shape=[num_heads, 1, 1, 1, filters]))
+
+
+def ensemble_dense(inputs, units, num_heads, activation, kernel_initializer, name):
+    """[num_heads, batch, in] -> [num_heads, batch, units], every head with its own weights, as one batched matmul."""
+    with tf.variable_scope(name):
+        kernel = tf.get_variable('kernel', [num_heads, inputs.shape[-1].value, units],
+                                 initializer=stacked_initializer(kernel_initializer))
+        bias = tf.get_variable('bias', [num_heads, units], initializer=tf.zeros_initializer())
+
+        return activation(tf.matmul(inputs, kernel) + tf.expand_dims(bias, axis=1))
+
+
+def ensemble_lstm_variables(nin, scope, num_heads, num_hidden, init_scale=1.0):
+    with tf.variable_scope(scope):
+        wx = tf.get_variable("wx", [num_heads, nin, num_hidden * 4],
+                             initializer=stacked_initializer(ortho_init(init_scale)))
+        wh = tf.get_variable("wh", [num_heads, num_hidden, num_hidden * 4],
+                             initializer=stacked_initializer(ortho_init(init_scale)))
+        b = tf.get_variable("b", [num_heads, num_hidden * 4], initializer=tf.constant_initializer(0.0))
+    return wx, wh, b
+
+
+def ensemble_lstm_step(c, h, batch_inputs, batch_mask, wx, wh, b):
+    """lstm_step for all heads at once. c, h: [num_heads, batch, num_hidden], batch_inputs: [num_heads, batch, nin],
+    batch_mask: [batch, 1], shared by the heads."""
+    c = c * batch_mask
+    h = h * batch_mask
+    z = tf.matmul(batch_inputs, wx) + tf.matmul(h, wh) + tf.expand_dims(b, axis=1)
+    i, f, o, u = tf.split(axis=2, num_or_size_splits=4, value=z)
+    i = tf.nn.sigmoid(i)
+    f = tf.nn.sigmoid(f)
+    o = tf.nn.sigmoid(o)
+    u = tf.tanh(u)
+    c = f * c + i * u
+    h = o * tf.tanh(c)
+    return c, h
+
+
+def states_to_heads(states_batch, num_heads, num_hidden):
+    """[batch, num_heads * num_hidden * 2] states, each head's (c, h) side by side -> c, h [num_heads, batch, num_hidden]"""
+    states = tf.transpose(tf.reshape(states_batch, shape=[-1, num_heads, 2, num_hidden]), [2, 1, 0, 3])
+    return states[0], states[1]
+
+
+def heads_to_states(c, h, num_heads, num_hidden):
+    states = tf.transpose(tf.stack([c, h]), [2, 1, 0, 3])
+    return tf.reshape(states, shape=[-1, num_heads * 2 * num_hidden])
+
+
+def ensemble_forward(frame_inputs, action_inputs, state_reset_before_prediction_mask, states_in, num_heads,
+                     lstm_size, variable_scope, reuse=False, single_step=False):
+    """RNN_forward with num_heads independent sets of weights, all heads computed by the same batched ops.
+
+    Inputs are shared by all heads and are [batch, time, ...] sequences, or [batch, ...] with single_step.
+    States are [batch, num_heads * lstm_size * 2] so that they are kept per env like a single model's.
+
+    Returns:
+        (per-head predictions [num_heads, batch(, time), ...], states_out)
+    """
+    with tf.variable_scope(variable_scope, reuse=reuse):
+        variance_scaling = tf.contrib.layers.variance_scaling_initializer()
+        xavier = tf.contrib.layers.xavier_initializer()
+
+        if single_step:
+            frames_as_batch = frame_inputs
+        else:
+            frame_input_shape = tf.shape(frame_inputs)
+            batch_size, runtime_sequence_length = frame_input_shape[0], frame_input_shape[1]
+            frames_as_batch = tf.reshape(frame_inputs, shape=[-1, *frame_inputs.shape[2:]])
+
+        compress = ensemble_conv2d(frames_as_batch, filters=32, kernel_size=4, strides=2, num_heads=num_heads,
+                                   activation=tf.nn.relu, kernel_initializer=variance_scaling, name='encode_1',
+                                   shared_inputs=True)
+        compress = ensemble_conv2d(compress, filters=64, kernel_size=4, strides=2, num_heads=num_heads,
+                                   activation=tf.nn.relu, kernel_initializer=variance_scaling, name='encode_2')
+        compress = ensemble_conv2d(compress, filters=128, kernel_size=4, strides=2, num_heads=num_heads,
+                                   activation=tf.nn.relu, kernel_initializer=variance_scaling, name='encode_3')
+        compress = ensemble_conv2d(compress, filters=256, kernel_size=4, strides=2, num_heads=num_heads,
+                                   activation=tf.nn.relu, kernel_initializer=variance_scaling, name='encode_4')
+        logger.debug("compress 4 shape {}".format(compress.shape))
+
+        compress_before_dense_shape = [d.value for d in compress.shape[2:]]
+        compress = tf.reshape(compress, shape=[num_heads, -1, int(np.prod(compress_before_dense_shape))])
+
+        compress = ensemble_dense(compress, units=512, num_heads=num_heads, activation=tf.nn.relu,
+                                  kernel_initializer=variance_scaling, name='dense')
+
+        wx, wh, b = ensemble_lstm_variables(compress.shape[-1].value + action_inputs.shape[-1].value, 'lstm1',
+                                            num_heads, lstm_size)
+        c, h = states_to_heads(states_in, num_heads, lstm_size)
+
+        if single_step:
+            head_action_inputs = tf.tile(tf.expand_dims(action_inputs, axis=0), multiples=[num_heads, 1, 1])
+            lstm_inputs = tf.concat(values=(compress, head_action_inputs), axis=2)
+
+            c, h = ensemble_lstm_step(c, h, lstm_inputs, tf.expand_dims(state_reset_before_prediction_mask, axis=1),
+                                      wx, wh, b)
+            lstm_output_as_batch = h
+        else:
+            compress_as_seq = tf.reshape(compress, shape=[num_heads, batch_size, runtime_sequence_length,
+                                                          compress.shape[-1].value])
+            head_action_inputs = tf.tile(tf.expand_dims(action_inputs, axis=0), multiples=[num_heads, 1, 1, 1])
+            lstm_inputs = tf.concat(values=(compress_as_seq, head_action_inputs), axis=3)
+
+            # Time major for the scan: [time, num_heads, batch, ...] inputs and [time, batch, 1] masks.
+            lstm_inputs = tf.transpose(lstm_inputs, [2, 0, 1, 3])
+            retain_state_masks = tf.expand_dims(tf.transpose(state_reset_before_prediction_mask, [1, 0]), axis=2)
+
+            def _lstm_step(state_accumulator, inputs_elem):
+                step_c, step_h = state_accumulator
+                batch_inputs, batch_mask = inputs_elem
+                return ensemble_lstm_step(step_c, step_h, batch_inputs, batch_mask, wx, wh, b)
+
+            c_sequence, h_sequence = tf.scan(fn=_lstm_step, elems=(lstm_inputs, retain_state_masks),
+                                             initializer=(c, h), back_prop=True)
+            c, h = c_sequence[-1], h_sequence[-1]
+
+            lstm_output_as_batch = tf.reshape(tf.transpose(h_sequence, [1, 2, 0, 3]), shape=[num_heads, -1, lstm_size])
+
+        states_out = heads_to_states(c, h, num_heads, lstm_size)
+
+        decompress = ensemble_dense(lstm_output_as_batch, units=int(np.prod(compress_before_dense_shape)),
+                                    num_heads=num_heads, activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                                    name='dense_1')
+        decompress = tf.reshape(decompress, shape=[num_heads, -1, *compress_before_dense_shape])
+
+        decompress = ensemble_conv2d_transpose(decompress, filters=128, kernel_size=5, strides=2, num_heads=num_heads,
+                                               activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                                               name='decode_1')
+        decompress = ensemble_conv2d_transpose(decompress, filters=64, kernel_size=4, strides=2, num_heads=num_heads,
+                                               activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                                               name='decode_2')
+        decompress = ensemble_conv2d_transpose(decompress, filters=32, kernel_size=4, strides=2, num_heads=num_heads,
+                                               activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                                               name='decode_3')
+        decompress = ensemble_conv2d_transpose(decompress, filters=3, kernel_size=2, strides=2, num_heads=num_heads,
+                                               activation=tf.nn.sigmoid, kernel_initializer=xavier,
+                                               bias_initializer=xavier, name='decode_4')
+        logger.debug("decompress 4 shape {}".format(decompress.shape))
+
+        if single_step:
+            return decompress, states_out
+
+        out = tf.reshape(decompress, shape=[num_heads, batch_size, runtime_sequence_length,
+                                            *decompress.shape[2:]], name='out_reshape')
+
+        return out, states_out
+
+
+def ensemble_prediction_stats(predictions):
+    """Returns the mean prediction of the heads [batch(, time), ...] and their disagreement, the variance across
+    heads summed over each frame [batch(, time)]."""
+    mean_prediction = tf.reduce_mean(predictions, axis=0)
+    variance = tf.reduce_mean(tf.square(predictions - mean_prediction), axis=0)
+    return mean_prediction, tf.reduce_sum(variance, axis=(-3, -2, -1))
+
+
+def ensemble_prediction_errors(predictions, targets):
+    """Each head's summed squared error against targets, averaged over the heads [batch(, time)]."""
+    return tf.reduce_mean(tf.reduce_sum(tf.square(predictions - targets), axis=(-3, -2, -1)), axis=0)
+
+
+class EnsembleFramePredictRNN(Model):
+    """num_heads FramePredictRNN style networks in one graph, evaluated together by batched ops.
+
+    Heads differ only by their random initialization. They see the same inputs and are each trained on their own
+    loss. Single step methods score predictions both by the heads' mean prediction error and by their
+    disagreement (variance across heads).
+    """
+
+    def __init__(self, observation_space, action_dim, num_heads=5, working_dir=None, sess=None, graph=None,
+                 summary_writer=None):
+        logger.info("Ensemble_Frame_Predict_RNN obs space {} action dim {} heads {}".format(observation_space,
+                                                                                          action_dim, num_heads))
+
+        self.observation_space = observation_space
+        self.action_dim = action_dim
+        self.num_heads = num_heads
+
+        save_prefix = 'ensemble_frame_predict_rnn_heads_{}_obs_{}_act_{}'.format(self.num_heads,
+                                                                                 self.observation_space,
+                                                                                 self.action_dim)
+
+        super().__init__(save_prefix, working_dir, sess, graph, summary_writer=summary_writer)
+
+    def _build_model(self, restore_from_dir=None):
+
+        with self.graph.as_default():
+            rnn_scope = 'ENSEMBLE_FRAME_PREDICT_RNN_MODEL'
+            with tf.variable_scope(rnn_scope):
+
+                self.sequence_frame_inputs = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
+                                                            name='frame_inputs')
+
+                self.sequence_action_inputs = tf.placeholder(tf.float32, shape=[None, None, self.action_dim],
+                                                             name='action_inputs')
+
+                self.sequence_frame_targets = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
+                                                             name='frame_targets')
+
+                scaled_sequence_frame_inputs = tf.cast(self.sequence_frame_inputs, tf.float32) / 255.0
+                scaled_sequence_frame_targets = tf.cast(self.sequence_frame_targets, tf.float32) / 255.0
+
+                runtime_batch_size = tf.shape(self.sequence_frame_inputs)[0]
+
+                # mask (done at time t-1)
+                self.state_reset_before_prediction_mask = tf.placeholder(tf.float32, [None, None])
+
+                lstm_size = 256
+                states_size = self.num_heads * lstm_size * 2
+
+                zero_states = tf.zeros(shape=[runtime_batch_size, states_size], dtype=tf.float32)
+                self.states_in = tf.placeholder_with_default(zero_states, shape=[None, states_size])
+
+                rnn_forward_scope = 'rnn_forward'
+
+                self.output, self.states_out = ensemble_forward(
+                    frame_inputs=scaled_sequence_frame_inputs,
+                    action_inputs=self.sequence_action_inputs,
+                    state_reset_before_prediction_mask=self.state_reset_before_prediction_mask,
+                    states_in=self.states_in,
+                    num_heads=self.num_heads,
+                    lstm_size=lstm_size,
+                    variable_scope=rnn_forward_scope,
+                    reuse=False)
+
+                with tf.name_scope('mse_loss'):
+                    # mask (done at time t)
+                    self.state_reset_between_input_and_target_mask = tf.placeholder(tf.float32, [None, None])
+
+                    valid_example_mask = self.state_reset_between_input_and_target_mask
+                    valid_example_counts = mask_non_zero_counts(valid_example_mask)
+
+                    # [num_heads, batch, time]
+                    frame_squared_error = tf.reduce_sum(tf.square(self.output - scaled_sequence_frame_targets),
+                                                        axis=(3, 4, 5))
+                    masked_frame_squared_error = frame_squared_error * valid_example_mask
+                    # [batch, time], averaged over heads like the single step errors.
+                    self.masked_frame_mean_squared_errors = tf.reduce_mean(masked_frame_squared_error, axis=0)
+                    head_mse_over_sequences = tf.reduce_sum(masked_frame_squared_error, 2) / valid_example_counts
+                    self.head_mse_losses = tf.reduce_mean(head_mse_over_sequences, axis=1)
+                    # [batch], averaged over heads
+                    self.sequence_losses = tf.reduce_mean(head_mse_over_sequences, axis=0)
+
+                    self.mse_loss = tf.reduce_mean(self.head_mse_losses)
+                    # Summed, so each head gets the same gradients it would as a separate FramePredictRNN.
+                    self.train_loss = tf.reduce_sum(self.head_mse_losses)
+                    tf.summary.scalar('mse_loss', self.mse_loss)
+
+                    _, frame_disagreement = ensemble_prediction_stats(self.output)
+                    self.disagreement = tf.reduce_sum(frame_disagreement * valid_example_mask) / \
+                                        tf.reduce_sum(valid_example_mask)
+                    tf.summary.scalar('disagreement', self.disagreement)
+
+                with tf.name_scope('single_step'):
+                    self.step_frame_inputs = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                            name='step_frame_inputs')
+                    self.step_action_inputs = tf.placeholder(tf.float32, shape=[None, self.action_dim],
+                                                             name='step_action_inputs')
+                    self.step_frame_targets = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                             name='step_frame_targets')
+                    self.step_state_reset_before_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                                  name='step_states_mask')
+                    self.step_valid_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                     name='step_valid_prediction_mask')
+
+                    step_batch_size = tf.shape(self.step_action_inputs)[0]
+                    step_zero_states = tf.zeros(shape=[step_batch_size, states_size], dtype=tf.float32)
+                    self.step_states_in = tf.placeholder_with_default(step_zero_states, shape=[None, states_size])
+
+                    scaled_step_frame_inputs = tf.cast(self.step_frame_inputs, tf.float32) / 255.0
+                    scaled_step_frame_targets = tf.cast(self.step_frame_targets, tf.float32) / 255.0
+
+                    def single_step_forward(states_in):
+                        head_predictions, states_out = ensemble_forward(
+                            frame_inputs=scaled_step_frame_inputs,
+                            action_inputs=self.step_action_inputs,
+                            state_reset_before_prediction_mask=self.step_state_reset_before_prediction_mask,
+                            states_in=states_in,
+                            num_heads=self.num_heads,
+                            lstm_size=lstm_size,
+                            variable_scope=rnn_forward_scope,
+                            reuse=True,
+                            single_step=True)
+
+                        output, disagreement = ensemble_prediction_stats(head_predictions)
+                        errors = ensemble_prediction_errors(head_predictions, scaled_step_frame_targets)
+
+                        return {'head_predictions': head_predictions,
+                                'output': output,
+                                'states_out': states_out,
+                                'errors': errors * self.step_valid_prediction_mask,
+                                'disagreement': disagreement * self.step_valid_prediction_mask,
+                                'unmasked_disagreement': disagreement}
+
+                    stateless_step = single_step_forward(self.step_states_in)
+                    self.step_output = stateless_step['output']
+                    self.step_states_out = stateless_step['states_out']
+                    self.step_errors = stateless_step['errors']
+                    self.step_disagreement = stateless_step['disagreement']
+
+                # Per-env states stay in a local (never checkpointed) variable, as in FramePredictRNN.
+                with tf.name_scope('stateful_single_step'):
+                    self.resident_states = tf.Variable(
+                        initial_value=tf.zeros(shape=[0, states_size], dtype=tf.float32),
+                        trainable=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        validate_shape=False,
+                        name='resident_states'
+                    )
+
+                    stateful_step = single_step_forward(self.resident_states)
+
+                    self.advance_resident_states = tf.assign(self.resident_states, stateful_step['states_out'],
+                                                             validate_shape=False)
+                    stateful_step['states_out'] = self.advance_resident_states.op
+
+                    self.resident_states_placeholder = tf.placeholder(tf.float32, shape=[None, states_size],
+                                                                      name='resident_states_in')
+                    self.assign_resident_states = tf.assign(self.resident_states, self.resident_states_placeholder,
+                                                            validate_shape=False)
+
+                # In stateful mode states_out is the op that advances the resident states, so fetching it returns None.
+                self._single_step_fetches = {False: stateless_step, True: stateful_step}
+
+            rnn_ops_scope = 'ENSEMBLE_FRAME_PREDICT_RNN_OPS'
+            with tf.variable_scope(rnn_ops_scope):
+                self.optimizer = tf.train.RMSPropOptimizer(learning_rate=0.0001)
+                self.local_step = tf.Variable(0, name='local_step', trainable=False)
+                self.train_op = self.optimizer.minimize(self.train_loss, global_step=self.local_step)
+                self.tf_summaries_merged = tf.summary.merge_all(scope=rnn_scope)
+
+                var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_scope)
+                var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_ops_scope)
+
+                self.saver = self._make_saver(var_list)
+
+            self.init = tf.variables_initializer(var_list=var_list, name='ensemble_frame_predict_rnn_initializer')
+
+            pipeline_scope = 'ENSEMBLE_FRAME_PREDICT_RNN_PIPELINE'
+            with tf.variable_scope(pipeline_scope):
+                # Every head's predictions and their disagreement are kept in the graph between
+                # begin_predict_on_frame_batch and score_pending_predictions.
+                self.pending_head_predictions = tf.Variable(
+                    initial_value=tf.zeros(shape=[self.num_heads, 0, *self.observation_space.shape],
+                                           dtype=tf.float32),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    validate_shape=False,
+                    name='pending_head_predictions'
+                )
+                self.pending_disagreement = tf.Variable(
+                    initial_value=tf.zeros(shape=[0], dtype=tf.float32),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    validate_shape=False,
+                    name='pending_disagreement'
+                )
+
+                for fetches in self._single_step_fetches.values():
+                    fetches['store_pending'] = tf.group(
+                        tf.assign(self.pending_head_predictions, fetches['head_predictions'], validate_shape=False),
+                        tf.assign(self.pending_disagreement, fetches['unmasked_disagreement'], validate_shape=False))
+
+                self.pending_env_indexes = tf.placeholder(tf.int32, shape=[None], name='pending_env_indexes')
+                self.pending_frame_targets = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                            name='pending_frame_targets')
+                scaled_pending_frame_targets = tf.cast(self.pending_frame_targets, tf.float32) / 255.0
+                self.pending_valid_prediction_mask = tf.placeholder(tf.float32, shape=[None],
+                                                                    name='pending_valid_prediction_mask')
+
+                pending_head_predictions = tf.gather(self.pending_head_predictions, self.pending_env_indexes, axis=1)
+                self.pending_prediction_errors = ensemble_prediction_errors(pending_head_predictions,
+                                                                            scaled_pending_frame_targets) * \
+                                                 self.pending_valid_prediction_mask
+                self.pending_prediction_disagreement = tf.gather(self.pending_disagreement,
+                                                                 self.pending_env_indexes) * \
+                                                       self.pending_valid_prediction_mask
+
+        self.sess.run([self.pending_head_predictions.initializer, self.pending_disagreement.initializer,
+                       self.resident_states.initializer])
+
+        if restore_from_dir:
+            self._restore_model(restore_from_dir)
+        else:
+            logger.debug("Running Ensemble Frame Predict RNN local init\n")
+            self.sess.run(self.init)
+
+        self.writer.add_graph(self.graph)
+
+    def train_on_batch(self, input_frame_sequence_batch, target_frame_sequence_batch, states_mask_sequence_batch,
+                       input_action_sequence_batch, states_batch=None, return_sequence_losses=False):
+        """Trains every head on the batch.
+
+        Returns:
+            (mean loss over heads, disagreement over the batch, states_out, step), followed by each sequence's loss
+            averaged over heads if return_sequence_losses
+        """
+
+        assert np.array_equal(input_frame_sequence_batch.shape[:-3], target_frame_sequence_batch.shape[:-3])
+        assert np.array_equal(input_frame_sequence_batch.shape[:-3], states_mask_sequence_batch[:, :-1].shape)
+        assert np.array_equal(input_frame_sequence_batch.shape[:-3], input_action_sequence_batch.shape[:-1])
+
+        feed_dict = {
+            self.sequence_frame_inputs: input_frame_sequence_batch,
+            self.sequence_action_inputs: input_action_sequence_batch,
+            self.sequence_frame_targets: target_frame_sequence_batch,
+            self.state_reset_before_prediction_mask: states_mask_sequence_batch[:, :-1],
+            self.state_reset_between_input_and_target_mask: states_mask_sequence_batch[:, 1:]
+        }
+
+        if states_batch is not None:
+            assert np.array_equal(input_frame_sequence_batch.shape[0], states_batch.shape[0])
+            feed_dict[self.states_in] = states_batch
+
+        fetches = [self.train_op, self.mse_loss, self.disagreement, self.states_out, self.local_step]
+        if return_sequence_losses:
+            fetches.append(self.sequence_losses)
+
+        vals = self._run_train_step(fetches, feed_dict=feed_dict)
+        _, loss, disagreement, states_out, step = vals[:5]
+
+        if return_sequence_losses:
+            return loss, disagreement, states_out, step, vals[5]
+        return loss, disagreement, states_out, step
+
+    def _get_single_step_feed_dict(self, frames, actions, states_mask, states_in=None):
+
+        actions = np.asarray(actions)
+        states_mask = np.asarray(states_mask)
+
+        assert frames.shape[0] == actions.shape[0]
+        assert frames.shape[0] == states_mask.shape[0]
+        assert frames.shape[1:] == self.observation_space.shape
+
+        batch_size = frames.shape[0]
+
+        actions = convertToOneHot(actions, num_classes=self.action_dim)
+        actions = np.reshape(actions, newshape=(batch_size, self.action_dim))
+
+        states_mask = np.reshape(states_mask, newshape=(batch_size,))
+
+        feed_dict = {self.step_frame_inputs: frames,
+                     self.step_action_inputs: actions,
+                     self.step_state_reset_before_prediction_mask: states_mask
+                     }
+
+        if states_in is not None:
+            feed_dict[self.step_states_in] = states_in
+
+        return feed_dict
+
+    def predict_on_frame_batch_with_scores(self, frames, actions, states_mask, target_predictions,
+                                           valid_prediction_mask, states_in=None, stateful=False):
+        """With stateful, states_in must be None, the resident states are used and advanced, and states_out is None.
+
+        Returns:
+            (mean predictions of the heads, states_out, per-sample mean errors, per-sample disagreement)
+        """
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        feed_dict[self.step_frame_targets] = target_predictions
+        feed_dict[self.step_valid_prediction_mask] = np.reshape(valid_prediction_mask, newshape=(-1,))
+
+        fetches = self._single_step_fetches[stateful]
+        return self.sess.run([fetches['output'], fetches['states_out'], fetches['errors'], fetches['disagreement']],
+                             feed_dict=feed_dict)
+
+    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None,
+                                         valid_prediction_mask=None, stateful=False):
+        """Same as FramePredictRNN's, with the heads' mean prediction and mean error."""
+        if target_predictions is not None and valid_prediction_mask is not None:
+            return self.predict_on_frame_batch_with_scores(frames, actions, states_mask, target_predictions,
+                                                           valid_prediction_mask, states_in, stateful)[:3]
+
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        fetches = self._single_step_fetches[stateful]
+        predictions, states_out = self.sess.run([fetches['output'], fetches['states_out']], feed_dict=feed_dict)
+        return predictions, states_out, None
+
+    def predict_scores_on_frame_batch(self, frames, actions, states_mask, target_predictions, valid_prediction_mask,
+                                      states_in=None, stateful=False):
+        """Like predict_on_frame_batch_with_scores, but never copies predictions out of the graph.
+
+        Returns:
+            (per-sample mean errors, per-sample disagreement, states_out)
+        """
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        feed_dict[self.step_frame_targets] = target_predictions
+        feed_dict[self.step_valid_prediction_mask] = valid_prediction_mask
+
+        fetches = self._single_step_fetches[stateful]
+        return self.sess.run([fetches['errors'], fetches['disagreement'], fetches['states_out']], feed_dict=feed_dict)
+
+    def begin_predict_on_frame_batch(self, frames, actions, states_mask, states_in=None, return_predictions=False,
+                                     stateful=False):
+        """Runs a single prediction step and keeps every head's predictions in the graph for
+        score_pending_predictions.
+
+        Returns:
+            (mean predictions or None, states_out)
+        """
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        fetches = self._single_step_fetches[stateful]
+
+        if return_predictions:
+            _, states_out, predictions = self.sess.run([fetches['store_pending'], fetches['states_out'],
+                                                        fetches['output']],
+                                                       feed_dict=feed_dict)
+            return predictions, states_out
+
+        _, states_out = self.sess.run([fetches['store_pending'], fetches['states_out']], feed_dict=feed_dict)
+        return None, states_out
+
+    def score_pending_predictions(self, env_indexes, target_predictions, valid_prediction_mask):
+        """Returns (per-sample mean errors, per-sample disagreement) of the pending predictions at env_indexes."""
+        feed_dict = {
+            self.pending_env_indexes: env_indexes,
+            self.pending_frame_targets: target_predictions,
+            self.pending_valid_prediction_mask: valid_prediction_mask
+        }
+
+        return self.sess.run([self.pending_prediction_errors, self.pending_prediction_disagreement],
+                             feed_dict=feed_dict)
+
+    def reset_resident_states(self, batch_size):
+        """Sets the stateful inference states to zero states for batch_size envs."""
+        zero_states = np.zeros(shape=(batch_size, self.resident_states_placeholder.shape[1].value), dtype=np.float32)
+        self.sess.run(self.assign_resident_states.op, feed_dict={self.resident_states_placeholder: zero_states})
+
+    def predict_on_frame_batch(self, frames, actions, states_mask, states_in=None):
+        return self.predict_on_frame_batch_with_loss(frames, actions, states_mask, states_in)[:2]
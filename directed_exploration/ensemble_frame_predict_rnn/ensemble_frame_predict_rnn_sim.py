@@ -0,0 +1,183 @@
+from directed_exploration.ensemble_frame_predict_rnn.ensemble_frame_predict_rnn import EnsembleFramePredictRNN
+from directed_exploration.validation import validate_full_rnn_on_tf_records_batched, get_validation_pipeline
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EnsembleFramePredictRNNSim:
+    """Disagreement based curiosity from an ensemble of num_heads frame prediction networks in one graph.
+
+    The per-sample losses returned as intrinsic reward are
+    error_reward_weight * (mean prediction error of the heads) + disagreement_reward_weight * (variance across heads).
+    predict_errors_and_disagreement_on_batch returns the two terms separately.
+    """
+
+    def __init__(self, observation_space, action_dim=5, working_dir=None, sess=None, graph=None,
+                 summary_writer=None, num_heads=5, error_reward_weight=1.0, disagreement_reward_weight=1.0,
+                 stateful_inference=False):
+
+        # With stateful_inference, per-env rnn states for the predict methods stay in the graph. t_states must be
+        # None and None is returned in place of t_plus_1_states.
+        self.stateful_inference = stateful_inference
+
+        self.error_reward_weight = error_reward_weight
+        self.disagreement_reward_weight = disagreement_reward_weight
+
+        self.rnn = EnsembleFramePredictRNN(observation_space,
+                                           action_dim,
+                                           num_heads,
+                                           working_dir,
+                                           sess,
+                                           graph,
+                                           summary_writer)
+
+    def _intrinsic_rewards(self, errors, disagreement):
+        return self.error_reward_weight * errors + self.disagreement_reward_weight * disagreement
+
+    def save_model(self):
+        return self.rnn.save_model()
+
+    def restore_model(self, checkpoint_path):
+        self.rnn.restore_checkpoint(checkpoint_path)
+
+    def set_async_checkpointing(self, enabled=True):
+        self.rnn.set_async_checkpointing(enabled)
+
+    def wait_for_pending_saves(self):
+        self.rnn.wait_for_pending_save()
+
+    def wait_for_checkpoint(self, checkpoint_path):
+        self.rnn.wait_for_checkpoint(checkpoint_path)
+
+    def get_current_step(self):
+        return self.rnn.sess.run([self.rnn.local_step])[0]
+
+    def set_summary_schedule(self, every_n_steps=1, every_n_seconds=None):
+        self.rnn.set_summary_schedule(every_n_steps, every_n_seconds)
+
+    def predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, actual_t_plus_one_obs=None, t_plus_1_dones=None, return_t_plus_one_predictions=True):
+
+        return_vals = []
+
+        if actual_t_plus_one_obs is not None and t_plus_1_dones is not None:
+            t_plus_1_predictions, t_plus_1_states, errors, disagreement = self.rnn.predict_on_frame_batch_with_scores(
+                frames=t_obs,
+                actions=t_actions,
+                states_mask=1 - np.asarray(t_dones),
+                target_predictions=actual_t_plus_one_obs,
+                valid_prediction_mask=1 - np.asarray(t_plus_1_dones),
+                states_in=t_states,
+                stateful=self.stateful_inference)
+
+            if return_t_plus_one_predictions:
+                return_vals.append(t_plus_1_predictions)
+            return_vals.append(self._intrinsic_rewards(errors, disagreement))
+
+        else:
+            t_plus_1_predictions, t_plus_1_states, _ = self.rnn.predict_on_frame_batch_with_loss(
+                frames=t_obs,
+                actions=t_actions,
+                states_mask=1 - np.asarray(t_dones),
+                states_in=t_states,
+                stateful=self.stateful_inference)
+
+            if return_t_plus_one_predictions:
+                return_vals.append(t_plus_1_predictions)
+
+        return_vals.append(t_plus_1_states)
+
+        return return_vals
+
+    def predict_errors_and_disagreement_on_batch(self, t_obs, t_actions, t_dones, actual_t_plus_one_obs,
+                                                 t_plus_1_dones, t_states=None):
+        """predict_losses_on_batch with the two intrinsic reward terms kept apart.
+
+        Returns:
+            (NDArray of per-sample mean prediction errors, NDArray of per-sample disagreement,
+            NDArray of t_plus_one_states)
+        """
+
+        return self.rnn.predict_scores_on_frame_batch(
+            frames=t_obs,
+            actions=t_actions,
+            states_mask=1 - np.asarray(t_dones),
+            target_predictions=actual_t_plus_one_obs,
+            valid_prediction_mask=1 - np.asarray(t_plus_1_dones),
+            states_in=t_states,
+            stateful=self.stateful_inference)
+
+    def predict_losses_on_batch(self, t_obs, t_actions, t_dones, actual_t_plus_one_obs, t_plus_1_dones, t_states=None):
+
+        errors, disagreement, t_plus_1_states = self.predict_errors_and_disagreement_on_batch(
+            t_obs, t_actions, t_dones, actual_t_plus_one_obs, t_plus_1_dones, t_states)
+
+        return self._intrinsic_rewards(errors, disagreement), t_plus_1_states
+
+    def begin_predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, return_t_plus_one_predictions=False):
+
+        t_plus_1_predictions, t_plus_1_states = self.rnn.begin_predict_on_frame_batch(
+            frames=t_obs,
+            actions=t_actions,
+            states_mask=1 - np.asarray(t_dones),
+            states_in=t_states,
+            return_predictions=return_t_plus_one_predictions,
+            stateful=self.stateful_inference)
+
+        return_vals = []
+
+        if return_t_plus_one_predictions:
+            return_vals.append(t_plus_1_predictions)
+
+        return_vals.append(t_plus_1_states)
+
+        return return_vals
+
+    def finish_predict_on_batch(self, env_indexes, actual_t_plus_one_obs, t_plus_1_dones):
+
+        errors, disagreement = self.rnn.score_pending_predictions(env_indexes=env_indexes,
+                                                                  target_predictions=actual_t_plus_one_obs,
+                                                                  valid_prediction_mask=1 - np.asarray(t_plus_1_dones))
+
+        return self._intrinsic_rewards(errors, disagreement)
+
+    def reset_states(self, num_envs):
+        self.rnn.reset_resident_states(num_envs)
+
+    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch,
+                       return_sequence_losses=False):
+
+        assert obs_sequence_batch.shape[1] == action_sequence_batch.shape[1] + 1
+        assert obs_sequence_batch.shape[:2] == dones_sequence_batch.shape
+
+        mask = 1 - dones_sequence_batch
+
+        vals = self.rnn.train_on_batch(
+            input_frame_sequence_batch=obs_sequence_batch[:, :-1],
+            target_frame_sequence_batch=obs_sequence_batch[:, 1:],
+            states_mask_sequence_batch=mask,
+            input_action_sequence_batch=action_sequence_batch,
+            states_batch=initial_states_batch,
+            return_sequence_losses=return_sequence_losses)
+        rnn_loss, disagreement, states_out, rnn_step = vals[:4]
+
+        if return_sequence_losses:
+            return rnn_step, {'full rnn loss': rnn_loss, 'ensemble disagreement': disagreement}, states_out, vals[4]
+        return rnn_step, {'full rnn loss': rnn_loss, 'ensemble disagreement': disagreement}, states_out
+
+    def prepare_validation(self, allowed_action_space):
+        get_validation_pipeline(self.rnn.sess, allowed_action_space)
+
+    def validate(self, validation_data_dir, allowed_action_space=None):
+
+        # Scored by the heads' mean prediction error only, so it compares with FramePredictRNNSim's validation loss.
+        avg_val_loss = validate_full_rnn_on_tf_records_batched(
+            data_dir=validation_data_dir,
+            rnn=self.rnn,
+            sess=self.rnn.sess,
+            allowed_action_space=allowed_action_space
+        )
+
+        return {'avg_val_loss': avg_val_loss}
@@ -158,15 +158,19 @@ class FramePredictHMRNN(Model):
             rnn_scope = 'FRAME_PREDICT_RNN_MODEL'
             with tf.variable_scope(rnn_scope):
 
-                self.sequence_frame_inputs = tf.placeholder(tf.float32, shape=[None, None, *self.observation_space.shape],
+                # Frames are fed as uint8 and scaled to [0, 1] in the graph.
+                self.sequence_frame_inputs = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
                                                       name='frame_inputs')
 
                 self.sequence_action_inputs = tf.placeholder(tf.float32, shape=[None, None, self.action_dim],
                                                     name='action_inputs')
 
-                self.sequence_frame_targets = tf.placeholder(tf.float32, shape=[None, None, *self.observation_space.shape],
+                self.sequence_frame_targets = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
                                                        name='frame_targets')
 
+                scaled_sequence_frame_inputs = tf.cast(self.sequence_frame_inputs, tf.float32) / 255.0
+                scaled_sequence_frame_targets = tf.cast(self.sequence_frame_targets, tf.float32) / 255.0
+
                 frame_input_shape = tf.shape(self.sequence_frame_inputs)
                 runtime_batch_size = frame_input_shape[0]
                 runtime_sequence_length = frame_input_shape[1]
@@ -183,7 +187,7 @@ class FramePredictHMRNN(Model):
                 rnn_forward_scope = 'rnn_forward'
 
                 self.output, self.states_out = RNN_forward(
-                        frame_inputs=self.sequence_frame_inputs,
+                        frame_inputs=scaled_sequence_frame_inputs,
                         action_inputs=self.sequence_action_inputs,
                         batch_size=runtime_batch_size,
                         state_reset_before_prediction_mask=self.state_reset_before_prediction_mask,
@@ -206,11 +210,12 @@ class FramePredictHMRNN(Model):
                     valid_example_mask = self.state_reset_between_input_and_target_mask
                     valid_example_counts = mask_non_zero_counts(valid_example_mask)
 
-                    frame_squared_errors = tf.square(self.output - self.sequence_frame_targets)
+                    frame_squared_errors = tf.square(self.output - scaled_sequence_frame_targets)
                     frame_squared_error = tf.reduce_sum(frame_squared_errors, axis=(2, 3, 4))
                     self.masked_frame_mean_squared_errors = frame_squared_error * valid_example_mask
-                    mse_over_sequences = tf.reduce_sum(self.masked_frame_mean_squared_errors, 1) / valid_example_counts
-                    mse_over_batch = tf.reduce_mean(mse_over_sequences)
+                    self.sequence_losses = tf.reduce_sum(self.masked_frame_mean_squared_errors, 1) / \
+                        valid_example_counts
+                    mse_over_batch = tf.reduce_mean(self.sequence_losses)
                     self.mse_loss = mse_over_batch
                     tf.summary.scalar('mse_loss', self.mse_loss)
 
@@ -226,14 +231,42 @@ class FramePredictHMRNN(Model):
                 var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_scope)
                 var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_ops_scope)
 
-                self.saver = tf.train.Saver(var_list=var_list,
-                                            max_to_keep=5,
-                                            keep_checkpoint_every_n_hours=1)
+                self.saver = self._make_saver(var_list)
 
             self.init = tf.variables_initializer(var_list=var_list, name='frame_predict_rnn_initializer')
 
             self.tvars = tf.trainable_variables()
 
+            pipeline_scope = 'FRAME_PREDICT_RNN_PIPELINE'
+            with tf.variable_scope(pipeline_scope):
+                # Single step predictions are kept in the graph between begin_predict_on_frame_batch and
+                # score_pending_predictions so that they never have to be copied out just to compute losses.
+                # This is a local variable, so it isn't checkpointed.
+                self.pending_predictions = tf.Variable(
+                    initial_value=tf.zeros(shape=[0, *self.observation_space.shape], dtype=tf.float32),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    validate_shape=False,
+                    name='pending_predictions'
+                )
+
+                self.store_pending_predictions = tf.assign(self.pending_predictions, self.output[:, 0],
+                                                           validate_shape=False)
+
+                self.pending_env_indexes = tf.placeholder(tf.int32, shape=[None], name='pending_env_indexes')
+                self.pending_frame_targets = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                            name='pending_frame_targets')
+                scaled_pending_frame_targets = tf.cast(self.pending_frame_targets, tf.float32) / 255.0
+                self.pending_valid_prediction_mask = tf.placeholder(tf.float32, shape=[None],
+                                                                    name='pending_valid_prediction_mask')
+
+                pending_predictions = tf.gather(self.pending_predictions, self.pending_env_indexes)
+                pending_squared_errors = tf.square(pending_predictions - scaled_pending_frame_targets)
+                self.pending_prediction_losses = tf.reduce_sum(pending_squared_errors, axis=(1, 2, 3)) * \
+                                                 self.pending_valid_prediction_mask
+
+        self.sess.run(self.pending_predictions.initializer)
+
         if restore_from_dir:
             self._restore_model(restore_from_dir)
         else:
@@ -253,7 +286,7 @@ class FramePredictHMRNN(Model):
         return dict
 
     def train_on_batch(self, input_frame_sequence_batch, target_frame_sequence_batch, states_mask_sequence_batch,
-                       input_action_sequence_batch, states_batch=None):
+                       input_action_sequence_batch, states_batch=None, return_sequence_losses=False):
 
         assert np.array_equal(input_frame_sequence_batch.shape[:-3], target_frame_sequence_batch.shape[:-3])
         assert np.array_equal(input_frame_sequence_batch.shape[:-3], states_mask_sequence_batch[:, :-1].shape)
@@ -271,15 +304,15 @@ class FramePredictHMRNN(Model):
             assert np.array_equal(input_frame_sequence_batch.shape[0], states_batch.shape[0])
             feed_dict[self.states_in] = states_batch
 
-        _, loss, states_out, step, summaries = self.sess.run([self.train_op,
-                                                              self.mse_loss,
-                                                              self.states_out,
-                                                              self.local_step,
-                                                              self.tf_summaries_merged],
-                                                             feed_dict=feed_dict)
+        fetches = [self.train_op, self.mse_loss, self.states_out, self.local_step]
+        if return_sequence_losses:
+            fetches.append(self.sequence_losses)
 
-        self.writer.add_summary(summaries, step)
+        vals = self._run_train_step(fetches, feed_dict=feed_dict)
+        _, loss, states_out, step = vals[:4]
 
+        if return_sequence_losses:
+            return loss, states_out, step, vals[4]
         return loss, states_out, step
 
     # def train_on_input_fn(self, input_fn, steps=None):
@@ -392,7 +425,7 @@ class FramePredictHMRNN(Model):
     #         np.multiply(cell.c, mask, out=cell.c)
     #         np.multiply(cell.h, mask, out=cell.h)
 
-    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None, valid_prediction_mask=None):
+    def _get_single_step_feed_dict(self, frames, actions, states_mask, states_in=None):
 
         actions = np.asarray(actions)
         states_mask = np.asarray(states_mask)
@@ -416,6 +449,12 @@ class FramePredictHMRNN(Model):
         if states_in is not None:
             feed_dict[self.states_in] = states_in
 
+        return feed_dict
+
+    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None, valid_prediction_mask=None):
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+
         if target_predictions is not None and valid_prediction_mask is not None:
             feed_dict[self.sequence_frame_targets] = np.expand_dims(target_predictions, axis=1)
             feed_dict[self.state_reset_between_input_and_target_mask] = np.expand_dims(valid_prediction_mask, axis=1)
@@ -427,6 +466,46 @@ class FramePredictHMRNN(Model):
             predictions, states_out = self.sess.run([self.output, self.states_out], feed_dict=feed_dict)
             return predictions[:, 0, ...], states_out, None
 
+    def predict_losses_on_frame_batch(self, frames, actions, states_mask, target_predictions, valid_prediction_mask,
+                                      states_in=None):
+        """Like predict_on_frame_batch_with_loss, but only fetches per-sample losses and states, not predictions.
+
+        Returns:
+            (losses, states_out)
+        """
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        feed_dict[self.sequence_frame_targets] = np.expand_dims(target_predictions, axis=1)
+        feed_dict[self.state_reset_between_input_and_target_mask] = np.expand_dims(valid_prediction_mask, axis=1)
+
+        losses, states_out = self.sess.run([self.masked_frame_mean_squared_errors, self.states_out], feed_dict=feed_dict)
+        return losses[:, 0], states_out
+
+    def begin_predict_on_frame_batch(self, frames, actions, states_mask, states_in=None, return_predictions=False):
+        """Runs a single prediction step and keeps the predictions in the graph for score_pending_predictions.
+
+        Returns:
+            (predictions or None, states_out)
+        """
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+
+        if return_predictions:
+            _, states_out, predictions = self.sess.run([self.store_pending_predictions.op, self.states_out, self.output],
+                                                       feed_dict=feed_dict)
+            return predictions[:, 0, ...], states_out
+
+        _, states_out = self.sess.run([self.store_pending_predictions.op, self.states_out], feed_dict=feed_dict)
+        return None, states_out
+
+    def score_pending_predictions(self, env_indexes, target_predictions, valid_prediction_mask):
+        """Returns per-sample losses of the pending predictions at env_indexes against target_predictions."""
+        feed_dict = {
+            self.pending_env_indexes: env_indexes,
+            self.pending_frame_targets: target_predictions,
+            self.pending_valid_prediction_mask: valid_prediction_mask
+        }
+
+        return self.sess.run(self.pending_prediction_losses, feed_dict=feed_dict)
+
     def predict_on_frame_batch(self, frames, actions, states_mask, states_in=None):
         return self.predict_on_frame_batch_with_loss( frames, actions, states_mask, states_in)[:2]
 
@@ -1,5 +1,5 @@
 from directed_exploration.frame_predict_hmrnn.frame_predict_hmrnn import FramePredictHMRNN
-from directed_exploration.validation import validate_full_rnn_on_tf_records
+from directed_exploration.validation import validate_full_rnn_on_tf_records, get_validation_pipeline
 
 import numpy as np
 import logging
@@ -19,15 +19,27 @@ class FramePredictHMRNNSim:
 
 
     def save_model(self):
-        self.rnn.save_model()
+        return self.rnn.save_model()
+
+    def restore_model(self, checkpoint_path):
+        self.rnn.restore_checkpoint(checkpoint_path)
+
+    def set_async_checkpointing(self, enabled=True):
+        self.rnn.set_async_checkpointing(enabled)
+
+    def wait_for_pending_saves(self):
+        self.rnn.wait_for_pending_save()
+
+    def wait_for_checkpoint(self, checkpoint_path):
+        self.rnn.wait_for_checkpoint(checkpoint_path)
 
     def get_current_step(self):
         return self.rnn.sess.run([self.rnn.local_step])[0]
 
-    def predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, actual_t_plus_one_obs=None, t_plus_1_dones=None, return_t_plus_one_predictions=True):
+    def set_summary_schedule(self, every_n_steps=1, every_n_seconds=None):
+        self.rnn.set_summary_schedule(every_n_steps, every_n_seconds)
 
-        t_obs = t_obs / 255.0
-        actual_t_plus_one_obs = actual_t_plus_one_obs / 255.0
+    def predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, actual_t_plus_one_obs=None, t_plus_1_dones=None, return_t_plus_one_predictions=True):
 
         valid_prediction_mask = None
         if t_plus_1_dones is not None:
@@ -52,33 +64,66 @@ class FramePredictHMRNNSim:
 
         return return_vals
 
-    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch):
+    def predict_losses_on_batch(self, t_obs, t_actions, t_dones, actual_t_plus_one_obs, t_plus_1_dones, t_states=None):
 
-        assert len(obs_sequence_batch) == len(action_sequence_batch) + 1
-        assert len(obs_sequence_batch) == len(dones_sequence_batch)
+        losses, t_plus_1_states = self.rnn.predict_losses_on_frame_batch(
+            frames=t_obs,
+            actions=t_actions,
+            states_mask=1 - np.asarray(t_dones),
+            states_in=t_states,
+            target_predictions=actual_t_plus_one_obs,
+            valid_prediction_mask=1 - np.asarray(t_plus_1_dones))
 
-        obs_sequence_batch = np.asarray(obs_sequence_batch).swapaxes(1, 0)
-        action_sequence_batch = np.asarray(action_sequence_batch).swapaxes(1, 0)
-        dones_sequence_batch = np.asarray(dones_sequence_batch).swapaxes(1, 0)
+        return losses, t_plus_1_states
 
-        assert obs_sequence_batch.shape[0] == action_sequence_batch.shape[0]
-        assert obs_sequence_batch.shape[0] == dones_sequence_batch.shape[0]
+    def begin_predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, return_t_plus_one_predictions=False):
 
-        obs_sequence_batch = obs_sequence_batch / 255.0
+        t_plus_1_predictions, t_plus_1_states = self.rnn.begin_predict_on_frame_batch(
+            frames=t_obs,
+            actions=t_actions,
+            states_mask=1 - np.asarray(t_dones),
+            states_in=t_states,
+            return_predictions=return_t_plus_one_predictions)
 
-        mask = 1 - dones_sequence_batch
+        return_vals = []
 
-        mb_obs_shape = obs_sequence_batch.shape
+        if return_t_plus_one_predictions:
+            return_vals.append(t_plus_1_predictions)
 
-        rnn_loss, states_out, rnn_step = self.rnn.train_on_batch(
+        return_vals.append(t_plus_1_states)
+
+        return return_vals
+
+    def finish_predict_on_batch(self, env_indexes, actual_t_plus_one_obs, t_plus_1_dones):
+
+        return self.rnn.score_pending_predictions(env_indexes=env_indexes,
+                                                  target_predictions=actual_t_plus_one_obs,
+                                                  valid_prediction_mask=1 - np.asarray(t_plus_1_dones))
+
+    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch,
+                       return_sequence_losses=False):
+
+        assert obs_sequence_batch.shape[1] == action_sequence_batch.shape[1] + 1
+        assert obs_sequence_batch.shape[:2] == dones_sequence_batch.shape
+
+        mask = 1 - dones_sequence_batch
+
+        vals = self.rnn.train_on_batch(
             input_frame_sequence_batch=obs_sequence_batch[:, :-1],
             target_frame_sequence_batch=obs_sequence_batch[:, 1:],
             states_mask_sequence_batch=mask,
             input_action_sequence_batch=action_sequence_batch,
-            states_batch=initial_states_batch)
+            states_batch=initial_states_batch,
+            return_sequence_losses=return_sequence_losses)
+        rnn_loss, states_out, rnn_step = vals[:3]
 
+        if return_sequence_losses:
+            return rnn_step, {'full rnn loss': rnn_loss}, states_out, vals[3]
         return rnn_step, {'full rnn loss': rnn_loss}, states_out
 
+    def prepare_validation(self, allowed_action_space):
+        get_validation_pipeline(self.rnn.sess, allowed_action_space)
+
     def validate(self, validation_data_dir, allowed_action_space=None):
 
         avg_val_loss = validate_full_rnn_on_tf_records(
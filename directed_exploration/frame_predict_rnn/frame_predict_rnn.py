@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 from directed_exploration.model import Model
 from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.utils.tf_util import block_fused_lstm, LSTM_BACKENDS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,8 +27,51 @@ def ortho_init(scale=1.0):
     return _ortho_init
 
 
+def lstm_variables(nin, scope, num_hidden, init_scale=1.0):
+    with tf.variable_scope(scope):
+        wx = tf.get_variable("wx", [nin, num_hidden * 4], initializer=ortho_init(init_scale))
+        wh = tf.get_variable("wh", [num_hidden, num_hidden * 4], initializer=ortho_init(init_scale))
+        b = tf.get_variable("b", [num_hidden * 4], initializer=tf.constant_initializer(0.0))
+    return wx, wh, b
+
+
+def lstm_step(c, h, batch_inputs, batch_mask, wx, wh, b):
+    c = c * batch_mask
+    h = h * batch_mask
+    z = tf.matmul(batch_inputs, wx) + tf.matmul(h, wh) + b
+    i, f, o, u = tf.split(axis=1, num_or_size_splits=4, value=z)
+    i = tf.nn.sigmoid(i)
+    f = tf.nn.sigmoid(f)
+    o = tf.nn.sigmoid(o)
+    u = tf.tanh(u)
+    c = f * c + i * u
+    h = o * tf.tanh(c)
+    return c, h
+
+
+def single_step_lstm(input_batch, retain_state_mask_batch, initial_states_batch, scope, num_hidden, init_scale=1.0):
+    """One step of dynamic_lstm (same variables) without the scan and transposes.
+
+    Args:
+        input_batch: [batch, nin]
+        retain_state_mask_batch: [batch]
+        initial_states_batch: [batch, num_hidden * 2]
+
+    Returns:
+        (h [batch, num_hidden], states [batch, num_hidden * 2])
+    """
+    nin = input_batch.get_shape()[1].value
+    wx, wh, b = lstm_variables(nin, scope, num_hidden, init_scale)
+    c, h = tf.split(axis=1, num_or_size_splits=2, value=initial_states_batch)
+
+    c, h = lstm_step(c, h, input_batch, tf.expand_dims(retain_state_mask_batch, axis=1), wx, wh, b)
+
+    return h, tf.concat(axis=1, values=(c, h))
+
+
 def dynamic_lstm(input_sequence_batch, retain_state_mask_sequence_batch, initial_states_batch,
-                 scope, num_hidden, init_scale=1.0):
+                 scope, num_hidden, init_scale=1.0, backend='scan'):
+    assert backend in LSTM_BACKENDS
 
     input_sequence_batch = tf.transpose(input_sequence_batch, [1, 0, 2], name='transpose_xs')
     retain_state_mask_sequence_batch = tf.expand_dims(
@@ -36,28 +80,22 @@ def dynamic_lstm(input_sequence_batch, retain_state_mask_sequence_batch, initial
     )
 
     nbatch, nin = [v.value for v in input_sequence_batch[0].get_shape()]
-    with tf.variable_scope(scope):
-        wx = tf.get_variable("wx", [nin, num_hidden * 4], initializer=ortho_init(init_scale))
-        wh = tf.get_variable("wh", [num_hidden, num_hidden * 4], initializer=ortho_init(init_scale))
-        b = tf.get_variable("b", [num_hidden * 4], initializer=tf.constant_initializer(0.0))
+    wx, wh, b = lstm_variables(nin, scope, num_hidden, init_scale)
     c, h = tf.split(axis=1, num_or_size_splits=2, value=initial_states_batch)
 
     def _dynamic_lstm_step(state_accumulator, inputs_elem):
         c, h = state_accumulator
         batch_inputs, batch_mask = inputs_elem
-        c = c * batch_mask
-        h = h * batch_mask
-        z = tf.matmul(batch_inputs, wx) + tf.matmul(h, wh) + b
-        i, f, o, u = tf.split(axis=1, num_or_size_splits=4, value=z)
-        i = tf.nn.sigmoid(i)
-        f = tf.nn.sigmoid(f)
-        o = tf.nn.sigmoid(o)
-        u = tf.tanh(u)
-        c = f * c + i * u
-        h = o * tf.tanh(c)
-        return c, h
-
-    states = tf.scan(fn=_dynamic_lstm_step, elems=(input_sequence_batch, retain_state_mask_sequence_batch), initializer=(c, h), back_prop=True)
+        return lstm_step(c, h, batch_inputs, batch_mask, wx, wh, b)
+
+    def _scan_lstm():
+        return tf.scan(fn=_dynamic_lstm_step, elems=(input_sequence_batch, retain_state_mask_sequence_batch), initializer=(c, h), back_prop=True)
+
+    if backend == 'block_fused':
+        states = block_fused_lstm(input_sequence_batch, retain_state_mask_sequence_batch, c, h, wx, wh, b,
+                                  scan_fallback_fn=_scan_lstm)
+    else:
+        states = _scan_lstm()
     sequence_batches_out = tf.transpose(states[1], [1, 0, 2])
     state_batch_out = tf.concat(axis=1, values=(states[0][-1], states[1][-1]))
 
@@ -71,74 +109,109 @@ def mask_non_zero_counts(mask):
         return length
 
 
-def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_prediction_mask, lstm_size, states_in, variable_scope, reuse=False):
-    with tf.variable_scope(variable_scope, reuse=reuse):
-        variance_scaling = tf.contrib.layers.variance_scaling_initializer()
-        xavier = tf.contrib.layers.xavier_initializer()
+def frame_encoder(frames_as_batch):
+    """Conv encoder of RNN_forward. Must be called inside RNN_forward's variable scope.
+
+    Returns:
+        (features [batch, 512], static shape of the last conv output, which the decoder mirrors)
+    """
+    variance_scaling = tf.contrib.layers.variance_scaling_initializer()
+
+    logger.debug("inputs shape {}".format(frames_as_batch.shape))
 
-        runtime_sequence_length = tf.shape(frame_inputs)[1]
+    compress = tf.layers.Conv2D(filters=32, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_1')(frames_as_batch)
 
-        frame_inputs_as_batch = tf.reshape(frame_inputs, shape=[batch_size * runtime_sequence_length, *frame_inputs.shape[2:]])
+    logger.debug("compress 1 shape {}".format(compress.shape))
 
-        print("inputs shape {}".format(frame_inputs_as_batch.shape))
+    compress = tf.layers.Conv2D(filters=64, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_2')(compress)
 
-        compress = tf.layers.Conv2D(filters=32, kernel_size=4, strides=2,
-                                    padding='valid', activation=tf.nn.relu,
-                                    kernel_initializer=variance_scaling,
-                                    name='encode_1')(frame_inputs_as_batch)
+    logger.debug("compress 2 shape {}".format(compress.shape))
 
-        print("compress 1 shape {}".format(compress.shape))
+    compress = tf.layers.Conv2D(filters=128, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_3')(compress)
 
-        compress = tf.layers.Conv2D(filters=64, kernel_size=4, strides=2,
-                                    padding='valid', activation=tf.nn.relu,
-                                    kernel_initializer=variance_scaling,
-                                    name='encode_2')(compress)
+    logger.debug("compress 3 shape {}".format(compress.shape))
 
-        print("compress 2 shape {}".format(compress.shape))
+    compress = tf.layers.Conv2D(filters=256, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_4')(compress)
+    logger.debug("compress 4 shape {}".format(compress.shape))
+    compress_before_dense_shape = compress.shape
 
-        compress = tf.layers.Conv2D(filters=128, kernel_size=4, strides=2,
-                                    padding='valid', activation=tf.nn.relu,
-                                    kernel_initializer=variance_scaling,
-                                    name='encode_3')(compress)
+    compress = tf.layers.flatten(compress)
 
-        print("compress 3 shape {}".format(compress.shape))
+    logger.debug("compress flatten shape {}".format(compress.shape))
 
-        compress = tf.layers.Conv2D(filters=256, kernel_size=4, strides=2,
-                                    padding='valid', activation=tf.nn.relu,
-                                    kernel_initializer=variance_scaling,
-                                    name='encode_4')(compress)
-        print("compress 4 shape {}".format(compress.shape))
-        compress_before_dense_shape = compress.shape
 
-        compress = tf.layers.flatten(compress)
+    # Explicitly named (with the names they were originally given automatically) so that the layers can be
+    # reused by the single step graph.
+    compress = tf.layers.Dense(units=512, activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                               name='dense')(compress)
 
-        print("compress flatten shape {}".format(compress.shape))
 
+    logger.debug("compress dense 1 shape {}".format(compress.shape))
 
-        compress = tf.layers.Dense(units=512, activation=tf.nn.relu, kernel_initializer=variance_scaling)(compress)
+    return compress, compress_before_dense_shape
 
 
-        print("compress dense 1 shape {}".format(compress.shape))
+def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_prediction_mask, lstm_size, states_in, variable_scope, reuse=False, lstm_backend='scan', single_step=False):
+    """Builds the frame prediction network.
 
+    By default inputs are [batch, time, ...] sequences. With single_step, inputs have no time dimension
+    ([batch, ...]) and one LSTM step is built without the scan, for one step at a time inference.
+    Both versions create (or with reuse, share) the same variables.
+    """
+    with tf.variable_scope(variable_scope, reuse=reuse):
+        variance_scaling = tf.contrib.layers.variance_scaling_initializer()
+        xavier = tf.contrib.layers.xavier_initializer()
+
+        if single_step:
+            compress, compress_before_dense_shape = frame_encoder(frame_inputs)
+        else:
+            runtime_sequence_length = tf.shape(frame_inputs)[1]
 
-        compress_as_seq = tf.reshape(compress, shape=[batch_size, runtime_sequence_length, compress.shape[1]])
+            frame_inputs_as_batch = tf.reshape(frame_inputs, shape=[batch_size * runtime_sequence_length, *frame_inputs.shape[2:]])
 
-        lstm_inputs = tf.concat(values=(compress_as_seq, action_inputs), axis=2)
+            compress, compress_before_dense_shape = frame_encoder(frame_inputs_as_batch)
 
-        lstm_output, states_out = dynamic_lstm(input_sequence_batch=lstm_inputs,
-                                               retain_state_mask_sequence_batch=state_reset_before_prediction_mask,
-                                               initial_states_batch=states_in,
-                                               num_hidden=lstm_size,
-                                               scope='lstm1')
+        if single_step:
+            lstm_inputs = tf.concat(values=(compress, action_inputs), axis=1)
 
-        lstm_output_as_batch = tf.reshape(lstm_output, shape=[batch_size*runtime_sequence_length, lstm_size])
+            lstm_output_as_batch, states_out = single_step_lstm(input_batch=lstm_inputs,
+                                                                retain_state_mask_batch=state_reset_before_prediction_mask,
+                                                                initial_states_batch=states_in,
+                                                                num_hidden=lstm_size,
+                                                                scope='lstm1')
+        else:
+            compress_as_seq = tf.reshape(compress, shape=[batch_size, runtime_sequence_length, compress.shape[1]])
+
+            lstm_inputs = tf.concat(values=(compress_as_seq, action_inputs), axis=2)
+
+            lstm_output, states_out = dynamic_lstm(input_sequence_batch=lstm_inputs,
+                                                   retain_state_mask_sequence_batch=state_reset_before_prediction_mask,
+                                                   initial_states_batch=states_in,
+                                                   num_hidden=lstm_size,
+                                                   scope='lstm1',
+                                                   backend=lstm_backend)
 
-        decompress = tf.layers.Dense(units=2304, activation=tf.nn.relu, kernel_initializer=variance_scaling)(lstm_output_as_batch)
+            lstm_output_as_batch = tf.reshape(lstm_output, shape=[batch_size*runtime_sequence_length, lstm_size])
+
+        decompress = tf.layers.Dense(units=2304, activation=tf.nn.relu, kernel_initializer=variance_scaling,
+                                     name='dense_1')(lstm_output_as_batch)
 
         # decompress = tf.reshape(tensor=decompress, shape=[-1, 1, 1, decompress.shape[1]])
         decompress = tf.reshape(tensor=decompress, shape=[-1, *compress_before_dense_shape[1:]])
 
-        print("decompress dense 1 shape {}".format(decompress.shape))
+        logger.debug("decompress dense 1 shape {}".format(decompress.shape))
 
 
         decompress = tf.layers.Conv2DTranspose(filters=128, kernel_size=5, strides=2,
@@ -146,7 +219,7 @@ def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_pred
                                              kernel_initializer=variance_scaling,
                                              name='decode_1')(decompress)
 
-        print("decompress 1 shape {}".format(decompress.shape))
+        logger.debug("decompress 1 shape {}".format(decompress.shape))
 
 
         decompress = tf.layers.Conv2DTranspose(filters=64, kernel_size=4, strides=2,
@@ -154,7 +227,7 @@ def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_pred
                                              kernel_initializer=variance_scaling,
                                              name='decode_2')(decompress)
 
-        print("decompress 2 shape {}".format(decompress.shape))
+        logger.debug("decompress 2 shape {}".format(decompress.shape))
 
 
         decompress = tf.layers.Conv2DTranspose(filters=32, kernel_size=4, strides=2,
@@ -162,7 +235,7 @@ def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_pred
                                              kernel_initializer=variance_scaling,
                                              name='decode_3')(decompress)
 
-        print("decompress 3 shape {}".format(decompress.shape))
+        logger.debug("decompress 3 shape {}".format(decompress.shape))
 
 
         decompress = tf.layers.Conv2DTranspose(filters=3, kernel_size=2, strides=2,
@@ -170,8 +243,12 @@ def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_pred
                                              kernel_initializer=xavier, bias_initializer=xavier,
                                              name='decode_4')(decompress)
 
-        print("decompress 4 shape {}".format(decompress.shape))
+        logger.debug("decompress 4 shape {}".format(decompress.shape))
+
 
+        if single_step:
+            # Already [batch, ...]
+            return decompress, states_out
 
         out = tf.reshape(decompress, shape=tf.shape(frame_inputs), name='out_reshape')
 
@@ -179,11 +256,13 @@ def RNN_forward(frame_inputs, action_inputs, batch_size, state_reset_before_pred
 
 
 class FramePredictRNN(Model):
-    def __init__(self, observation_space, action_dim, working_dir=None, sess=None, graph=None, summary_writer=None):
+    def __init__(self, observation_space, action_dim, working_dir=None, sess=None, graph=None, summary_writer=None,
+                 lstm_backend='scan'):
         logger.info("Frame_Predict_RNN obs space {} action dim {}".format(observation_space, action_dim))
 
         self.observation_space = observation_space
         self.action_dim = action_dim
+        self.lstm_backend = lstm_backend
         self.saved_state = None
 
         save_prefix = 'frame_predict_rnn_obs_{}_act_{}'.format(self.observation_space, self.action_dim)
@@ -196,15 +275,19 @@ class FramePredictRNN(Model):
             rnn_scope = 'FRAME_PREDICT_RNN_MODEL'
             with tf.variable_scope(rnn_scope):
 
-                self.sequence_frame_inputs = tf.placeholder(tf.float32, shape=[None, None, *self.observation_space.shape],
+                # Frames are fed as uint8 and scaled to [0, 1] in the graph.
+                self.sequence_frame_inputs = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
                                                       name='frame_inputs')
 
                 self.sequence_action_inputs = tf.placeholder(tf.float32, shape=[None, None, self.action_dim],
                                                     name='action_inputs')
 
-                self.sequence_frame_targets = tf.placeholder(tf.float32, shape=[None, None, *self.observation_space.shape],
+                self.sequence_frame_targets = tf.placeholder(tf.uint8, shape=[None, None, *self.observation_space.shape],
                                                        name='frame_targets')
 
+                scaled_sequence_frame_inputs = tf.cast(self.sequence_frame_inputs, tf.float32) / 255.0
+                scaled_sequence_frame_targets = tf.cast(self.sequence_frame_targets, tf.float32) / 255.0
+
                 frame_input_shape = tf.shape(self.sequence_frame_inputs)
                 runtime_batch_size = frame_input_shape[0]
                 runtime_sequence_length = frame_input_shape[1]
@@ -221,14 +304,15 @@ class FramePredictRNN(Model):
                 rnn_forward_scope = 'rnn_forward'
 
                 self.output, self.states_out = RNN_forward(
-                        frame_inputs=self.sequence_frame_inputs,
+                        frame_inputs=scaled_sequence_frame_inputs,
                         action_inputs=self.sequence_action_inputs,
                         batch_size=runtime_batch_size,
                         state_reset_before_prediction_mask=self.state_reset_before_prediction_mask,
                         lstm_size=lstm_size,
                         states_in=self.states_in,
                         variable_scope=rnn_forward_scope,
-                        reuse=False)
+                        reuse=False,
+                        lstm_backend=self.lstm_backend)
 
                 # with tf.control_dependencies([tf.assert_equal(self.output,self.output2), tf.assert_equal(self.states_out, self.states_out2)]):
                 #     self.output = tf.Print(self.output, [self.output])
@@ -244,14 +328,89 @@ class FramePredictRNN(Model):
                     valid_example_mask = self.state_reset_between_input_and_target_mask
                     valid_example_counts = mask_non_zero_counts(valid_example_mask)
 
-                    frame_squared_errors = tf.square(self.output - self.sequence_frame_targets)
+                    frame_squared_errors = tf.square(self.output - scaled_sequence_frame_targets)
                     frame_squared_error = tf.reduce_sum(frame_squared_errors, axis=(2, 3, 4))
                     self.masked_frame_mean_squared_errors = frame_squared_error * valid_example_mask
-                    mse_over_sequences = tf.reduce_sum(self.masked_frame_mean_squared_errors, 1) / valid_example_counts
-                    mse_over_batch = tf.reduce_mean(mse_over_sequences)
+                    self.sequence_losses = tf.reduce_sum(self.masked_frame_mean_squared_errors, 1) / \
+                        valid_example_counts
+                    mse_over_batch = tf.reduce_mean(self.sequence_losses)
                     self.mse_loss = mse_over_batch
                     tf.summary.scalar('mse_loss', self.mse_loss)
 
+                # Single step graph for one step at a time inference during rollouts.
+                # Shares all variables with the sequence graph above but has no scan, transposes or time reshapes.
+                with tf.name_scope('single_step'):
+                    self.step_frame_inputs = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                            name='step_frame_inputs')
+                    self.step_action_inputs = tf.placeholder(tf.float32, shape=[None, self.action_dim],
+                                                             name='step_action_inputs')
+                    self.step_frame_targets = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                             name='step_frame_targets')
+                    self.step_state_reset_before_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                                  name='step_states_mask')
+                    self.step_valid_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                     name='step_valid_prediction_mask')
+
+                    step_batch_size = tf.shape(self.step_frame_inputs)[0]
+                    step_zero_states = tf.zeros(shape=[step_batch_size, lstm_size * 2], dtype=tf.float32)
+                    self.step_states_in = tf.placeholder_with_default(step_zero_states, shape=[None, lstm_size * 2])
+
+                    scaled_step_frame_inputs = tf.cast(self.step_frame_inputs, tf.float32) / 255.0
+                    scaled_step_frame_targets = tf.cast(self.step_frame_targets, tf.float32) / 255.0
+
+                    def single_step_forward(states_in):
+                        output, states_out = RNN_forward(
+                            frame_inputs=scaled_step_frame_inputs,
+                            action_inputs=self.step_action_inputs,
+                            batch_size=step_batch_size,
+                            state_reset_before_prediction_mask=self.step_state_reset_before_prediction_mask,
+                            lstm_size=lstm_size,
+                            states_in=states_in,
+                            variable_scope=rnn_forward_scope,
+                            reuse=True,
+                            single_step=True)
+
+                        squared_errors = tf.square(output - scaled_step_frame_targets)
+                        losses = tf.reduce_sum(squared_errors, axis=(1, 2, 3)) * self.step_valid_prediction_mask
+
+                        return output, states_out, losses
+
+                    self.step_output, self.step_states_out, self.step_losses = single_step_forward(self.step_states_in)
+
+                # Stateful version of the single step graph. Per-env states stay in a local (never checkpointed)
+                # variable instead of being fed in and fetched every step. Resets on done happen in the graph
+                # through the states mask, like in the stateless version.
+                with tf.name_scope('stateful_single_step'):
+                    self.resident_states = tf.Variable(
+                        initial_value=tf.zeros(shape=[0, lstm_size * 2], dtype=tf.float32),
+                        trainable=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        validate_shape=False,
+                        name='resident_states'
+                    )
+
+                    self.stateful_step_output, stateful_step_states_out, self.stateful_step_losses = \
+                        single_step_forward(self.resident_states)
+
+                    self.advance_resident_states = tf.assign(self.resident_states, stateful_step_states_out,
+                                                             validate_shape=False)
+
+                    self.resident_states_placeholder = tf.placeholder(tf.float32, shape=[None, lstm_size * 2],
+                                                                      name='resident_states_in')
+                    self.assign_resident_states = tf.assign(self.resident_states, self.resident_states_placeholder,
+                                                            validate_shape=False)
+
+                # Tensors used by the one step prediction methods, for stateless and stateful inference.
+                # In stateful mode states_out is the op that advances the resident states, so fetching it returns None.
+                self._single_step_fetches = {
+                    False: {'output': self.step_output,
+                            'states_out': self.step_states_out,
+                            'losses': self.step_losses},
+                    True: {'output': self.stateful_step_output,
+                           'states_out': self.advance_resident_states.op,
+                           'losses': self.stateful_step_losses}
+                }
+
             rnn_ops_scope = 'FRAME_PREDICT_RNN_OPS'
             with tf.variable_scope(rnn_ops_scope):
                 self.optimizer = tf.train.RMSPropOptimizer(learning_rate=0.0001)
@@ -264,14 +423,46 @@ class FramePredictRNN(Model):
                 var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_scope)
                 var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_ops_scope)
 
-                self.saver = tf.train.Saver(var_list=var_list,
-                                            max_to_keep=5,
-                                            keep_checkpoint_every_n_hours=1)
+                self.saver = self._make_saver(var_list)
 
             self.init = tf.variables_initializer(var_list=var_list, name='frame_predict_rnn_initializer')
 
             self.tvars = tf.trainable_variables()
 
+            pipeline_scope = 'FRAME_PREDICT_RNN_PIPELINE'
+            with tf.variable_scope(pipeline_scope):
+                # Single step predictions are kept in the graph between begin_predict_on_frame_batch and
+                # score_pending_predictions so that they never have to be copied out just to compute losses.
+                # This is a local variable, so it isn't checkpointed.
+                self.pending_predictions = tf.Variable(
+                    initial_value=tf.zeros(shape=[0, *self.observation_space.shape], dtype=tf.float32),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    validate_shape=False,
+                    name='pending_predictions'
+                )
+
+                self.store_pending_predictions = tf.assign(self.pending_predictions, self.step_output,
+                                                           validate_shape=False)
+                self._single_step_fetches[False]['store_pending'] = self.store_pending_predictions.op
+
+                self._single_step_fetches[True]['store_pending'] = tf.assign(
+                    self.pending_predictions, self.stateful_step_output, validate_shape=False).op
+
+                self.pending_env_indexes = tf.placeholder(tf.int32, shape=[None], name='pending_env_indexes')
+                self.pending_frame_targets = tf.placeholder(tf.uint8, shape=[None, *self.observation_space.shape],
+                                                            name='pending_frame_targets')
+                scaled_pending_frame_targets = tf.cast(self.pending_frame_targets, tf.float32) / 255.0
+                self.pending_valid_prediction_mask = tf.placeholder(tf.float32, shape=[None],
+                                                                    name='pending_valid_prediction_mask')
+
+                pending_predictions = tf.gather(self.pending_predictions, self.pending_env_indexes)
+                pending_squared_errors = tf.square(pending_predictions - scaled_pending_frame_targets)
+                self.pending_prediction_losses = tf.reduce_sum(pending_squared_errors, axis=(1, 2, 3)) * \
+                                                 self.pending_valid_prediction_mask
+
+        self.sess.run([self.pending_predictions.initializer, self.resident_states.initializer])
+
         if restore_from_dir:
             self._restore_model(restore_from_dir)
         else:
@@ -291,7 +482,7 @@ class FramePredictRNN(Model):
         return dict
 
     def train_on_batch(self, input_frame_sequence_batch, target_frame_sequence_batch, states_mask_sequence_batch,
-                       input_action_sequence_batch, states_batch=None):
+                       input_action_sequence_batch, states_batch=None, return_sequence_losses=False):
 
         assert np.array_equal(input_frame_sequence_batch.shape[:-3], target_frame_sequence_batch.shape[:-3])
         assert np.array_equal(input_frame_sequence_batch.shape[:-3], states_mask_sequence_batch[:, :-1].shape)
@@ -309,15 +500,15 @@ class FramePredictRNN(Model):
             assert np.array_equal(input_frame_sequence_batch.shape[0], states_batch.shape[0])
             feed_dict[self.states_in] = states_batch
 
-        _, loss, states_out, step, summaries = self.sess.run([self.train_op,
-                                                              self.mse_loss,
-                                                              self.states_out,
-                                                              self.local_step,
-                                                              self.tf_summaries_merged],
-                                                             feed_dict=feed_dict)
+        fetches = [self.train_op, self.mse_loss, self.states_out, self.local_step]
+        if return_sequence_losses:
+            fetches.append(self.sequence_losses)
 
-        self.writer.add_summary(summaries, step)
+        vals = self._run_train_step(fetches, feed_dict=feed_dict)
+        _, loss, states_out, step = vals[:4]
 
+        if return_sequence_losses:
+            return loss, states_out, step, vals[4]
         return loss, states_out, step
 
     # def train_on_input_fn(self, input_fn, steps=None):
@@ -430,7 +621,19 @@ class FramePredictRNN(Model):
     #         np.multiply(cell.c, mask, out=cell.c)
     #         np.multiply(cell.h, mask, out=cell.h)
 
-    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None, valid_prediction_mask=None):
+    def inference_signature(self):
+        inputs = {'step_frame_inputs': self.step_frame_inputs,
+                  'step_action_inputs': self.step_action_inputs,
+                  'step_frame_targets': self.step_frame_targets,
+                  'step_state_reset_before_prediction_mask': self.step_state_reset_before_prediction_mask,
+                  'step_valid_prediction_mask': self.step_valid_prediction_mask,
+                  'step_states_in': self.step_states_in}
+        outputs = {'step_output': self.step_output,
+                   'step_states_out': self.step_states_out,
+                   'step_losses': self.step_losses}
+        return inputs, outputs
+
+    def _get_single_step_feed_dict(self, frames, actions, states_mask, states_in=None):
 
         actions = np.asarray(actions)
         states_mask = np.asarray(states_mask)
@@ -444,26 +647,88 @@ class FramePredictRNN(Model):
         actions = convertToOneHot(actions, num_classes=self.action_dim)
         actions = np.reshape(actions, newshape=(batch_size, self.action_dim))
 
-        states_mask = np.reshape(states_mask, newshape=(batch_size, 1))
+        states_mask = np.reshape(states_mask, newshape=(batch_size,))
 
-        feed_dict = {self.sequence_frame_inputs: np.expand_dims(frames, axis=1),
-                     self.sequence_action_inputs: np.expand_dims(actions, axis=1),
-                     self.state_reset_before_prediction_mask: states_mask
+        feed_dict = {self.step_frame_inputs: frames,
+                     self.step_action_inputs: actions,
+                     self.step_state_reset_before_prediction_mask: states_mask
                      }
 
         if states_in is not None:
-            feed_dict[self.states_in] = states_in
+            feed_dict[self.step_states_in] = states_in
+
+        return feed_dict
+
+    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None, valid_prediction_mask=None, stateful=False):
+        """With stateful, states_in must be None, the resident states are used and advanced, and states_out is None."""
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        fetches = self._single_step_fetches[stateful]
 
         if target_predictions is not None and valid_prediction_mask is not None:
-            feed_dict[self.sequence_frame_targets] = np.expand_dims(target_predictions, axis=1)
-            feed_dict[self.state_reset_between_input_and_target_mask] = np.expand_dims(valid_prediction_mask, axis=1)
+            feed_dict[self.step_frame_targets] = target_predictions
+            feed_dict[self.step_valid_prediction_mask] = np.reshape(valid_prediction_mask, newshape=(-1,))
 
-            predictions, states_out, losses = self.sess.run([self.output, self.states_out, self.masked_frame_mean_squared_errors], feed_dict=feed_dict)
-            return predictions[:, 0, ...], states_out, losses[:, 0]
+            predictions, states_out, losses = self.sess.run([fetches['output'], fetches['states_out'], fetches['losses']], feed_dict=feed_dict)
+            return predictions, states_out, losses
 
         else:
-            predictions, states_out = self.sess.run([self.output, self.states_out], feed_dict=feed_dict)
-            return predictions[:, 0, ...], states_out, None
+            predictions, states_out = self.sess.run([fetches['output'], fetches['states_out']], feed_dict=feed_dict)
+            return predictions, states_out, None
+
+    def predict_losses_on_frame_batch(self, frames, actions, states_mask, target_predictions, valid_prediction_mask,
+                                      states_in=None, stateful=False):
+        """Like predict_on_frame_batch_with_loss, but only fetches per-sample losses and states, not predictions.
+
+        Returns:
+            (losses, states_out)
+        """
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        feed_dict[self.step_frame_targets] = target_predictions
+        feed_dict[self.step_valid_prediction_mask] = valid_prediction_mask
+        fetches = self._single_step_fetches[stateful]
+
+        losses, states_out = self.sess.run([fetches['losses'], fetches['states_out']], feed_dict=feed_dict)
+        return losses, states_out
+
+    def begin_predict_on_frame_batch(self, frames, actions, states_mask, states_in=None, return_predictions=False,
+                                     stateful=False):
+        """Runs a single prediction step and keeps the predictions in the graph for score_pending_predictions.
+
+        Returns:
+            (predictions or None, states_out)
+        """
+        assert not (stateful and states_in is not None)
+
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        fetches = self._single_step_fetches[stateful]
+
+        if return_predictions:
+            _, states_out, predictions = self.sess.run([fetches['store_pending'], fetches['states_out'],
+                                                        fetches['output']],
+                                                       feed_dict=feed_dict)
+            return predictions, states_out
+
+        _, states_out = self.sess.run([fetches['store_pending'], fetches['states_out']], feed_dict=feed_dict)
+        return None, states_out
+
+    def reset_resident_states(self, batch_size):
+        """Sets the stateful inference states to zero states for batch_size envs."""
+        zero_states = np.zeros(shape=(batch_size, self.resident_states_placeholder.shape[1].value), dtype=np.float32)
+        self.sess.run(self.assign_resident_states.op, feed_dict={self.resident_states_placeholder: zero_states})
+
+    def score_pending_predictions(self, env_indexes, target_predictions, valid_prediction_mask):
+        """Returns per-sample losses of the pending predictions at env_indexes against target_predictions."""
+        feed_dict = {
+            self.pending_env_indexes: env_indexes,
+            self.pending_frame_targets: target_predictions,
+            self.pending_valid_prediction_mask: valid_prediction_mask
+        }
+
+        return self.sess.run(self.pending_prediction_losses, feed_dict=feed_dict)
 
     def predict_on_frame_batch(self, frames, actions, states_mask, states_in=None):
         return self.predict_on_frame_batch_with_loss( frames, actions, states_mask, states_in)[:2]
@@ -0,0 +1,271 @@
+from directed_exploration.frame_predict_rnn.frame_predict_rnn import FramePredictRNN
+from directed_exploration.sep_vae_rnn.state_rnn import StateRNN
+from directed_exploration.sep_vae_rnn.vae import VAE
+from directed_exploration.mcts.mcts_cnn import MCTS_CNN
+from directed_exploration.utils.data_util import convertToOneHot
+from tensorflow.tools.graph_transforms import TransformGraph
+import tensorflow as tf
+import gym
+import numpy as np
+import argparse
+import tempfile
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+FROZEN_GRAPH_FILE = 'frozen_inference_graph.pb'
+SIGNATURE_FILE = 'signature.json'
+
+# Variables are already constants when these run. Inputs and outputs are never removed or folded.
+FROZEN_GRAPH_TRANSFORMS = [
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order'
+]
+
+MODEL_NAMES = ('vae', 'state_rnn', 'frame_predict_rnn', 'mcts_cnn')
+
+
+def default_export_dir(model):
+    return os.path.join(model.save_file_path, 'frozen_inference')
+
+
+def export_frozen_inference_graph(model, export_dir=None):
+    """Writes the model's stateless inference graph with its current weights folded in as constants.
+
+    Only what the outputs of model.inference_signature() depend on is kept, so optimizer slots, summaries, savers,
+    the sequence training graph and the stateful inference variables are all dropped.
+
+    model.inference_signature() returns (inputs, outputs), dicts of attribute name -> tensor for the model's
+    stateless predict methods. Only the models in MODEL_NAMES have one.
+    """
+    if not hasattr(model, 'inference_signature'):
+        raise ValueError("{} has no inference_signature(), so it can't be exported as a frozen inference "
+                         "graph".format(type(model).__name__))
+
+    if export_dir is None:
+        export_dir = default_export_dir(model)
+
+    inputs, outputs = model.inference_signature()
+    input_node_names = sorted({tensor.op.name for tensor in inputs.values()})
+    output_node_names = sorted({tensor.op.name for tensor in outputs.values()})
+
+    training_graph_def = model.graph.as_graph_def()
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess=model.sess,
+                                                                    input_graph_def=training_graph_def,
+                                                                    output_node_names=output_node_names)
+    frozen_graph_def = TransformGraph(frozen_graph_def, input_node_names, output_node_names,
+                                      FROZEN_GRAPH_TRANSFORMS)
+
+    os.makedirs(export_dir, exist_ok=True)
+    tf.train.write_graph(frozen_graph_def, export_dir, FROZEN_GRAPH_FILE, as_text=False)
+
+    signature = {
+        'model': type(model).__name__,
+        'step': int(model.sess.run(model.local_step)),
+        'inputs': {name: tensor.name for name, tensor in inputs.items()},
+        'outputs': {name: tensor.name for name, tensor in outputs.items()}
+    }
+    with open(os.path.join(export_dir, SIGNATURE_FILE), 'w') as signature_file:
+        json.dump(signature, signature_file, indent=2, sort_keys=True)
+
+    logger.info("Exported frozen {} inference graph at step {} to {} ({} nodes, down from {})".format(
+        signature['model'], signature['step'], export_dir, len(frozen_graph_def.node), len(training_graph_def.node)))
+
+    return export_dir
+
+
+class FrozenModel:
+    """Serves a model's stateless predict methods from a graph written by export_frozen_inference_graph.
+
+    Signature tensors are set as attributes with the same names they have on the model they were exported from.
+    """
+
+    def __init__(self, export_dir, sess_config=None):
+        with open(os.path.join(export_dir, SIGNATURE_FILE)) as signature_file:
+            signature = json.load(signature_file)
+
+        if signature['model'] != self.model_name:
+            raise ValueError("{} holds a frozen {} graph, not {}".format(export_dir, signature['model'],
+                                                                        self.model_name))
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, FROZEN_GRAPH_FILE), 'rb') as graph_file:
+            graph_def.ParseFromString(graph_file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.sess = tf.Session(graph=self.graph, config=sess_config)
+        self.step = signature['step']
+
+        for name, tensor_name in list(signature['inputs'].items()) + list(signature['outputs'].items()):
+            setattr(self, name, self.graph.get_tensor_by_name(tensor_name))
+
+        logger.info("Loaded frozen {} inference graph at step {} from {}".format(self.model_name, self.step,
+                                                                                export_dir))
+
+    def close(self):
+        self.sess.close()
+
+
+class FrozenVAE(FrozenModel):
+    model_name = 'VAE'
+
+    def encode_frames(self, frames):
+        return self.sess.run(self.z_encoded, feed_dict={self.x: frames})
+
+    def decode_frames(self, z_codes):
+        return self.sess.run(self.decoded, feed_dict={self.z_encoded: z_codes})
+
+    def get_loss_for_decoded_frames(self, z_codes, target_frames, return_generated_frames=False):
+        feed_dict = {self.z_encoded: z_codes, self.x: target_frames}
+        if not return_generated_frames:
+            return self.sess.run(self.per_frame_reconstruction_loss, feed_dict=feed_dict)
+        return self.sess.run([self.per_frame_reconstruction_loss, self.decoded], feed_dict=feed_dict)
+
+    def encode_then_decode_frames(self, frames):
+        return self.sess.run(self.decoded, feed_dict={self.x: frames})
+
+
+class FrozenStateRNN(FrozenModel):
+    model_name = 'StateRNN'
+
+    def __init__(self, export_dir, sess_config=None):
+        super().__init__(export_dir, sess_config)
+        self.latent_dim = self.step_output.shape[1].value
+        self.action_dim = self.step_inputs.shape[1].value - self.latent_dim
+
+    def predict_on_frames(self, z_codes, actions, states_mask, states_in=None):
+        batch_size = z_codes.shape[0]
+
+        actions = convertToOneHot(np.asarray(actions), num_classes=self.action_dim)
+        actions = np.reshape(actions, newshape=(batch_size, self.action_dim))
+
+        feed_dict = {self.step_inputs: np.concatenate((z_codes, actions), axis=1),
+                     self.step_state_reset_before_prediction_mask: np.reshape(states_mask, newshape=(batch_size,))}
+
+        if states_in is not None:
+            feed_dict[self.step_states_in] = states_in
+
+        return self.sess.run([self.step_output, self.step_states_out], feed_dict=feed_dict)
+
+
+class FrozenFramePredictRNN(FrozenModel):
+    model_name = 'FramePredictRNN'
+
+    def __init__(self, export_dir, sess_config=None):
+        super().__init__(export_dir, sess_config)
+        self.action_dim = self.step_action_inputs.shape[1].value
+
+    def _get_single_step_feed_dict(self, frames, actions, states_mask, states_in=None):
+        batch_size = frames.shape[0]
+
+        actions = convertToOneHot(np.asarray(actions), num_classes=self.action_dim)
+        actions = np.reshape(actions, newshape=(batch_size, self.action_dim))
+
+        feed_dict = {self.step_frame_inputs: frames,
+                     self.step_action_inputs: actions,
+                     self.step_state_reset_before_prediction_mask: np.reshape(states_mask, newshape=(batch_size,))}
+
+        if states_in is not None:
+            feed_dict[self.step_states_in] = states_in
+
+        return feed_dict
+
+    def predict_on_frame_batch_with_loss(self, frames, actions, states_mask, states_in=None, target_predictions=None,
+                                         valid_prediction_mask=None):
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+
+        if target_predictions is not None and valid_prediction_mask is not None:
+            feed_dict[self.step_frame_targets] = target_predictions
+            feed_dict[self.step_valid_prediction_mask] = np.reshape(valid_prediction_mask, newshape=(-1,))
+            return self.sess.run([self.step_output, self.step_states_out, self.step_losses], feed_dict=feed_dict)
+
+        predictions, states_out = self.sess.run([self.step_output, self.step_states_out], feed_dict=feed_dict)
+        return predictions, states_out, None
+
+    def predict_losses_on_frame_batch(self, frames, actions, states_mask, target_predictions, valid_prediction_mask,
+                                      states_in=None):
+        feed_dict = self._get_single_step_feed_dict(frames, actions, states_mask, states_in)
+        feed_dict[self.step_frame_targets] = target_predictions
+        feed_dict[self.step_valid_prediction_mask] = valid_prediction_mask
+
+        return self.sess.run([self.step_losses, self.step_states_out], feed_dict=feed_dict)
+
+    def predict_on_frame_batch(self, frames, actions, states_mask, states_in=None):
+        return self.predict_on_frame_batch_with_loss(frames, actions, states_mask, states_in)[:2]
+
+
+class FrozenMCTS_CNN(FrozenModel):
+    model_name = 'MCTS_CNN'
+
+    def predict_on_obs_batch(self, obs_batch):
+        return self.sess.run([self.policy_out, self.value_out], feed_dict={self.obs_input: obs_batch})
+
+    def predict_on_single_obs(self, obs):
+        return (result[0] for result in self.predict_on_obs_batch(np.expand_dims(obs, axis=0)))
+
+
+FROZEN_MODEL_CLASSES = {frozen_class.model_name: frozen_class
+                        for frozen_class in [FrozenVAE, FrozenStateRNN, FrozenFramePredictRNN, FrozenMCTS_CNN]}
+
+
+def load_frozen_model(export_dir, sess_config=None):
+    """Returns the Frozen* model matching the graph in export_dir."""
+    with open(os.path.join(export_dir, SIGNATURE_FILE)) as signature_file:
+        model_name = json.load(signature_file)['model']
+    return FROZEN_MODEL_CLASSES[model_name](export_dir, sess_config)
+
+
+def build_model(model_name, working_dir, sess, graph, latent_dim, action_dim, obs_shape, summary_writer=None):
+    """Builds (and restores from working_dir if it holds a checkpoint) one of MODEL_NAMES with its training graph."""
+    if summary_writer is None:
+        # Keeps graph events from these throwaway models out of the run's own summaries.
+        summary_writer = tf.summary.FileWriter(tempfile.mkdtemp())
+
+    if model_name == 'vae':
+        return VAE(latent_dim, working_dir, sess, graph, summary_writer)
+
+    if model_name == 'state_rnn':
+        return StateRNN(latent_dim, action_dim, working_dir, sess, graph, summary_writer)
+
+    observation_space = gym.spaces.Box(low=0, high=255, shape=tuple(obs_shape), dtype=np.uint8)
+
+    if model_name == 'frame_predict_rnn':
+        return FramePredictRNN(observation_space, action_dim, working_dir, sess, graph, summary_writer)
+
+    if model_name == 'mcts_cnn':
+        return MCTS_CNN(observation_space, gym.spaces.Discrete(action_dim), working_dir, sess, graph,
+                        summary_writer)
+
+    raise ValueError("Unknown model {}, must be one of {}".format(model_name, MODEL_NAMES))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Export a frozen, constant folded inference graph of a trained "
+                                                 "model, loadable with load_frozen_model")
+    parser.add_argument("--model", type=str, choices=MODEL_NAMES, required=True)
+    parser.add_argument("--working-dir", help="Run directory holding the model's checkpoint directory",
+                        type=str, required=True)
+    parser.add_argument("--export-dir", help="Defaults to frozen_inference in the model's checkpoint directory",
+                        type=str, default=None)
+    parser.add_argument("--latent-dim", type=int, default=4)
+    parser.add_argument("--action-dim", type=int, default=5)
+    parser.add_argument("--obs-shape", help="Observation shape for frame_predict_rnn and mcts_cnn",
+                        type=int, nargs=3, default=[84, 84, 3])
+    args = parser.parse_args()
+
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph)
+    model = build_model(args.model, args.working_dir, sess, graph, args.latent_dim, args.action_dim, args.obs_shape)
+
+    if not os.path.exists(os.path.join(model.save_file_path, 'checkpoint')):
+        parser.error("No {} checkpoint in {}".format(model.save_prefix, model.save_file_path))
+
+    export_frozen_inference_graph(model, args.export_dir)
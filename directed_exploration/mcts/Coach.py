@@ -166,8 +166,8 @@ class Coach():
 
                 for batch_number in range(self.args.num_batches):
                     self.search_trees = [MCTS(self.nnet, self.args) for _ in range(self.nenvs)]
-                    scaled_obs_batch, policy_targets, value_targets = self.run_batch(self.args.batch_nsteps)
-                    self.nnet.train_on_batch(scaled_obs_batch, policy_targets, value_targets)
+                    obs_batch, policy_targets, value_targets = self.run_batch(self.args.batch_nsteps)
+                    self.nnet.train_on_batch(obs_batch, policy_targets, value_targets)
                     # bookkeeping + plot progress
                     batch_time.update(time.time() - end)
                     end = time.time()
@@ -24,13 +24,14 @@ class MCTS_CNN(Model):
             with tf.variable_scope(model_scope):
                 variance_scaling = tf.contrib.layers.variance_scaling_initializer()
 
-                self.scaled_obs_input = tf.placeholder(tf.float32, shape=[None, *self.obs_space.shape],
-                                                       name='scaled_obs')
+                # Observations are fed as uint8 and scaled to [0, 1] in the graph.
+                self.obs_input = tf.placeholder(tf.uint8, shape=[None, *self.obs_space.shape], name='obs')
+                scaled_obs_input = tf.cast(self.obs_input, tf.float32) / 255.0
 
                 net = tf.layers.Conv2D(filters=32, kernel_size=7, strides=4,
                                        padding='valid', activation=tf.nn.relu,
                                        kernel_initializer=variance_scaling,
-                                       name='conv1')(self.scaled_obs_input)
+                                       name='conv1')(scaled_obs_input)
 
                 net = tf.layers.Conv2D(filters=64, kernel_size=5, strides=2,
                                        padding='valid', activation=tf.nn.relu,
@@ -84,9 +85,7 @@ class MCTS_CNN(Model):
                 var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=model_scope)
                 var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=ops_scope)
 
-                self.saver = tf.train.Saver(var_list=var_list,
-                                            max_to_keep=5,
-                                            keep_checkpoint_every_n_hours=1)
+                self.saver = self._make_saver(var_list)
 
             self.init = tf.variables_initializer(var_list=var_list, name='mcts_cnn_initializer')
 
@@ -98,31 +97,31 @@ class MCTS_CNN(Model):
 
         self.writer.add_graph(self.graph)
 
-    def train_on_batch(self, scaled_obs_batch, policy_targets, value_targets):
+    def train_on_batch(self, obs_batch, policy_targets, value_targets):
 
         feed_dict = {
-            self.scaled_obs_input: scaled_obs_batch,
+            self.obs_input: obs_batch,
             self.value_targets: value_targets,
             self.policy_targets: policy_targets
         }
 
-        _, loss, value_loss, policy_loss, summaries, step = self.sess.run([self.train_op,
-                                                                           self.loss,
-                                                                           self.value_loss,
-                                                                           self.policy_loss,
-                                                                           self.tf_summaries_merged,
-                                                                           self.local_step],
-                                                                          feed_dict=feed_dict)
-
-        self.writer.add_summary(summaries, step)
+        _, loss, value_loss, policy_loss, step = self._run_train_step([self.train_op,
+                                                                       self.loss,
+                                                                       self.value_loss,
+                                                                       self.policy_loss,
+                                                                       self.local_step],
+                                                                      feed_dict=feed_dict)
 
         return loss, value_loss, policy_loss, step
 
-    def predict_on_obs_batch(self, scaled_obs_batch):
+    def inference_signature(self):
+        return {'obs_input': self.obs_input}, {'policy_out': self.policy_out, 'value_out': self.value_out}
+
+    def predict_on_obs_batch(self, obs_batch):
 
-        feed_dict = {self.scaled_obs_input: scaled_obs_batch}
+        feed_dict = {self.obs_input: obs_batch}
         policy_prediction, value_prediction = self.sess.run([self.policy_out, self.value_out], feed_dict=feed_dict)
         return policy_prediction, value_prediction
 
-    def predict_on_single_obs(self, scaled_obs):
-        return (result[0] for result in self.predict_on_obs_batch(np.expand_dims(scaled_obs, axis=0)))
+    def predict_on_single_obs(self, obs):
+        return (result[0] for result in self.predict_on_obs_batch(np.expand_dims(obs, axis=0)))
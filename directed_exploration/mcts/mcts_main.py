@@ -3,6 +3,8 @@ from directed_exploration.mcts.mcts_cnn import MCTS_CNN
 from directed_exploration.utils.AsyncAtariSubprocVecEnv import AsyncAtariSubprocEnv
 from directed_exploration.logging_ops import init_logging, get_logger
 from directed_exploration.utils.data_util import DotDict
+from directed_exploration.utils.cpu_topology import parse_cpu_list, pinned_env_fn, apply_cpu_layout, \
+    make_session_config, cpu_topology_report
 
 import os
 import datetime
@@ -30,10 +32,22 @@ args = DotDict({
     # 'load_folder_file': ('/dev/models/8x100x50','best.pth.tar'),
     'numItersForTrainExamplesHistory': 20,
 
+    # Checkpoint every iteration from a snapshot, writing it in the background.
+    'async_checkpoints': False,
+
+    # TensorFlow thread pool sizes (0 lets TensorFlow pick) and cpu lists like '0-15' to pin the main process and
+    # the env workers to (None leaves them unpinned). See cpu_topology.apply_cpu_layout.
+    'num_envs': 12,
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    'main_process_cpus': None,
+    'env_worker_cpus': None,
+    'cpus_per_env_worker': 0,
+
 })
 
 
-def make_async_atari_env(env_id, num_env, seed, monitor_dir, start_index=0):
+def make_async_atari_env(env_id, num_env, seed, monitor_dir, start_index=0, env_worker_cpus=None):
     def make_env(rank):  # pylint: disable=C0111
         def _thunk():
             # import gym
@@ -42,12 +56,14 @@ def make_async_atari_env(env_id, num_env, seed, monitor_dir, start_index=0):
             env = make_atari(env_id)
             env.seed(seed + rank)
             # env = Monitor(env, os.path.join(monitor_dir, str(rank)))
-            return wrap_deepmind(env, scale=True, frame_stack=False)
+            return wrap_deepmind(env, scale=False, frame_stack=False)
 
         return _thunk
 
     set_global_seeds(seed)
-    return AsyncAtariSubprocEnv([make_env(i + start_index) for i in range(num_env)])
+    return AsyncAtariSubprocEnv([pinned_env_fn(make_env(i + start_index),
+                                               None if env_worker_cpus is None else env_worker_cpus[i])
+                                 for i in range(num_env)])
 
 
 if __name__ == "__main__":
@@ -73,15 +89,24 @@ if __name__ == "__main__":
 
     logger.info("Working dir: {}".format(working_dir))
 
+    env_worker_cpus = apply_cpu_layout(main_cpus=parse_cpu_list(args.main_process_cpus),
+                                       env_cpus=parse_cpu_list(args.env_worker_cpus),
+                                       num_env_workers=args.num_envs,
+                                       cpus_per_env_worker=args.cpus_per_env_worker)
+    logger.info(cpu_topology_report(main_cpus=parse_cpu_list(args.main_process_cpus),
+                                    env_worker_cpus=env_worker_cpus,
+                                    intra_op_threads=args.intra_op_threads,
+                                    inter_op_threads=args.inter_op_threads))
+
     subproc_env_group = make_async_atari_env(
         env_id="PongNoFrameskip-v4",
-        num_env=12,
+        num_env=args.num_envs,
         seed=42,
-        monitor_dir=monitor_dir
+        monitor_dir=monitor_dir,
+        env_worker_cpus=env_worker_cpus
     )
 
-    config = tf.ConfigProto(allow_soft_placement=True)
-    config.gpu_options.allow_growth = True
+    config = make_session_config(intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
     sess = tf.Session(config=config)
 
     summary_writer = tf.summary.FileWriter(working_dir)
@@ -94,6 +119,9 @@ if __name__ == "__main__":
         summary_writer=summary_writer
     )
 
+    if args.async_checkpoints:
+        nnet.set_async_checkpointing()
+
     # if args.load_model:
     #     nnet.load_checkpoint(args.load_folder_file[0], args.load_folder_file[1])
 
@@ -102,4 +130,5 @@ if __name__ == "__main__":
     #     print("Load trainExamples from file")
     #     c.loadTrainExamples()
     c.learn()
+    nnet.wait_for_pending_save()
     subproc_env_group.close()
@@ -1,11 +1,18 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from directed_exploration.utils.async_checkpoint import AsyncCheckpointWriter
 import tensorflow as tf
 import datetime
+import time
 import os
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Saves are written one at a time, so the handles of older ones are only kept to report their errors.
+MAX_PENDING_CHECKPOINT_HANDLES = 5
+
 def variable_summaries(var):
   """Attach a lot of summaries to a Tensor (for TensorBoard visualization)."""
   with tf.name_scope('summaries'):
@@ -46,6 +53,18 @@ class Model(ABC):
 
         self.identifier = os.path.basename(os.path.normpath(self.save_file_path))
 
+        # Train steps only fetch and write merged summaries when this schedule is due. See set_summary_schedule.
+        self.summary_every_n_steps = 1
+        self.summary_every_n_seconds = None
+        self._train_steps_since_summary = 0
+        self._last_summary_time = None
+
+        # Set by set_async_checkpointing. _pending_checkpoints maps the paths of the latest async saves to their
+        # PendingCheckpoint handles, for wait_for_checkpoint on other threads.
+        self.async_checkpoint_writer = None
+        self._pending_checkpoints = OrderedDict()
+        self._pending_checkpoints_lock = threading.Lock()
+
         if summary_writer is not None:
             self.writer = summary_writer
         else:
@@ -60,14 +79,118 @@ class Model(ABC):
         if restore_from_dir:
             self._restore_model(restore_from_dir)
 
+    def set_summary_schedule(self, every_n_steps=1, every_n_seconds=None):
+        """Write train summaries once every_n_steps train steps or every_n_seconds seconds have passed since they
+        were last written, whichever comes first. Either can be None. Summaries are always written on the first step.
+        """
+        self.summary_every_n_steps = every_n_steps
+        self.summary_every_n_seconds = every_n_seconds
+
+    def summaries_due_this_step(self):
+        """Counts a train step and returns whether it should write summaries (then call summaries_written)."""
+        self._train_steps_since_summary += 1
+
+        if self._last_summary_time is None:
+            return True
+        if self.summary_every_n_steps is not None and self._train_steps_since_summary >= self.summary_every_n_steps:
+            return True
+        if self.summary_every_n_seconds is not None and \
+                time.monotonic() - self._last_summary_time >= self.summary_every_n_seconds:
+            return True
+        return False
+
+    def summaries_written(self):
+        self._train_steps_since_summary = 0
+        self._last_summary_time = time.monotonic()
+
+    def _run_train_step(self, fetches, feed_dict):
+        """Runs fetches in one session run, also fetching and writing the merged summaries when they are due.
+
+        Returns:
+            list of the fetched values of fetches
+        """
+        write_summaries = self.summaries_due_this_step()
+
+        run_fetches = list(fetches) + [self.local_step]
+        if write_summaries:
+            run_fetches.append(self.tf_summaries_merged)
+
+        results = self.sess.run(run_fetches, feed_dict=feed_dict)
+
+        if write_summaries:
+            self.writer.add_summary(results[-1], results[len(fetches)])
+            self.summaries_written()
+
+        return results[:len(fetches)]
+
+    def _make_saver(self, var_list):
+        self.saved_variables = var_list
+        return tf.train.Saver(var_list=var_list,
+                              max_to_keep=5,
+                              keep_checkpoint_every_n_hours=1)
+
+    def set_async_checkpointing(self, enabled=True):
+        """With async checkpointing, save_model only snapshots the variables and they are written in the background.
+
+        The returned checkpoint path can only be restored after wait_for_checkpoint (or wait_for_pending_save on the
+        saving thread).
+        """
+        if not enabled:
+            self.wait_for_pending_save()
+            self.async_checkpoint_writer = None
+        elif self.async_checkpoint_writer is None:
+            self.async_checkpoint_writer = AsyncCheckpointWriter(self.saved_variables, name=self.save_prefix)
+
+    def wait_for_pending_save(self):
+        """Waits for the latest save. Only for the thread that calls save_model, see wait_for_checkpoint."""
+        if self.async_checkpoint_writer is not None:
+            self.async_checkpoint_writer.wait()
+
+    def wait_for_checkpoint(self, checkpoint_path):
+        """Blocks until the checkpoint save_model returned as checkpoint_path is on disk. Raises if writing it failed.
+
+        Safe to call from any thread.
+        """
+        with self._pending_checkpoints_lock:
+            pending = self._pending_checkpoints.get(checkpoint_path)
+
+        # Checkpoints saved synchronously, or before the latest few async saves, are already complete.
+        if pending is not None:
+            pending.wait()
+
     def _restore_model(self, from_dir):
         logger.info("Restoring {} model from {}".format(self.save_prefix, from_dir))
         self.saver.restore(self.sess, tf.train.latest_checkpoint(from_dir))
 
+    def restore_checkpoint(self, checkpoint_path):
+        logger.info("Restoring {} model from checkpoint {}".format(self.save_prefix, checkpoint_path))
+        self.saver.restore(self.sess, checkpoint_path)
+
     def save_model(self):
         if not os.path.exists(self.save_file_path):
             os.makedirs(self.save_file_path, exist_ok=True)
 
+        if self.async_checkpoint_writer is not None:
+            pending = self.async_checkpoint_writer.save(sess=self.sess,
+                                                        save_path=os.path.join(self.save_file_path,
+                                                                               self.save_prefix),
+                                                        global_step=self.local_step)
+            save_path = pending.checkpoint_path
+
+            with self._pending_checkpoints_lock:
+                self._pending_checkpoints[save_path] = pending
+                while len(self._pending_checkpoints) > MAX_PENDING_CHECKPOINT_HANDLES:
+                    self._pending_checkpoints.popitem(last=False)
+            if self.save_metagraph:
+                self.saver.export_meta_graph(save_path + '.meta')
+
+            self.save_metagraph = False
+
+            logger.info("{} model snapshot for {} taken in {:.3f}s, writing in the background".format(
+                self.save_prefix, save_path, self.async_checkpoint_writer.last_snapshot_seconds))
+
+            return save_path
+
         save_path = self.saver.save(sess=self.sess,
                                     save_path=os.path.join(self.save_file_path, self.save_prefix),
                                     write_meta_graph=self.save_metagraph,
@@ -77,6 +200,8 @@ class Model(ABC):
 
         logger.info("{} model saved in path: {}".format(self.save_prefix, save_path))
 
+        return save_path
+
     def __del__(self):
         logger.info("del called")
         if self.writer:
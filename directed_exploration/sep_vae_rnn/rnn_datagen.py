@@ -9,6 +9,7 @@ import re
 import itertools
 from functools import reduce
 from directed_exploration.sep_vae_rnn.vae import VAE
+from directed_exploration.utils.frame_records import decode_frame_features
 import gym
 import random
 
@@ -36,10 +37,6 @@ def get_numbered_tfrecord_file_names_from_directory(dir, prefix):
     return list(map(lambda f: os.path.join(dir, f), dir_files))
 
 
-def decode_pickled_np_array(bytes):
-    return pickle.loads(bytes).astype(np.float32)
-
-
 def debug_imshow_image_with_action(frame, action, wait_time=30, window_label='frame'):
     font = cv2.FONT_HERSHEY_SIMPLEX
     location = (0, 10)
@@ -71,7 +68,7 @@ def write_vae_episode_to_rnn_tf_record(vae_read_file_name, vae, rnn_data_write_d
     while not all_of_file_read:
 
         # If a generated sequence is less than max_sequence_length, the rest of it will be zeros.
-        raw_frame_sequence = np.zeros(shape=(max_sequence_length,) + FRAME_DIMS, dtype=np.float32)
+        raw_frame_sequence = np.zeros(shape=(max_sequence_length,) + FRAME_DIMS, dtype=np.uint8)
         action_sequence = np.zeros(shape=(max_sequence_length, ACTION_LENGTH), dtype=np.float32)
         # encoded_sequence = np.zeros(shape=(max_sequence_length, vae.latent_dim + ACTION_LENGTH), dtype=np.float32)
 
@@ -87,7 +84,7 @@ def write_vae_episode_to_rnn_tf_record(vae_read_file_name, vae, rnn_data_write_d
             example.ParseFromString(serialized_example)
 
             action = example.features.feature['action_at_frame'].float_list.value[:]
-            raw_frame = decode_pickled_np_array(example.features.feature['frame_bytes'].bytes_list.value[0])
+            raw_frame = decode_frame_features(example.features.feature)
 
             raw_frame_sequence[sequence_index] = raw_frame
             action_sequence[sequence_index] = action
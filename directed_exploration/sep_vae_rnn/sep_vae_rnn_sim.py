@@ -1,20 +1,28 @@
-from directed_exploration.sep_vae_rnn.vae import VAE
+from directed_exploration.sep_vae_rnn.vae import VAE, per_frame_reconstruction_loss
 from directed_exploration.sep_vae_rnn.state_rnn import StateRNN
-from directed_exploration.validation import validate_vae_state_rnn_pair_on_tf_records
+from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.validation import validate_vae_state_rnn_pair_on_tf_records, get_validation_pipeline
 
+import os
 import numpy as np
+import tensorflow as tf
 
 
 class SeparateVaeRnnSim:
     def __init__(self, latent_dim=4, action_dim=5, working_dir=None, sess=None, graph=None,
-                 summary_writer=None):
+                 summary_writer=None, lstm_backend='scan', stateful_inference=False, joint_training=True):
+
+        # With stateful_inference, per-env rnn states for the predict methods stay in the graph. t_states must be
+        # None and None is returned in place of t_plus_1_states.
+        self.stateful_inference = stateful_inference
 
         self.state_rnn = StateRNN(latent_dim,
                                   action_dim,
                                   working_dir,
                                   sess,
                                   graph,
-                                  summary_writer)
+                                  summary_writer,
+                                  lstm_backend)
 
         self.vae = VAE(latent_dim,
                        working_dir,
@@ -22,47 +30,200 @@ class SeparateVaeRnnSim:
                        graph,
                        summary_writer)
 
+        self._pending_code_predictions = None
+
+        # With joint_training, train_on_batch updates the VAE and the StateRNN in one session run.
+        self.joint_training = joint_training
+
+        self._build_fused_inference_graph()
+        if self.joint_training:
+            self._build_joint_train_graph()
+
+    def _build_fused_inference_graph(self):
+        # VAE encoder -> StateRNN step -> VAE decoder and loss wired together in the shared graph, so that each
+        # prediction step is one session run and latent codes are never copied to the host in between.
+        with self.vae.graph.as_default(), tf.name_scope('SEP_VAE_RNN_FUSED_STEP'):
+            self.step_frame_inputs = tf.placeholder(tf.uint8, shape=self.vae.x.shape, name='step_frame_inputs')
+            self.step_action_inputs = tf.placeholder(tf.float32, shape=[None, self.state_rnn.action_dim],
+                                                     name='step_action_inputs')
+            self.step_frame_targets = tf.placeholder(tf.uint8, shape=self.vae.x.shape, name='step_frame_targets')
+            self.step_state_reset_before_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                          name='step_states_mask')
+            self.step_valid_prediction_mask = tf.placeholder(tf.float32, [None], name='step_valid_prediction_mask')
+
+            states_size = self.state_rnn.step_states_in.shape[1].value
+            step_zero_states = tf.zeros(shape=[tf.shape(self.step_action_inputs)[0], states_size], dtype=tf.float32)
+            self.step_states_in = tf.placeholder_with_default(step_zero_states, shape=[None, states_size])
+
+            z_codes = self.vae.build_encoder(self.step_frame_inputs)
+            rnn_inputs = tf.concat(values=(z_codes, self.step_action_inputs), axis=1)
+            scaled_step_frame_targets = tf.cast(self.step_frame_targets, tf.float32) / 255.0
+
+            # In stateful mode states_out is the op that advances the StateRNN's resident states, so fetching it
+            # returns None.
+            self._fused_step_fetches = {}
+            for stateful, states_in in [(False, self.step_states_in), (True, self.state_rnn.resident_states)]:
+                code_predictions, states_out = self.state_rnn.build_single_step_forward(
+                    rnn_inputs, self.step_state_reset_before_prediction_mask, states_in)
+
+                if stateful:
+                    states_out = tf.assign(self.state_rnn.resident_states, states_out, validate_shape=False).op
+
+                decoded = self.vae.build_decoder(code_predictions)
+                losses = per_frame_reconstruction_loss(scaled_step_frame_targets, decoded) * \
+                         self.step_valid_prediction_mask
+
+                self._fused_step_fetches[stateful] = {'code_predictions': code_predictions,
+                                                      'states_out': states_out,
+                                                      'decoded': decoded,
+                                                      'losses': losses}
+
+    def _build_joint_train_graph(self):
+        # The StateRNN is trained on the codes the VAE's training forward pass samples in the same run. The stop
+        # gradient keeps the codes constant to the rnn loss, as they were when they were fetched and fed back in.
+        with self.vae.graph.as_default(), tf.name_scope('SEP_VAE_RNN_JOINT_TRAIN'):
+            self.joint_action_inputs = tf.placeholder(tf.float32, shape=[None, None, self.state_rnn.action_dim],
+                                                      name='action_inputs')
+            self.joint_states_mask = tf.placeholder(tf.float32, shape=[None, None], name='states_mask')
+
+            batch_size = tf.shape(self.joint_states_mask)[0]
+            states_size = self.state_rnn.states_in.shape[1].value
+            zero_states = tf.zeros(shape=[batch_size, states_size], dtype=tf.float32)
+            self.joint_states_in = tf.placeholder_with_default(zero_states, shape=[None, states_size])
+
+            codes = tf.reshape(tf.stop_gradient(self.vae.z_encoded),
+                               shape=[batch_size, tf.shape(self.joint_states_mask)[1], self.state_rnn.latent_dim])
+
+            self.joint_rnn_loss, self.joint_rnn_sequence_losses, self.joint_rnn_states_out = \
+                self.state_rnn.build_sequence_loss(
+                    sequence_inputs=tf.concat(values=(codes[:, :-1], self.joint_action_inputs), axis=2),
+                    sequence_targets=codes[:, 1:],
+                    states_mask_sequence=self.joint_states_mask,
+                    states_in=self.joint_states_in)
+
+            # Shares the StateRNN optimizer's slots with its own train op.
+            rnn_train_op = self.state_rnn.optimizer.minimize(
+                self.joint_rnn_loss,
+                global_step=self.state_rnn.local_step,
+                var_list=tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.state_rnn.variable_scope.name))
+
+            self.joint_train_op = tf.group(self.vae.train_op, rnn_train_op)
+
+    def _get_fused_step_feed_dict(self, t_obs, t_actions, t_dones, t_states=None):
+        assert not (self.stateful_inference and t_states is not None)
+
+        batch_size = len(t_obs)
+
+        actions = convertToOneHot(np.asarray(t_actions), num_classes=self.state_rnn.action_dim)
+
+        feed_dict = {self.step_frame_inputs: t_obs,
+                     self.step_action_inputs: np.reshape(actions, newshape=(batch_size, self.state_rnn.action_dim)),
+                     self.step_state_reset_before_prediction_mask: np.reshape(1 - np.asarray(t_dones),
+                                                                              newshape=(batch_size,))}
+
+        if t_states is not None:
+            feed_dict[self.step_states_in] = t_states
+
+        return feed_dict
+
     def save_model(self):
-        self.vae.save_model()
-        self.state_rnn.save_model()
+        return self.vae.save_model(), self.state_rnn.save_model()
+
+    def restore_model(self, checkpoint_path):
+        vae_checkpoint_path, state_rnn_checkpoint_path = checkpoint_path
+        self.vae.restore_checkpoint(vae_checkpoint_path)
+        self.state_rnn.restore_checkpoint(state_rnn_checkpoint_path)
+
+    def set_async_checkpointing(self, enabled=True):
+        self.vae.set_async_checkpointing(enabled)
+        self.state_rnn.set_async_checkpointing(enabled)
+
+    def wait_for_pending_saves(self):
+        self.vae.wait_for_pending_save()
+        self.state_rnn.wait_for_pending_save()
+
+    def wait_for_checkpoint(self, checkpoint_path):
+        vae_checkpoint_path, state_rnn_checkpoint_path = checkpoint_path
+        self.vae.wait_for_checkpoint(vae_checkpoint_path)
+        self.state_rnn.wait_for_checkpoint(state_rnn_checkpoint_path)
 
     def get_current_step(self):
         return self.vae.sess.run([self.vae.local_step])[0]
 
-    def predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, actual_t_plus_one_obs=None, return_t_plus_one_predictions=True):
+    def set_summary_schedule(self, every_n_steps=1, every_n_seconds=None):
+        self.vae.set_summary_schedule(every_n_steps, every_n_seconds)
+        self.state_rnn.set_summary_schedule(every_n_steps, every_n_seconds)
+
+    def predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, actual_t_plus_one_obs=None, t_plus_1_dones=None, return_t_plus_one_predictions=True):
 
-        encoded_current_obs = self.vae.encode_frames(t_obs)
-        t_plus_1_code_predictions, t_plus_1_states = self.state_rnn.predict_on_frame_batch(z_codes=encoded_current_obs,
-                                                                                           actions=t_actions,
-                                                                                           states_mask=1 - np.asarray(t_dones),
-                                                                                           states_in=t_states)
+        feed_dict = self._get_fused_step_feed_dict(t_obs, t_actions, t_dones, t_states)
+        fetches = self._fused_step_fetches[self.stateful_inference]
 
         tensors_to_evaluate = []
-        feed_dict = {self.vae.z_encoded: t_plus_1_code_predictions, self.vae.x: actual_t_plus_one_obs}
 
         if return_t_plus_one_predictions:
-            tensors_to_evaluate.append(self.vae.decoded)
+            tensors_to_evaluate.append(fetches['decoded'])
 
         if actual_t_plus_one_obs is not None:
-            tensors_to_evaluate.append(self.vae.per_frame_reconstruction_loss)
+            valid_prediction_mask = np.ones(len(t_obs))
+            if t_plus_1_dones is not None:
+                valid_prediction_mask = 1 - np.asarray(t_plus_1_dones)
 
-        return_vals = self.vae.sess.run(tensors_to_evaluate, feed_dict)
+            feed_dict[self.step_frame_targets] = actual_t_plus_one_obs
+            feed_dict[self.step_valid_prediction_mask] = valid_prediction_mask
+            tensors_to_evaluate.append(fetches['losses'])
 
-        return_vals.append(t_plus_1_states)
+        tensors_to_evaluate.append(fetches['states_out'])
 
-        return return_vals
+        return self.vae.sess.run(tensors_to_evaluate, feed_dict)
 
-    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch):
+    def predict_losses_on_batch(self, t_obs, t_actions, t_dones, actual_t_plus_one_obs, t_plus_1_dones, t_states=None):
 
-        assert len(obs_sequence_batch) == len(action_sequence_batch) + 1
-        assert len(obs_sequence_batch) == len(dones_sequence_batch)
+        feed_dict = self._get_fused_step_feed_dict(t_obs, t_actions, t_dones, t_states)
+        feed_dict[self.step_frame_targets] = actual_t_plus_one_obs
+        feed_dict[self.step_valid_prediction_mask] = 1 - np.asarray(t_plus_1_dones)
+        fetches = self._fused_step_fetches[self.stateful_inference]
 
-        obs_sequence_batch = np.asarray(obs_sequence_batch).swapaxes(1, 0)
-        action_sequence_batch = np.asarray(action_sequence_batch).swapaxes(1, 0)
-        dones_sequence_batch = np.asarray(dones_sequence_batch).swapaxes(1, 0)
+        losses, t_plus_1_states = self.vae.sess.run([fetches['losses'], fetches['states_out']], feed_dict)
 
-        assert obs_sequence_batch.shape[0] == action_sequence_batch.shape[0]
-        assert obs_sequence_batch.shape[0] == dones_sequence_batch.shape[0]
+        return losses, t_plus_1_states
+
+    def begin_predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, return_t_plus_one_predictions=False):
+
+        feed_dict = self._get_fused_step_feed_dict(t_obs, t_actions, t_dones, t_states)
+        fetches = self._fused_step_fetches[self.stateful_inference]
+
+        tensors_to_evaluate = [fetches['code_predictions'], fetches['states_out']]
+        if return_t_plus_one_predictions:
+            tensors_to_evaluate.append(fetches['decoded'])
+
+        # Predicted codes are tiny, so they are kept on the host until the actual observations arrive.
+        self._pending_code_predictions, t_plus_1_states, *t_plus_1_predictions = self.vae.sess.run(
+            tensors_to_evaluate, feed_dict)
+
+        return t_plus_1_predictions + [t_plus_1_states]
+
+    def finish_predict_on_batch(self, env_indexes, actual_t_plus_one_obs, t_plus_1_dones):
+
+        losses = self.vae.get_loss_for_decoded_frames(z_codes=self._pending_code_predictions[env_indexes],
+                                                      target_frames=actual_t_plus_one_obs)
+
+        return losses * (1 - np.asarray(t_plus_1_dones))
+
+    def reset_states(self, num_envs):
+        self.state_rnn.reset_resident_states(num_envs)
+
+    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch,
+                       return_sequence_losses=False):
+        # The sequence losses are the StateRNN's code prediction losses. The VAE's loss is per frame and on another
+        # scale, so it isn't mixed in.
+
+        assert obs_sequence_batch.shape[1] == action_sequence_batch.shape[1] + 1
+        assert obs_sequence_batch.shape[:2] == dones_sequence_batch.shape
+
+        if self.joint_training:
+            return self._joint_train_on_batch(obs_sequence_batch, action_sequence_batch, dones_sequence_batch,
+                                              initial_states_batch, return_sequence_losses)
 
         mask = 1 - dones_sequence_batch
 
@@ -77,18 +238,71 @@ class SeparateVaeRnnSim:
 
         encoded_obs = np.reshape(encoded_obs, newshape=[mb_obs_shape[0], mb_obs_shape[1], self.state_rnn.latent_dim])
 
-        rnn_loss, states_out, rnn_step = self.state_rnn.train_on_batch(
+        vals = self.state_rnn.train_on_batch(
             input_code_sequence_batch=encoded_obs[:, :-1],
             target_code_sequence_batch=encoded_obs[:, 1:],
             states_mask_sequence_batch=mask,
             input_action_sequence_batch=action_sequence_batch,
-            states_batch=initial_states_batch)
+            states_batch=initial_states_batch,
+            return_sequence_losses=return_sequence_losses)
+        rnn_loss, states_out, rnn_step = vals[:3]
+
+        if return_sequence_losses:
+            return vae_step, {'rnn loss': rnn_loss, 'vae loss': vae_loss}, states_out, vals[3]
+        return vae_step, {'rnn loss': rnn_loss, 'vae loss': vae_loss}, states_out
+
+    def _joint_train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch,
+                              initial_states_batch, return_sequence_losses=False):
+
+        mb_obs_shape = obs_sequence_batch.shape
+
+        feed_dict = {
+            self.vae.x: np.reshape(obs_sequence_batch, newshape=[mb_obs_shape[0] * mb_obs_shape[1],
+                                                                 *mb_obs_shape[2:]]),
+            self.joint_action_inputs: action_sequence_batch,
+            self.joint_states_mask: 1 - dones_sequence_batch
+        }
+
+        if initial_states_batch is not None:
+            feed_dict[self.joint_states_in] = initial_states_batch
+
+        # Both models' summaries follow the VAE's summary schedule.
+        write_summaries = self.vae.summaries_due_this_step()
 
+        fetches = [self.joint_train_op,
+                   self.vae.loss,
+                   self.joint_rnn_loss,
+                   self.joint_rnn_states_out,
+                   self.vae.local_step,
+                   self.state_rnn.local_step]
+        if return_sequence_losses:
+            fetches.append(self.joint_rnn_sequence_losses)
+        if write_summaries:
+            fetches.append(self.vae.tf_summaries_merged)
+
+        vals = self.vae.sess.run(fetches, feed_dict=feed_dict)
+        _, vae_loss, rnn_loss, states_out, vae_step, rnn_step = vals[:6]
+
+        if write_summaries:
+            self.vae.writer.add_summary(vals[-1], vae_step)
+
+            # Same series as the StateRNN's own mse_loss summary.
+            rnn_summary = tf.Summary()
+            rnn_summary.value.add(tag=self.state_rnn.mse_loss_summary_tag, simple_value=rnn_loss)
+            self.state_rnn.writer.add_summary(rnn_summary, rnn_step)
+
+            self.vae.summaries_written()
+
+        if return_sequence_losses:
+            return vae_step, {'rnn loss': rnn_loss, 'vae loss': vae_loss}, states_out, vals[6]
         return vae_step, {'rnn loss': rnn_loss, 'vae loss': vae_loss}, states_out
 
+    def prepare_validation(self, allowed_action_space):
+        get_validation_pipeline(self.vae.sess, allowed_action_space)
+
     def validate(self, validation_data_dir, allowed_action_space=None):
 
-        avg_val_loss = validate_vae_state_rnn_pair_on_tf_records(
+        avg_val_loss, file_val_losses = validate_vae_state_rnn_pair_on_tf_records(
             data_dir=validation_data_dir,
             vae=self.vae,
             state_rnn=self.state_rnn,
@@ -96,4 +310,8 @@ class SeparateVaeRnnSim:
             allowed_action_space=allowed_action_space
         )
 
-        return {'avg_val_loss': avg_val_loss}
\ No newline at end of file
+        val_losses = {'avg_val_loss': avg_val_loss}
+        for file_name, file_val_loss in file_val_losses.items():
+            val_losses['val_loss/{}'.format(os.path.splitext(os.path.basename(file_name))[0])] = file_val_loss
+
+        return val_losses
\ No newline at end of file
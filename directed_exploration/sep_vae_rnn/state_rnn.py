@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 from directed_exploration.model import Model
 from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.utils.tf_util import block_fused_lstm, LSTM_BACKENDS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,8 +27,51 @@ def ortho_init(scale=1.0):
     return _ortho_init
 
 
+def lstm_variables(nin, scope, num_hidden, init_scale=1.0):
+    with tf.variable_scope(scope):
+        wx = tf.get_variable("wx", [nin, num_hidden * 4], initializer=ortho_init(init_scale))
+        wh = tf.get_variable("wh", [num_hidden, num_hidden * 4], initializer=ortho_init(init_scale))
+        b = tf.get_variable("b", [num_hidden * 4], initializer=tf.constant_initializer(0.0))
+    return wx, wh, b
+
+
+def lstm_step(c, h, batch_inputs, batch_mask, wx, wh, b):
+    c = c * batch_mask
+    h = h * batch_mask
+    z = tf.matmul(batch_inputs, wx) + tf.matmul(h, wh) + b
+    i, f, o, u = tf.split(axis=1, num_or_size_splits=4, value=z)
+    i = tf.nn.sigmoid(i)
+    f = tf.nn.sigmoid(f)
+    o = tf.nn.sigmoid(o)
+    u = tf.tanh(u)
+    c = f * c + i * u
+    h = o * tf.tanh(c)
+    return c, h
+
+
+def single_step_lstm(input_batch, retain_state_mask_batch, initial_states_batch, scope, num_hidden, init_scale=1.0):
+    """One step of dynamic_lstm (same variables) without the scan and transposes.
+
+    Args:
+        input_batch: [batch, nin]
+        retain_state_mask_batch: [batch]
+        initial_states_batch: [batch, num_hidden * 2]
+
+    Returns:
+        (h [batch, num_hidden], states [batch, num_hidden * 2])
+    """
+    nin = input_batch.get_shape()[1].value
+    wx, wh, b = lstm_variables(nin, scope, num_hidden, init_scale)
+    c, h = tf.split(axis=1, num_or_size_splits=2, value=initial_states_batch)
+
+    c, h = lstm_step(c, h, input_batch, tf.expand_dims(retain_state_mask_batch, axis=1), wx, wh, b)
+
+    return h, tf.concat(axis=1, values=(c, h))
+
+
 def dynamic_lstm(input_sequence_batch, retain_state_mask_sequence_batch, initial_states_batch,
-                 scope, num_hidden, init_scale=1.0):
+                 scope, num_hidden, init_scale=1.0, backend='scan'):
+    assert backend in LSTM_BACKENDS
 
     input_sequence_batch = tf.transpose(input_sequence_batch, [1, 0, 2], name='trasnpose_xs')
     retain_state_mask_sequence_batch = tf.expand_dims(
@@ -36,28 +80,22 @@ def dynamic_lstm(input_sequence_batch, retain_state_mask_sequence_batch, initial
     )
 
     nbatch, nin = [v.value for v in input_sequence_batch[0].get_shape()]
-    with tf.variable_scope(scope):
-        wx = tf.get_variable("wx", [nin, num_hidden * 4], initializer=ortho_init(init_scale))
-        wh = tf.get_variable("wh", [num_hidden, num_hidden * 4], initializer=ortho_init(init_scale))
-        b = tf.get_variable("b", [num_hidden * 4], initializer=tf.constant_initializer(0.0))
+    wx, wh, b = lstm_variables(nin, scope, num_hidden, init_scale)
     c, h = tf.split(axis=1, num_or_size_splits=2, value=initial_states_batch)
 
     def _dynamic_lstm_step(state_accumulator, inputs_elem):
         c, h = state_accumulator
         batch_inputs, batch_mask = inputs_elem
-        c = c * batch_mask
-        h = h * batch_mask
-        z = tf.matmul(batch_inputs, wx) + tf.matmul(h, wh) + b
-        i, f, o, u = tf.split(axis=1, num_or_size_splits=4, value=z)
-        i = tf.nn.sigmoid(i)
-        f = tf.nn.sigmoid(f)
-        o = tf.nn.sigmoid(o)
-        u = tf.tanh(u)
-        c = f * c + i * u
-        h = o * tf.tanh(c)
-        return c, h
-
-    states = tf.scan(fn=_dynamic_lstm_step, elems=(input_sequence_batch, retain_state_mask_sequence_batch), initializer=(c, h), back_prop=True)
+        return lstm_step(c, h, batch_inputs, batch_mask, wx, wh, b)
+
+    def _scan_lstm():
+        return tf.scan(fn=_dynamic_lstm_step, elems=(input_sequence_batch, retain_state_mask_sequence_batch), initializer=(c, h), back_prop=True)
+
+    if backend == 'block_fused':
+        states = block_fused_lstm(input_sequence_batch, retain_state_mask_sequence_batch, c, h, wx, wh, b,
+                                  scan_fallback_fn=_scan_lstm)
+    else:
+        states = _scan_lstm()
     sequence_batches_out = tf.transpose(states[1], [1, 0, 2])
     state_batch_out = tf.concat(axis=1, values=(states[0][-1], states[1][-1]))
 
@@ -81,47 +119,81 @@ def mask_non_zero_counts(mask):
         return length
 
 
-def RNN_forward(sequence_inputs, batch_size, state_reset_before_prediction_mask, lstm_size, states_in, latent_dim, variable_scope, reuse=False):
+def RNN_forward(sequence_inputs, batch_size, state_reset_before_prediction_mask, lstm_size, states_in, latent_dim, variable_scope, reuse=False, lstm_backend='scan', single_step=False):
+    """Builds the code prediction network.
+
+    By default inputs are [batch, time, ...] sequences. With single_step, inputs have no time dimension
+    ([batch, ...]) and one LSTM step is built without the scan, for one step at a time inference.
+    Both versions create (or with reuse, share) the same variables.
+    """
     with tf.variable_scope(variable_scope, reuse=reuse):
         variance_scaling = tf.contrib.layers.variance_scaling_initializer()
         xavier = tf.contrib.layers.xavier_initializer()
 
-        runtime_sequence_length = tf.shape(sequence_inputs)[1]
+        if single_step:
+            lstm_output_for_dense, states_out = single_step_lstm(input_batch=sequence_inputs,
+                                                                 retain_state_mask_batch=state_reset_before_prediction_mask,
+                                                                 initial_states_batch=states_in,
+                                                                 num_hidden=lstm_size,
+                                                                 scope='lstm1')
+        else:
+            runtime_sequence_length = tf.shape(sequence_inputs)[1]
 
-        lstm_output, states_out = dynamic_lstm(input_sequence_batch=sequence_inputs,
-                                               retain_state_mask_sequence_batch=state_reset_before_prediction_mask,
-                                               initial_states_batch=states_in,
-                                               num_hidden=lstm_size,
-                                               scope='lstm1')
+            lstm_output, states_out = dynamic_lstm(input_sequence_batch=sequence_inputs,
+                                                   retain_state_mask_sequence_batch=state_reset_before_prediction_mask,
+                                                   initial_states_batch=states_in,
+                                                   num_hidden=lstm_size,
+                                                   scope='lstm1',
+                                                   backend=lstm_backend)
 
-        lstm_output_for_dense = tf.reshape(lstm_output, shape=[batch_size*runtime_sequence_length, lstm_size])
+            lstm_output_for_dense = tf.reshape(lstm_output, shape=[batch_size*runtime_sequence_length, lstm_size])
 
+        # Explicitly named (with the names they were originally given automatically) so that the layers can be
+        # reused by the single step graph.
         dense1 = tf.layers.dense(inputs=lstm_output_for_dense,
                                  units=256,
                                  activation=tf.nn.relu,
-                                 kernel_initializer=variance_scaling)
+                                 kernel_initializer=variance_scaling,
+                                 name='dense')
 
         dense2 = tf.layers.dense(inputs=dense1,
                                  units=128,
                                  activation=tf.nn.relu,
-                                 kernel_initializer=variance_scaling)
+                                 kernel_initializer=variance_scaling,
+                                 name='dense_1')
 
         dense3 = tf.layers.dense(inputs=dense2,
                                  units=latent_dim,
                                  activation=None,
-                                 kernel_initializer=xavier)
+                                 kernel_initializer=xavier,
+                                 name='dense_2')
+
+        if single_step:
+            return dense3, states_out
 
         out = tf.reshape(dense3, shape=[batch_size, runtime_sequence_length, latent_dim])
 
         return out, states_out
 
 
+def sequence_mse_losses(output, sequence_targets, valid_example_mask):
+    """Each sequence's mean squared code error over its valid (not done) steps, shape [batch]."""
+    valid_example_counts = mask_non_zero_counts(valid_example_mask)
+
+    frame_squared_errors = tf.square(output - sequence_targets)
+    frame_mean_squared_errors = tf.reduce_mean(frame_squared_errors, axis=2)
+    masked_frame_mean_squared_erros = frame_mean_squared_errors * valid_example_mask
+    return tf.reduce_sum(masked_frame_mean_squared_erros, 1) / valid_example_counts
+
+
 class StateRNN(Model):
-    def __init__(self, latent_dim=4, action_dim=5, working_dir=None, sess=None, graph=None, summary_writer=None):
+    def __init__(self, latent_dim=4, action_dim=5, working_dir=None, sess=None, graph=None, summary_writer=None,
+                 lstm_backend='scan'):
         logger.info("RNN latent dim {} action dim {}".format(latent_dim, action_dim))
 
         self.latent_dim = latent_dim
         self.action_dim = action_dim
+        self.lstm_backend = lstm_backend
         self.saved_state = None
 
         save_prefix = 'state_rnn_{}dim'.format(self.latent_dim)
@@ -132,7 +204,7 @@ class StateRNN(Model):
 
         with self.graph.as_default():
             rnn_scope = 'STATE_RNN_MODEL'
-            with tf.variable_scope(rnn_scope):
+            with tf.variable_scope(rnn_scope) as self.variable_scope:
 
                 self.sequence_inputs = tf.placeholder(tf.float32, shape=[None, None, self.latent_dim + self.action_dim],
                                                       name='z_and_action_inputs')
@@ -162,7 +234,8 @@ class StateRNN(Model):
                         states_in=self.states_in,
                         latent_dim=self.latent_dim,
                         variable_scope=rnn_forward_scope,
-                        reuse=False)
+                        reuse=False,
+                        lstm_backend=self.lstm_backend)
 
                 # with tf.control_dependencies([tf.assert_equal(self.output,self.output2), tf.assert_equal(self.states_out, self.states_out2)]):
                 #     self.output = tf.Print(self.output, [self.output])
@@ -175,16 +248,60 @@ class StateRNN(Model):
                     self.state_reset_between_input_and_target_mask = tf.placeholder(tf.float32,
                                                                                     [None, None])
 
-                    valid_example_mask = self.state_reset_between_input_and_target_mask
-                    valid_example_counts = mask_non_zero_counts(valid_example_mask)
-
-                    frame_squared_errors = tf.square(self.output - self.sequence_targets)
-                    frame_mean_squared_errors = tf.reduce_mean(frame_squared_errors, axis=2)
-                    masked_frame_mean_squared_erros = frame_mean_squared_errors * valid_example_mask
-                    mse_over_sequences = tf.reduce_sum(masked_frame_mean_squared_erros, 1) / valid_example_counts
-                    mse_over_batch = tf.reduce_mean(mse_over_sequences)
-                    self.mse_loss = mse_over_batch
-                    tf.summary.scalar('mse_loss', self.mse_loss)
+                    self.sequence_losses = sequence_mse_losses(self.output, self.sequence_targets,
+                                                               self.state_reset_between_input_and_target_mask)
+                    self.mse_loss = tf.reduce_mean(self.sequence_losses)
+                    mse_loss_summary = tf.summary.scalar('mse_loss', self.mse_loss)
+                    # For writing mse losses computed outside of this graph to the same series.
+                    self.mse_loss_summary_tag = mse_loss_summary.op.name
+
+                # Single step graph for one step at a time inference during rollouts.
+                # Shares all variables with the sequence graph above but has no scan, transposes or time reshapes.
+                with tf.name_scope('single_step'):
+                    self.step_inputs = tf.placeholder(tf.float32, shape=[None, self.latent_dim + self.action_dim],
+                                                      name='step_z_and_action_inputs')
+                    self.step_state_reset_before_prediction_mask = tf.placeholder(tf.float32, [None],
+                                                                                  name='step_states_mask')
+
+                    step_batch_size = tf.shape(self.step_inputs)[0]
+                    step_zero_states = tf.zeros(shape=[step_batch_size, lstm_size * 2], dtype=tf.float32)
+                    self.step_states_in = tf.placeholder_with_default(step_zero_states, shape=[None, lstm_size * 2])
+
+                    def single_step_forward(states_in):
+                        return RNN_forward(
+                            sequence_inputs=self.step_inputs,
+                            batch_size=step_batch_size,
+                            state_reset_before_prediction_mask=self.step_state_reset_before_prediction_mask,
+                            lstm_size=lstm_size,
+                            states_in=states_in,
+                            latent_dim=self.latent_dim,
+                            variable_scope=rnn_forward_scope,
+                            reuse=True,
+                            single_step=True)
+
+                    self.step_output, self.step_states_out = single_step_forward(self.step_states_in)
+
+                # Stateful version of the single step graph. Per-env states stay in a local (never checkpointed)
+                # variable instead of being fed in and fetched every step. Resets on done happen in the graph
+                # through the states mask, like in the stateless version.
+                with tf.name_scope('stateful_single_step'):
+                    self.resident_states = tf.Variable(
+                        initial_value=tf.zeros(shape=[0, lstm_size * 2], dtype=tf.float32),
+                        trainable=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        validate_shape=False,
+                        name='resident_states'
+                    )
+
+                    self.stateful_step_output, stateful_step_states_out = single_step_forward(self.resident_states)
+
+                    self.advance_resident_states = tf.assign(self.resident_states, stateful_step_states_out,
+                                                             validate_shape=False)
+
+                    self.resident_states_placeholder = tf.placeholder(tf.float32, shape=[None, lstm_size * 2],
+                                                                      name='resident_states_in')
+                    self.assign_resident_states = tf.assign(self.resident_states, self.resident_states_placeholder,
+                                                            validate_shape=False)
 
             rnn_ops_scope = 'STATE_RNN_OPS'
             with tf.variable_scope(rnn_ops_scope):
@@ -198,14 +315,14 @@ class StateRNN(Model):
                 var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_scope)
                 var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=rnn_ops_scope)
 
-                self.saver = tf.train.Saver(var_list=var_list,
-                                            max_to_keep=5,
-                                            keep_checkpoint_every_n_hours=1)
+                self.saver = self._make_saver(var_list)
 
             self.init = tf.variables_initializer(var_list=var_list, name='state_rnn_initializer')
 
             self.tvars = tf.trainable_variables()
 
+        self.sess.run(self.resident_states.initializer)
+
         if restore_from_dir:
             self._restore_model(restore_from_dir)
         else:
@@ -225,7 +342,7 @@ class StateRNN(Model):
         return dict
 
     def train_on_batch(self, input_code_sequence_batch, target_code_sequence_batch, states_mask_sequence_batch,
-                       input_action_sequence_batch, states_batch=None):
+                       input_action_sequence_batch, states_batch=None, return_sequence_losses=False):
 
         assert np.array_equal(input_code_sequence_batch.shape[:-1], target_code_sequence_batch.shape[:-1])
         assert np.array_equal(input_code_sequence_batch.shape[:-1], states_mask_sequence_batch[:, :-1].shape)
@@ -244,15 +361,15 @@ class StateRNN(Model):
             assert np.array_equal(input_code_sequence_batch.shape[0], states_batch.shape[0])
             feed_dict[self.states_in] = states_batch
 
-        _, loss, states_out, step, summaries = self.sess.run([self.train_op,
-                                                              self.mse_loss,
-                                                              self.states_out,
-                                                              self.local_step,
-                                                              self.tf_summaries_merged],
-                                                             feed_dict=feed_dict)
+        fetches = [self.train_op, self.mse_loss, self.states_out, self.local_step]
+        if return_sequence_losses:
+            fetches.append(self.sequence_losses)
 
-        self.writer.add_summary(summaries, step)
+        vals = self._run_train_step(fetches, feed_dict=feed_dict)
+        _, loss, states_out, step = vals[:4]
 
+        if return_sequence_losses:
+            return loss, states_out, step, vals[4]
         return loss, states_out, step
 
     # def train_on_input_fn(self, input_fn, steps=None):
@@ -365,7 +482,58 @@ class StateRNN(Model):
     #         np.multiply(cell.c, mask, out=cell.c)
     #         np.multiply(cell.h, mask, out=cell.h)
 
-    def predict_on_frames(self, z_codes, actions, states_mask, states_in=None):
+    def build_single_step_forward(self, step_inputs, step_state_reset_before_prediction_mask, states_in):
+        """Builds another single step of the rnn on the given tensors in this model's graph, sharing its variables.
+
+        Returns:
+            (code predictions, states_out)
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            return RNN_forward(sequence_inputs=step_inputs,
+                               batch_size=tf.shape(step_inputs)[0],
+                               state_reset_before_prediction_mask=step_state_reset_before_prediction_mask,
+                               lstm_size=self.step_states_in.shape[1].value // 2,
+                               states_in=states_in,
+                               latent_dim=self.latent_dim,
+                               variable_scope='rnn_forward',
+                               reuse=True,
+                               single_step=True)
+
+    def build_sequence_loss(self, sequence_inputs, sequence_targets, states_mask_sequence, states_in):
+        """Builds another sequence graph and its mse loss on the given tensors, sharing this model's variables.
+
+        states_mask_sequence is [batch, time + 1], like the states mask passed to train_on_batch.
+
+        Returns:
+            (mse loss, per sequence mse losses, states_out)
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            output, states_out = RNN_forward(sequence_inputs=sequence_inputs,
+                                             batch_size=tf.shape(sequence_inputs)[0],
+                                             state_reset_before_prediction_mask=states_mask_sequence[:, :-1],
+                                             lstm_size=self.step_states_in.shape[1].value // 2,
+                                             states_in=states_in,
+                                             latent_dim=self.latent_dim,
+                                             variable_scope='rnn_forward',
+                                             reuse=True,
+                                             lstm_backend=self.lstm_backend)
+
+            with tf.name_scope('mse_loss'):
+                sequence_losses = sequence_mse_losses(output, sequence_targets, states_mask_sequence[:, 1:])
+                loss = tf.reduce_mean(sequence_losses)
+
+        return loss, sequence_losses, states_out
+
+    def inference_signature(self):
+        inputs = {'step_inputs': self.step_inputs,
+                  'step_state_reset_before_prediction_mask': self.step_state_reset_before_prediction_mask,
+                  'step_states_in': self.step_states_in}
+        outputs = {'step_output': self.step_output, 'step_states_out': self.step_states_out}
+        return inputs, outputs
+
+    def predict_on_frames(self, z_codes, actions, states_mask, states_in=None, stateful=False):
+        """With stateful, states_in must be None, the resident states are used and advanced, and states_out is None."""
+        assert not (stateful and states_in is not None)
 
         actions = np.asarray(actions)
         states_mask = np.asarray(states_mask)
@@ -379,20 +547,57 @@ class StateRNN(Model):
         actions = convertToOneHot(actions, num_classes=self.action_dim)
         actions = np.reshape(actions, newshape=(batch_size, self.action_dim))
 
-        states_mask = np.reshape(states_mask, newshape=(batch_size, 1))
+        states_mask = np.reshape(states_mask, newshape=(batch_size,))
+
+        feed_dict = {self.step_inputs: np.concatenate((z_codes, actions), axis=1),
+                     self.step_state_reset_before_prediction_mask: states_mask
+                     }
+
+        if states_in is not None:
+            feed_dict[self.step_states_in] = states_in
+
+        if stateful:
+            predictions, _ = self.sess.run([self.stateful_step_output, self.advance_resident_states.op],
+                                           feed_dict=feed_dict)
+            return predictions, None
+
+        predictions, states_out = self.sess.run([self.step_output, self.step_states_out], feed_dict=feed_dict)
+
+        return predictions, states_out
+
+    def predict_on_sequences(self, z_sequences, action_sequences, states_mask_sequences, states_in=None):
+        """Runs the sequence graph over whole [batch, time] sequences of codes and action indexes in one call.
+
+        states_mask_sequences[:, t] is 0 where the state is reset before predicting from step t.
+
+        Returns:
+            (predicted next codes [batch, time, latent_dim], states after the last step [batch, lstm_size * 2])
+        """
+        action_sequences = np.asarray(action_sequences)
+        states_mask_sequences = np.asarray(states_mask_sequences)
+
+        assert z_sequences.shape[:2] == action_sequences.shape
+        assert z_sequences.shape[:2] == states_mask_sequences.shape
+        assert z_sequences.shape[2] == self.latent_dim
+
+        batch_size, sequence_length = action_sequences.shape
 
-        sequence_inputs = np.expand_dims(np.concatenate((z_codes, actions), axis=1), 1)
+        action_sequences = convertToOneHot(np.reshape(action_sequences, newshape=(-1,)), num_classes=self.action_dim)
+        action_sequences = np.reshape(action_sequences, newshape=(batch_size, sequence_length, self.action_dim))
 
-        feed_dict = {self.sequence_inputs: sequence_inputs,
-                     self.state_reset_before_prediction_mask: states_mask
+        feed_dict = {self.sequence_inputs: np.concatenate((z_sequences, action_sequences), axis=2),
+                     self.state_reset_before_prediction_mask: states_mask_sequences
                      }
 
         if states_in is not None:
             feed_dict[self.states_in] = states_in
 
-        predictions, states_out = self.sess.run([self.output, self.states_out], feed_dict=feed_dict)
+        return self.sess.run([self.output, self.states_out], feed_dict=feed_dict)
 
-        return predictions[:, 0, :], states_out
+    def reset_resident_states(self, batch_size):
+        """Sets the stateful inference states to zero states for batch_size envs."""
+        zero_states = np.zeros(shape=(batch_size, self.resident_states_placeholder.shape[1].value), dtype=np.float32)
+        self.sess.run(self.assign_resident_states.op, feed_dict={self.resident_states_placeholder: zero_states})
 
     def predict_on_frames_retain_state(self, z_codes, actions, states_mask):
 
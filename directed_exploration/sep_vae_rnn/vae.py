@@ -14,6 +14,83 @@ def get_dependencies(tensor):
     return dependencies
 
 
+def vae_encoder(scaled_x, latent_dim):
+    """Builds the encoder on [batch, 64, 64, 3] frames in [0, 1]. Must be called inside the VAE's variable scope.
+
+    Returns:
+        (z_mean, z_log_var)
+    """
+    variance_scaling = tf.contrib.layers.variance_scaling_initializer()
+
+    encode_1 = tf.layers.Conv2D(filters=32, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_1')(scaled_x)
+    encode_2 = tf.layers.Conv2D(filters=64, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_2')(encode_1)
+    encode_3 = tf.layers.Conv2D(filters=128, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_3')(encode_2)
+    encode_4 = tf.layers.Conv2D(filters=256, kernel_size=4, strides=2,
+                                padding='valid', activation=tf.nn.relu,
+                                kernel_initializer=variance_scaling,
+                                name='encode_4')(encode_3)
+    vae_flatten = tf.layers.Flatten()(encode_4)
+
+    z_mean = tf.layers.Dense(units=latent_dim, name='z_mean')(vae_flatten)
+    z_log_var = tf.layers.Dense(units=latent_dim, name='z_log_var')(vae_flatten)
+
+    return z_mean, z_log_var
+
+
+def sample_z(z_mean, z_log_var):
+    # Sampler: Normal (gaussian) random distribution
+    eps = tf.random_normal(tf.shape(z_log_var), dtype=tf.float32, mean=0., stddev=1.0, name='epsilon')
+    return z_mean + tf.exp(z_log_var / 2) * eps
+
+
+def vae_decoder(z):
+    """Builds the decoder on [batch, latent_dim] codes. Must be called inside the VAE's variable scope."""
+    variance_scaling = tf.contrib.layers.variance_scaling_initializer()
+    xavier = tf.contrib.layers.xavier_initializer()
+
+    # we instantiate these layers separately so as to reuse them later
+    decode_dense_1 = tf.layers.Dense(units=1024, activation=tf.nn.relu,
+                                     name='decode_dense_1')(z)
+
+    def decode_reshape(tensor):
+        return tf.reshape(tensor=tensor, shape=[-1, 1, 1, 1024])
+
+    decode_1 = tf.layers.Conv2DTranspose(filters=128, kernel_size=5, strides=2,
+                                         padding='valid', activation=tf.nn.relu,
+                                         kernel_initializer=variance_scaling,
+                                         name='decode_1')(decode_reshape(decode_dense_1))
+
+    decode_2 = tf.layers.Conv2DTranspose(filters=64, kernel_size=5, strides=2,
+                                         padding='valid', activation=tf.nn.relu,
+                                         kernel_initializer=variance_scaling,
+                                         name='decode_2')(decode_1)
+
+    decode_3 = tf.layers.Conv2DTranspose(filters=32, kernel_size=6, strides=2,
+                                         padding='valid', activation=tf.nn.relu,
+                                         kernel_initializer=variance_scaling,
+                                         name='decode_3')(decode_2)
+
+    decode_4 = tf.layers.Conv2DTranspose(filters=3, kernel_size=6, strides=2,
+                                         padding='valid', activation=tf.nn.sigmoid,
+                                         kernel_initializer=xavier, bias_initializer=xavier,
+                                         name='decode_4')(decode_3)
+
+    return decode_4
+
+
+def per_frame_reconstruction_loss(scaled_target_frames, decoded):
+    return tf.sqrt(tf.reduce_sum(tf.square(scaled_target_frames - decoded), axis=[1, 2, 3]))
+
+
 class VAE(Model):
     def __init__(self, latent_dim=128, working_dir=None, sess=None, graph=None, summary_writer=None):
         logger.info("VAE latent dim {}".format(latent_dim))
@@ -27,71 +104,19 @@ class VAE(Model):
 
         with self.graph.as_default():
             vae_scope = 'VAE_MODEL'
-            with tf.variable_scope(vae_scope):
-                variance_scaling = tf.contrib.layers.variance_scaling_initializer()
-                xavier = tf.contrib.layers.xavier_initializer()
-
-                # Building the encoder
-
-                self.x = tf.placeholder(tf.float32, shape=[None, 64, 64, 3], name='x')
-
-                encode_1 = tf.layers.Conv2D(filters=32, kernel_size=4, strides=2,
-                                            padding='valid', activation=tf.nn.relu,
-                                            kernel_initializer=variance_scaling,
-                                            name='encode_1')(self.x)
-                encode_2 = tf.layers.Conv2D(filters=64, kernel_size=4, strides=2,
-                                            padding='valid', activation=tf.nn.relu,
-                                            kernel_initializer=variance_scaling,
-                                            name='encode_2')(encode_1)
-                encode_3 = tf.layers.Conv2D(filters=128, kernel_size=4, strides=2,
-                                            padding='valid', activation=tf.nn.relu,
-                                            kernel_initializer=variance_scaling,
-                                            name='encode_3')(encode_2)
-                encode_4 = tf.layers.Conv2D(filters=256, kernel_size=4, strides=2,
-                                            padding='valid', activation=tf.nn.relu,
-                                            kernel_initializer=variance_scaling,
-                                            name='encode_4')(encode_3)
-                vae_flatten = tf.layers.Flatten()(encode_4)
-
-                z_mean = tf.layers.Dense(units=self.latent_dim, name='z_mean')(vae_flatten)
-                z_log_var = tf.layers.Dense(units=self.latent_dim, name='z_log_var')(vae_flatten)
-
-                # Sampler: Normal (gaussian) random distribution
-                with tf.name_scope("sampling"):
-                    eps = tf.random_normal(tf.shape(z_log_var), dtype=tf.float32, mean=0., stddev=1.0, name='epsilon')
+            with tf.variable_scope(vae_scope) as self.variable_scope:
+                # Frames are fed as uint8 and scaled to [0, 1] in the graph.
+                self.x = tf.placeholder(tf.uint8, shape=[None, 64, 64, 3], name='x')
+                scaled_x = tf.cast(self.x, tf.float32) / 255.0
+
+                z_mean, z_log_var = vae_encoder(scaled_x, self.latent_dim)
 
-                    self.z_encoded = tf.placeholder_with_default(input=(z_mean + tf.exp(z_log_var / 2) * eps),
+                with tf.name_scope("sampling"):
+                    self.z_encoded = tf.placeholder_with_default(input=sample_z(z_mean, z_log_var),
                                                                  shape=[None, self.latent_dim],
                                                                  name='z')
 
-                # we instantiate these layers separately so as to reuse them later
-                decode_dense_1 = tf.layers.Dense(units=1024, activation=tf.nn.relu,
-                                                 name='decode_dense_1')(self.z_encoded)
-
-                def decode_reshape(tensor):
-                    return tf.reshape(tensor=tensor, shape=[-1, 1, 1, 1024])
-
-                decode_1 = tf.layers.Conv2DTranspose(filters=128, kernel_size=5, strides=2,
-                                                     padding='valid', activation=tf.nn.relu,
-                                                     kernel_initializer=variance_scaling,
-                                                     name='decode_1')(decode_reshape(decode_dense_1))
-
-                decode_2 = tf.layers.Conv2DTranspose(filters=64, kernel_size=5, strides=2,
-                                                     padding='valid', activation=tf.nn.relu,
-                                                     kernel_initializer=variance_scaling,
-                                                     name='decode_2')(decode_1)
-
-                decode_3 = tf.layers.Conv2DTranspose(filters=32, kernel_size=6, strides=2,
-                                                     padding='valid', activation=tf.nn.relu,
-                                                     kernel_initializer=variance_scaling,
-                                                     name='decode_3')(decode_2)
-
-                decode_4 = tf.layers.Conv2DTranspose(filters=3, kernel_size=6, strides=2,
-                                                     padding='valid', activation=tf.nn.sigmoid,
-                                                     kernel_initializer=xavier, bias_initializer=xavier,
-                                                     name='decode_4')(decode_3)
-
-                self.decoded = decode_4
+                self.decoded = vae_decoder(self.z_encoded)
 
                 with tf.name_scope('loss'):
                     with tf.name_scope('kl_div_loss'):
@@ -101,11 +126,10 @@ class VAE(Model):
                         tf.summary.scalar('kl_div_loss', self.kl_div_loss)
 
                     with tf.name_scope('reconstruction_loss'):
-                        self.per_frame_reconstruction_loss = tf.sqrt(tf.reduce_sum(tf.square(self.x - self.decoded),
-                                                                                   axis=[1, 2, 3]))
+                        self.per_frame_reconstruction_loss = per_frame_reconstruction_loss(scaled_x, self.decoded)
 
                         self.reconstruction_loss = tf.reduce_mean(
-                            tf.reduce_sum(tf.square(self.x - self.decoded), axis=[1, 2, 3])
+                            tf.reduce_sum(tf.square(scaled_x - self.decoded), axis=[1, 2, 3])
                         )
 
                         tf.summary.scalar('reconstruction_loss', self.reconstruction_loss)
@@ -127,9 +151,7 @@ class VAE(Model):
                 var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=vae_scope)
                 var_list += tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=vae_ops_scope)
 
-                self.saver = tf.train.Saver(var_list=var_list,
-                                            max_to_keep=5,
-                                            keep_checkpoint_every_n_hours=1)
+                self.saver = self._make_saver(var_list)
 
             self.init = tf.variables_initializer(var_list=var_list, name='vae_initializer')
 
@@ -145,16 +167,13 @@ class VAE(Model):
 
         feed_dict = {self.x: frames_batch}
 
-        _, loss, kl_divergence, reconstruction_loss, summaries, step, encodings = self.sess.run([self.train_op,
-                                                                                      self.loss,
-                                                                                      self.kl_div_loss,
-                                                                                      self.reconstruction_loss,
-                                                                                      self.tf_summaries_merged,
-                                                                                      self.local_step,
-                                                                                    self.z_encoded],
-                                                                                     feed_dict=feed_dict)
-
-        self.writer.add_summary(summaries, step)
+        _, loss, kl_divergence, reconstruction_loss, step, encodings = self._run_train_step([self.train_op,
+                                                                                             self.loss,
+                                                                                             self.kl_div_loss,
+                                                                                             self.reconstruction_loss,
+                                                                                             self.local_step,
+                                                                                             self.z_encoded],
+                                                                                            feed_dict=feed_dict)
 
         return loss, kl_divergence, reconstruction_loss, step, encodings
 
@@ -234,15 +253,12 @@ class VAE(Model):
 
             # Train
             feed_dict = {self.x: batch_x}
-            _, l, kl, r, summaries, step = self.sess.run([self.train_op,
-                                                          self.loss,
-                                                          self.kl_div_loss,
-                                                          self.reconstruction_loss,
-                                                          self.tf_summaries_merged,
-                                                          self.local_step],
-                                                         feed_dict=feed_dict)
-
-            self.writer.add_summary(summaries, step)
+            _, l, kl, r, step = self._run_train_step([self.train_op,
+                                                      self.loss,
+                                                      self.kl_div_loss,
+                                                      self.reconstruction_loss,
+                                                      self.local_step],
+                                                     feed_dict=feed_dict)
 
             if train_loop_step % 50 == 0 or train_loop_step == 1:
                 logger.debug('VAE Step %i, Loss: %f, KL div: %f, Reconstr: %f' % (step, l, kl, r))
@@ -256,8 +272,26 @@ class VAE(Model):
 
             train_loop_step += 1
 
-    def encode_frames(self, float_frames):
-        return self.sess.run(self.z_encoded, feed_dict={self.x: float_frames})
+    def inference_signature(self):
+        inputs = {'x': self.x, 'z_encoded': self.z_encoded}
+        outputs = {'z_encoded': self.z_encoded,
+                   'decoded': self.decoded,
+                   'per_frame_reconstruction_loss': self.per_frame_reconstruction_loss}
+        return inputs, outputs
+
+    def build_encoder(self, frames):
+        """Builds another encoder (with sampling) on uint8 frames in this model's graph, sharing its variables."""
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            z_mean, z_log_var = vae_encoder(tf.cast(frames, tf.float32) / 255.0, self.latent_dim)
+            return sample_z(z_mean, z_log_var)
+
+    def build_decoder(self, z_codes):
+        """Builds another decoder on z_codes in this model's graph, sharing its variables."""
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            return vae_decoder(z_codes)
+
+    def encode_frames(self, frames):
+        return self.sess.run(self.z_encoded, feed_dict={self.x: frames})
 
     def decode_frames(self, z_codes):
         return self.sess.run(self.decoded, feed_dict={self.z_encoded: z_codes})
@@ -270,5 +304,5 @@ class VAE(Model):
             return self.sess.run([self.per_frame_reconstruction_loss, self.decoded], feed_dict={self.z_encoded: z_codes,
                                                                                                 self.x: target_frames})
 
-    def encode_then_decode_frames(self, float_frames):
-        return self.sess.run(self.decoded, feed_dict={self.x: float_frames})
+    def encode_then_decode_frames(self, frames):
+        return self.sess.run(self.decoded, feed_dict={self.x: frames})
@@ -1,4 +1,3 @@
-import pickle
 import random
 import gym
 import gym_boxpush
@@ -10,6 +9,7 @@ import itertools
 import cv2
 import argparse
 from directed_exploration.utils.data_util import convertToOneHot
+from directed_exploration.utils.frame_records import frame_features, parse_frame_compression
 from multiprocessing import Process, Queue
 
 
@@ -24,7 +24,7 @@ def _bytes_feature(value):
 def _floats_feature(value):
     return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
-def write_user_controller_atari_episode_to_tf_record(episode_index, write_dir):
+def write_user_controller_atari_episode_to_tf_record(episode_index, write_dir, frame_compression=''):
 
     env = gym.make('BreakoutDeterministic-v4')
 
@@ -54,19 +54,16 @@ def write_user_controller_atari_episode_to_tf_record(episode_index, write_dir):
             frame[0] = env.reset()
 
         frame[0] = cv2.resize(src=frame[0], dsize=(84, 84), interpolation=cv2.INTER_AREA)
-        frame[0] = frame[0] / 255.0
 
         env.render()
         # cv2.imshow("game", frame[0])
         # cv2.waitKey(50)
         window.activate()
 
-        frame_bytes = pickle.dumps(frame[0])
-
         # save frame and action
         example = tf.train.Example(features=tf.train.Features(feature={
             'action_at_frame': _floats_feature(convertToOneHot(action[0], num_classes=env.action_space.n)),
-            'frame_bytes': _bytes_feature(frame_bytes)
+            **frame_features(np.asarray(frame[0], dtype=np.uint8), frame_compression)
         }))
         writer.write(example.SerializeToString())
 
@@ -92,7 +89,8 @@ def write_user_controller_atari_episode_to_tf_record(episode_index, write_dir):
 
 
 
-def write_user_controlled_boxpush_episode_to_tf_record(episode_index, write_dir, max_episode_length):
+def write_user_controlled_boxpush_episode_to_tf_record(episode_index, write_dir, max_episode_length,
+                                                       frame_compression=''):
     env = gym.make('boxpushsimple-v0')
 
     filename = os.path.join(write_dir, 'vae_{}.tfrecords'.format(episode_index))
@@ -123,13 +121,10 @@ def write_user_controlled_boxpush_episode_to_tf_record(episode_index, write_dir,
     while step_index < max_episode_length:
         env.render()
 
-        frame = frame / 255.0
-        frame_bytes = pickle.dumps(frame)
-
         # save frame and action
         example = tf.train.Example(features=tf.train.Features(feature={
             'action_at_frame': _floats_feature(convertToOneHot(action[0], num_classes=env.action_space.n)),
-            'frame_bytes': _bytes_feature(frame_bytes)
+            **frame_features(np.asarray(frame, dtype=np.uint8), frame_compression)
         }))
         writer.write(example.SerializeToString())
 
@@ -160,7 +155,8 @@ def generate_user_controlled_boxpush_data(args):
         frames_written_in_each_episode.append(write_user_controlled_boxpush_episode_to_tf_record(
             episode_index=episode_index,
             write_dir=args.write_dir,
-            max_episode_length=args.max_episode_length))
+            max_episode_length=args.max_episode_length,
+            frame_compression=args.frame_compression))
 
     print("Wrote {} frames in total".format(sum(frames_written_in_each_episode)))
     print("Last episode index written to was {}".format(ending_episode_index-1))
@@ -184,7 +180,8 @@ def generate_user_controlled_atari_data(args):
     def run_atari_episode(queue):
         frames_written_in_episode = write_user_controller_atari_episode_to_tf_record(
             episode_index=episode_index,
-            write_dir=args.write_dir
+            write_dir=args.write_dir,
+            frame_compression=args.frame_compression
         )
         queue.put(frames_written_in_episode)
 
@@ -199,7 +196,7 @@ def generate_user_controlled_atari_data(args):
     print("(So if writing more episodes, start at {})".format(ending_episode_index))
 
 
-def write_random_episode_to_tf_record(episode_index, write_dir, max_episode_length):
+def write_random_episode_to_tf_record(episode_index, write_dir, max_episode_length, frame_compression=''):
     env = gym.make('boxpushsimple-v0')
 
     filename = os.path.join(write_dir, 'vae_{}.tfrecords'.format(episode_index))
@@ -210,13 +207,10 @@ def write_random_episode_to_tf_record(episode_index, write_dir, max_episode_leng
 
     step_index = 0
     while step_index < max_episode_length:
-        frame = frame / 255.0
-        frame_bytes = pickle.dumps(frame)
-
         # save frame and action
         example = tf.train.Example(features=tf.train.Features(feature={
             'action_at_frame': _int64_feature(action),
-            'frame_bytes': _bytes_feature(frame_bytes)
+            **frame_features(np.asarray(frame, dtype=np.uint8), frame_compression)
         }))
         writer.write(example.SerializeToString())
 
@@ -249,7 +243,8 @@ def generate_random_vae_data(args):
         frames_written_in_each_episode = pool.starmap(write_user_controlled_boxpush_episode_to_tf_record,
                                                       zip(range(starting_episode_index, ending_episode_index),
                                                           itertools.repeat(args.write_dir),
-                                                          itertools.repeat(args.max_episode_length)
+                                                          itertools.repeat(args.max_episode_length),
+                                                          itertools.repeat(args.frame_compression)
                                                           )
                                                       )
 
@@ -270,6 +265,8 @@ if __name__ == '__main__':
                         type=int, default=12)
     parser.add_argument("--max-episode-length", help="Maximum length of any single episode",
                         type=int, default=1000)
+    parser.add_argument("--frame-compression", help="Compress each record's frame, 'none' or 'ZLIB'",
+                        type=parse_frame_compression, default='none')
     parser.add_argument("--user-controlled", help="user controls agent movements in environment",
                         action="store_true")
     args = parser.parse_args()
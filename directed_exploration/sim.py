@@ -2,15 +2,48 @@ from abc import ABC, abstractmethod
 
 
 class Sim(ABC):
+    """
+    Sims with stateful_inference set keep per-env rnn states for the predict methods in the model itself.
+    The predict methods then take t_states=None and return None in place of t_plus_one_states, and reset_states
+    zeroes those states. Only sims that support stateful_inference need reset_states.
+    """
+
+    stateful_inference = False
 
     @abstractmethod
     def save_model(self):
+        """Saves a checkpoint and returns whatever restore_model needs to load it again (e.g. its path)"""
+        pass
+
+    @abstractmethod
+    def restore_model(self, checkpoint_path):
+        """Restores the weights saved by the save_model call that returned checkpoint_path"""
+        pass
+
+    @abstractmethod
+    def set_async_checkpointing(self, enabled=True):
+        """With async checkpointing, save_model returns once the weights are copied and writes them in the background"""
+        pass
+
+    @abstractmethod
+    def wait_for_pending_saves(self):
+        """Blocks until every checkpoint returned by save_model so far can be restored. Only for the saving thread"""
+        pass
+
+    @abstractmethod
+    def wait_for_checkpoint(self, checkpoint_path):
+        """Blocks until the checkpoint save_model returned as checkpoint_path can be restored. Safe on any thread"""
         pass
 
     @abstractmethod
     def get_current_step(self):
         pass
 
+    @abstractmethod
+    def set_summary_schedule(self, every_n_steps=1, every_n_seconds=None):
+        """Sets how often train_on_batch writes model summaries, see Model.set_summary_schedule"""
+        pass
+
     @abstractmethod
     def predict_on_batch(self,  t_obs, t_actions, t_dones, t_state=None, actual_t_plus_one_obs=None, return_t_plus_one_predictions=True):
         """Predicts next observations given batch of current observations, actions, and states
@@ -32,23 +65,82 @@ class Sim(ABC):
         pass
 
     @abstractmethod
-    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch):
+    def predict_losses_on_batch(self, t_obs, t_actions, t_dones, actual_t_plus_one_obs, t_plus_1_dones, t_states=None):
+        """Reward-only version of predict_on_batch that never copies predicted observations out of the model.
+
+        Returns:
+            (NDArray of per-sample losses against actual_t_plus_one_obs, NDArray of t_plus_one_states)
+
+        """
+
+        pass
+
+    @abstractmethod
+    def begin_predict_on_batch(self, t_obs, t_actions, t_dones, t_states=None, return_t_plus_one_predictions=False):
+        """First half of predict_on_batch that doesn't need the actual next observations.
+
+        Lets the prediction for step t run while the envs are still stepping. The predictions are kept
+        by the sim until they are scored with finish_predict_on_batch.
+
+        Returns:
+            NDArray of t_plus_one_predictions (if return_t_plus_one_predictions) and the NDArray of t_plus_one_states
+
+        """
+
+        pass
+
+    @abstractmethod
+    def finish_predict_on_batch(self, env_indexes, actual_t_plus_one_obs, t_plus_1_dones):
+        """Scores the pending predictions from begin_predict_on_batch for a subset of envs.
+
+        May be called several times per step with disjoint env_indexes as groups of envs finish stepping.
+
+        Args:
+          env_indexes: Indexes into the batch passed to begin_predict_on_batch.
+          actual_t_plus_one_obs: Actual next observations for those envs.
+          t_plus_1_dones: Dones for those envs. Losses are zeroed where the episode ended.
+
+        Returns:
+            NDArray of per-sample losses for env_indexes
+
+        """
+
+        pass
+
+    def reset_states(self, num_envs):
+        """Sets the stateful inference rnn states to zero states for num_envs envs. Only called with stateful_inference"""
+        raise NotImplementedError("{} has no stateful inference".format(type(self).__name__))
+
+    @abstractmethod
+    def train_on_batch(self, obs_sequence_batch, action_sequence_batch, dones_sequence_batch, initial_states_batch,
+                       return_sequence_losses=False):
         """Trains on batch of sequential observation, actions, and initial states
 
+        All sequence batches are batch-major and may be views into a shared buffer,
+        so they should not be modified or kept after returning.
+
         Args:
-          obs_sequence_batch: Observations to train on.
-            Will use obs_seq_batch[:-1] as inputs and obs_seq_batch[1:] as targets
-          action_sequence_batch: Current actions to predict on.
-            Actions are those taken while observing obs_seq_batch[:-1]
+          obs_sequence_batch: Observations to train on, shape [batch, seq_length + 1, ...].
+            Will use obs_sequence_batch[:, :-1] as inputs and obs_sequence_batch[:, 1:] as targets
+          action_sequence_batch: One-hot actions, shape [batch, seq_length, action_dim].
+            Actions are those taken while observing obs_sequence_batch[:, :-1]
+          dones_sequence_batch: Episode dones for each observation, shape [batch, seq_length + 1].
           initial_states_batch: initial RNN state to predict on.
+          return_sequence_losses: Whether to also return each sequence's loss, shape [batch].
 
         Returns:
-            (train step, dictionary of loss values, rnn states out)
+            (train step, dictionary of loss values, rnn states out), followed by the sequence losses
+            if return_sequence_losses
 
         """
 
         pass
 
+    @abstractmethod
+    def prepare_validation(self, allowed_action_space):
+        """Builds everything validate needs in the sim's graph, so that the graph can be finalized afterwards"""
+        pass
+
     @abstractmethod
     def validate(self, validation_data_dir, allowed_action_space=None):
 
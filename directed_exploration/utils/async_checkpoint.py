@@ -0,0 +1,145 @@
+import threading
+import time
+import glob
+import os
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def fsync_checkpoint(checkpoint_path):
+    """fsyncs the files of the checkpoint at checkpoint_path, the checkpoint state file next to it and the directory."""
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+
+    for file_name in glob.glob(checkpoint_path + '.*') + [os.path.join(checkpoint_dir, 'checkpoint')]:
+        if os.path.exists(file_name):
+            with open(file_name, 'rb') as checkpoint_file:
+                os.fsync(checkpoint_file.fileno())
+
+    directory_fd = os.open(checkpoint_dir, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class PendingCheckpoint:
+    """Handle of one AsyncCheckpointWriter save. Any thread may wait on it, and every waiter sees its error."""
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        """Blocks until the checkpoint is on disk. Raises if writing it failed."""
+        self._done.wait()
+
+        if self.error is not None:
+            raise RuntimeError("Writing checkpoint {} failed".format(self.checkpoint_path)) from self.error
+
+
+class AsyncCheckpointWriter:
+    """Saves checkpoints of var_list without blocking the training thread on disk I/O.
+
+    save() copies the variable values into host memory in one session run and returns a PendingCheckpoint. A
+    background thread then loads them into a copy of the variables in a separate graph and saves that with a Saver
+    configured like the models' own, under the same variable names, so the model's saver restores the result. At most
+    one save is in flight: save() first waits for the previous one.
+
+    save() and wait() belong to the thread that saves. Other threads wait on the PendingCheckpoint of the checkpoint
+    they want to read.
+    """
+
+    def __init__(self, var_list, name, max_to_keep=5, keep_checkpoint_every_n_hours=1):
+        self.var_list = list(var_list)
+        self.name = name
+        self.max_to_keep = max_to_keep
+        self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
+
+        # Built on the first write.
+        self._graph = None
+        self._sess = None
+        self._saver = None
+        self._initializer = None
+        self._value_placeholders = None
+
+        self._pending = None
+        self._thread = None
+
+        self.last_snapshot_seconds = None
+        self.last_write_seconds = None
+
+    def save(self, sess, save_path, global_step):
+        """Snapshots the variables and starts writing them to save_path-<global step>.
+
+        Returns:
+            the PendingCheckpoint of the save
+        """
+        self.wait()
+
+        start = time.perf_counter()
+        values, step = sess.run([self.var_list, global_step])
+        self.last_snapshot_seconds = time.perf_counter() - start
+
+        pending = PendingCheckpoint('{}-{}'.format(save_path, step))
+
+        self._pending = pending
+        self._thread = threading.Thread(target=self._write, args=(values, save_path, step, pending),
+                                        name='{}_checkpoint_writer'.format(self.name))
+        self._thread.daemon = True
+        self._thread.start()
+
+        return pending
+
+    def wait(self):
+        """Blocks until the save in flight (if any) is on disk. Raises if it failed."""
+        if self._pending is not None:
+            self._pending.wait()
+
+    def _build_writer_graph(self, save_dir):
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._value_placeholders = [tf.placeholder(var.dtype.base_dtype, shape=var.shape)
+                                        for var in self.var_list]
+            writer_vars = {var.op.name: tf.Variable(initial_value=placeholder, trainable=False)
+                           for var, placeholder in zip(self.var_list, self._value_placeholders)}
+
+            # Running the initializer with the snapshot fed in loads it into the writer variables.
+            self._initializer = tf.variables_initializer(list(writer_vars.values()))
+            self._saver = tf.train.Saver(var_list=writer_vars,
+                                         max_to_keep=self.max_to_keep,
+                                         keep_checkpoint_every_n_hours=self.keep_checkpoint_every_n_hours)
+
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        # Keep rotating out the checkpoints that are already there.
+        checkpoint_state = tf.train.get_checkpoint_state(save_dir)
+        if checkpoint_state is not None:
+            self._saver.recover_last_checkpoints(checkpoint_state.all_model_checkpoint_paths)
+
+    def _write(self, values, save_path, step, pending):
+        try:
+            start = time.perf_counter()
+
+            if self._graph is None:
+                self._build_writer_graph(os.path.dirname(save_path))
+
+            self._sess.run(self._initializer, feed_dict=dict(zip(self._value_placeholders, values)))
+            checkpoint_path = self._saver.save(sess=self._sess, save_path=save_path, global_step=step,
+                                               write_meta_graph=False)
+            fsync_checkpoint(checkpoint_path)
+
+            self.last_write_seconds = time.perf_counter() - start
+
+            logger.info("{} checkpoint {} written: snapshot {:.3f}s, write {:.3f}s".format(
+                self.name, checkpoint_path, self.last_snapshot_seconds, self.last_write_seconds))
+        except Exception as e:
+            logger.exception("{} checkpoint write of step {} failed".format(self.name, step))
+            pending.error = e
+        finally:
+            pending._done.set()
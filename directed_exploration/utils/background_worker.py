@@ -0,0 +1,100 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingWorker:
+    """Runs submitted jobs one at a time on a single daemon thread without ever blocking the submitter.
+
+    At most one job waits behind the one that is running. Submitting while a job is already waiting replaces it,
+    and the replaced job's on_discard callback (if any) is called instead. Only the newest work is ever done
+    when the worker falls behind.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._pending_job = None
+        self._busy = False
+        self._closed = False
+
+        self.jobs_run = 0
+        self.jobs_discarded = 0
+        self.last_duration = None
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, fn, *args, on_discard=None, **kwargs):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("{} worker is closed".format(self.name))
+
+            replaced_job = self._pending_job
+            self._pending_job = (fn, args, kwargs, on_discard)
+            self._condition.notify()
+
+        if replaced_job is not None:
+            self._discard(replaced_job)
+
+    def is_idle(self):
+        with self._condition:
+            return self._pending_job is None and not self._busy
+
+    def wait_until_idle(self):
+        with self._condition:
+            while self._pending_job is not None or self._busy:
+                self._condition.wait()
+
+    def close(self, wait=True):
+        """Stops the worker. If wait, the pending job is still run first, otherwise it is discarded."""
+        with self._condition:
+            self._closed = True
+            replaced_job = None
+            if not wait:
+                replaced_job = self._pending_job
+                self._pending_job = None
+            self._condition.notify_all()
+
+        if replaced_job is not None:
+            self._discard(replaced_job)
+
+        self._thread.join()
+
+    def _discard(self, job):
+        self.jobs_discarded += 1
+        _, _, _, on_discard = job
+        if on_discard is not None:
+            try:
+                on_discard()
+            except Exception:
+                logger.exception("{} worker: on_discard callback failed".format(self.name))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending_job is None and not self._closed:
+                    self._condition.wait()
+
+                if self._pending_job is None:
+                    return
+
+                fn, args, kwargs, _ = self._pending_job
+                self._pending_job = None
+                self._busy = True
+
+            start = time.monotonic()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception("{} worker: job failed".format(self.name))
+            finally:
+                self.last_duration = time.monotonic() - start
+                self.jobs_run += 1
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
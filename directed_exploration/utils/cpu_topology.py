@@ -0,0 +1,172 @@
+import glob
+import os
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cpu_list(value):
+    """Parses a Linux style cpu list like '0-7,16,18-19' into a sorted list of cpu ids. 'None' or '' gives None."""
+    if value is None or value in ['None', '']:
+        return None
+
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            if int(last) < int(first):
+                raise ValueError("Bad cpu range {} in cpu list {}".format(part, value))
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    """The inverse of parse_cpu_list."""
+    if cpus is None:
+        return 'any'
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def available_cpus():
+    """Cpus this process may run on, or all of them where affinity isn't supported."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def pin_to_cpus(cpus):
+    """Restricts the calling thread, and the threads and processes it starts from now on, to cpus.
+
+    Returns:
+        whether the affinity could be set
+    """
+    if cpus is None:
+        return False
+
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning("Cpu affinity isn't supported on this platform, not pinning to cpus {}".format(
+            format_cpu_list(cpus)))
+        return False
+
+    os.sched_setaffinity(0, cpus)
+    return True
+
+
+def assign_env_worker_cpus(cpus, num_workers, cpus_per_worker=0):
+    """Splits cpus between num_workers env worker processes.
+
+    With cpus_per_worker 0, every worker may use all of cpus. Otherwise worker i gets cpus_per_worker consecutive cpus
+    of the list starting at i * cpus_per_worker, wrapping around when there are more workers than cpus.
+
+    Returns:
+        list of num_workers cpu lists, or None if cpus is None
+    """
+    if cpus is None:
+        return None
+
+    if cpus_per_worker <= 0:
+        return [list(cpus) for _ in range(num_workers)]
+
+    if cpus_per_worker > len(cpus):
+        raise ValueError("Can't give {} cpus to each env worker from the {} cpus {}".format(
+            cpus_per_worker, len(cpus), format_cpu_list(cpus)))
+
+    return [[cpus[(worker * cpus_per_worker + i) % len(cpus)] for i in range(cpus_per_worker)]
+            for worker in range(num_workers)]
+
+
+def pinned_env_fn(env_fn, cpus):
+    """Wraps a subproc env factory so that the worker process pins itself to cpus before building its env."""
+    if cpus is None:
+        return env_fn
+
+    def _pinned_env_fn():
+        pin_to_cpus(cpus)
+        return env_fn()
+
+    return _pinned_env_fn
+
+
+def apply_cpu_layout(main_cpus, env_cpus, num_env_workers, cpus_per_env_worker=0):
+    """Pins the calling (main) process to main_cpus and returns the env worker cpu lists to build the envs with.
+
+    Must be called before the TensorFlow session and the env workers are created. When main_cpus is set but env_cpus
+    isn't, env workers get the cpus that were available before pinning instead of inheriting main_cpus.
+    """
+    if env_cpus is None and (main_cpus is not None or cpus_per_env_worker > 0):
+        env_cpus = available_cpus()
+
+    pin_to_cpus(main_cpus)
+
+    return assign_env_worker_cpus(env_cpus, num_env_workers, cpus_per_env_worker)
+
+
+def make_session_config(intra_op_threads=0, inter_op_threads=0):
+    """ConfigProto with allow_soft_placement and GPU memory growth, like the runs' own. 0 threads leaves the pool
+    size to TensorFlow (one thread per cpu it can see)."""
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    config.gpu_options.allow_growth = True
+    return config
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as sysfs_file:
+            return sysfs_file.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_topology_report(main_cpus=None, env_worker_cpus=None, intra_op_threads=0, inter_op_threads=0):
+    """Describes the machine's cpu topology and how the run's threads and processes are laid out over it.
+
+    Args:
+        main_cpus: cpus the main (TensorFlow) process is pinned to, or None
+        env_worker_cpus: per env worker cpu lists from assign_env_worker_cpus, or None
+    """
+    lines = ['Cpu topology:']
+
+    lines.append("  logical cpus: {}, available to this process: {}".format(os.cpu_count(),
+                                                                            format_cpu_list(available_cpus())))
+
+    cores = set()
+    sockets = set()
+    for cpu_dir in glob.glob('/sys/devices/system/cpu/cpu[0-9]*'):
+        package_id = _read_sysfs(os.path.join(cpu_dir, 'topology', 'physical_package_id'))
+        core_id = _read_sysfs(os.path.join(cpu_dir, 'topology', 'core_id'))
+        if package_id is not None and core_id is not None:
+            sockets.add(package_id)
+            cores.add((package_id, core_id))
+    if cores:
+        lines.append("  sockets: {}, physical cores: {}".format(len(sockets), len(cores)))
+
+    for node_dir in sorted(glob.glob('/sys/devices/system/node/node[0-9]*'),
+                           key=lambda node_dir: int(os.path.basename(node_dir)[4:])):
+        node_cpus = _read_sysfs(os.path.join(node_dir, 'cpulist'))
+        if node_cpus:
+            lines.append("  numa {}: cpus {}".format(os.path.basename(node_dir), node_cpus))
+
+    lines.append("  TensorFlow intra op threads: {}, inter op threads: {}".format(intra_op_threads or 'default',
+                                                                                  inter_op_threads or 'default'))
+    lines.append("  main process cpus: {}".format(format_cpu_list(main_cpus)))
+
+    if env_worker_cpus is None:
+        lines.append("  env worker cpus: any")
+    else:
+        for worker, cpus in enumerate(env_worker_cpus):
+            lines.append("  env worker {} cpus: {}".format(worker, format_cpu_list(cpus)))
+
+    return '\n'.join(lines)
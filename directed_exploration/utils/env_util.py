@@ -1,8 +1,10 @@
 import numpy as np
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 from baselines.common.vec_env import VecEnv, CloudpickleWrapper
 from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
 from baselines.bench import Monitor
+from directed_exploration.utils.cpu_topology import pinned_env_fn
 
 import os
 import gym
@@ -72,9 +74,11 @@ class RecordWriteSubprocVecEnv(SubprocVecEnv):
         return np.stack([remote.recv() for remote in self.remotes])
 
 
-def make_record_write_subproc_env(env_id, num_env, start_index=0):
+def make_record_write_subproc_env(env_id, num_env, start_index=0, env_worker_cpus=None):
     """
     Create a BoxPushSubprocVecEnv.
+
+    env_worker_cpus: optional list of cpu lists (see cpu_topology.assign_env_worker_cpus), one per env worker process
     """
     def make_env(rank):  # pylint: disable=C0111
         def _thunk():
@@ -84,7 +88,9 @@ def make_record_write_subproc_env(env_id, num_env, start_index=0):
 
         return _thunk
     # set_global_seeds(seed)
-    return RecordWriteSubprocVecEnv([make_env(i + start_index) for i in range(num_env)])
+    return RecordWriteSubprocVecEnv([pinned_env_fn(make_env(i + start_index),
+                                                   None if env_worker_cpus is None else env_worker_cpus[i])
+                                     for i in range(num_env)])
 
 
 class ResizeFrameWrapper(gym.ObservationWrapper):
@@ -120,9 +126,11 @@ class RescaleFrameWrapper(gym.ObservationWrapper):
         return frame / 255.0
 
 
-def make_subproc_env(env_id, num_env, width, height, seed, start_index=0, monitor_to_dir=None):
+def make_subproc_env(env_id, num_env, width, height, seed, start_index=0, monitor_to_dir=None, env_worker_cpus=None):
     """
     Create a SubprocVecEnv.
+
+    env_worker_cpus: optional list of cpu lists (see cpu_topology.assign_env_worker_cpus), one per env worker process
     """
     def make_env(rank):  # pylint: disable=C0111
         def _thunk():
@@ -136,4 +144,37 @@ def make_subproc_env(env_id, num_env, width, height, seed, start_index=0, monito
         return _thunk
 
     # set_global_seeds(seed)
-    return SubprocVecEnv([make_env(i + start_index) for i in range(num_env)])
\ No newline at end of file
+    return SubprocVecEnv([pinned_env_fn(make_env(i + start_index),
+                                        None if env_worker_cpus is None else env_worker_cpus[i])
+                          for i in range(num_env)])
+
+
+def step_wait_in_groups(subproc_env, min_group_size):
+    """
+    Like SubprocVecEnv.step_wait, but yields results for groups of envs in the order they finish stepping
+    instead of waiting for the slowest env.
+
+    Must be called after subproc_env.step_async(). Yields (env_indexes, obs, rews, dones, infos) for groups of
+    at least min_group_size envs (the last group may be smaller).
+    """
+    env_indexes_by_remote = {remote: env_index for env_index, remote in enumerate(subproc_env.remotes)}
+    pending_remotes = list(subproc_env.remotes)
+
+    ready_env_indexes = []
+    ready_results = []
+
+    while pending_remotes:
+        for remote in wait(pending_remotes):
+            pending_remotes.remove(remote)
+            ready_env_indexes.append(env_indexes_by_remote[remote])
+            ready_results.append(remote.recv())
+
+        if len(ready_env_indexes) >= min_group_size or not pending_remotes:
+            if not pending_remotes:
+                subproc_env.waiting = False
+
+            obs, rews, dones, infos = zip(*ready_results)
+            yield np.asarray(ready_env_indexes), np.stack(obs), np.stack(rews), np.stack(dones), infos
+
+            ready_env_indexes = []
+            ready_results = []
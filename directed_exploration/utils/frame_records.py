@@ -0,0 +1,197 @@
+"""
+Frame record format for datagen and validation tfrecords.
+
+Each tf.Example holds one frame next to whatever other features (e.g. action_at_frame) the writer adds.
+
+Version 2 (written by frame_features):
+    format_version:    int64, 2
+    frame_raw:         bytes, the frame's raw uint8 bytes in C order, zlib compressed if frame_compression is 'ZLIB'
+    frame_shape:       int64 list, the frame's shape
+    frame_dtype:       bytes, 'uint8'
+    frame_compression: bytes, '' or 'ZLIB'
+
+Version 1 (no format_version feature):
+    frame_bytes:       bytes, a pickled numpy array, uint8 or float in [0, 1]
+
+Version 2 records decode with native ops (decode_frame_tensor), version 1 records only through pickle in a py_func.
+Migrate old shards with:
+
+    python -m directed_exploration.utils.frame_records <source dir> <destination dir> [--compression ZLIB]
+"""
+
+import argparse
+import os
+import pickle
+import shutil
+import time
+import zlib
+import numpy as np
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+FRAME_RECORD_FORMAT_VERSION = 2
+
+FRAME_COMPRESSIONS = ('', 'ZLIB')
+
+
+def decode_pickled_np_array(np_bytes):
+    frame = pickle.loads(np_bytes)
+    if frame.dtype != np.uint8:
+        # Older records store frames already scaled to [0, 1].
+        frame = np.round(frame * 255.0).astype(np.uint8)
+    return frame
+
+
+def parse_frame_compression(value):
+    """argparse type for frame compression, 'none' or 'ZLIB'."""
+    compression = '' if value == 'none' else value
+    if compression not in FRAME_COMPRESSIONS:
+        raise ValueError("Frame compression must be 'none' or one of {}".format(FRAME_COMPRESSIONS[1:]))
+    return compression
+
+
+def frame_features(frame, compression=''):
+    """Returns the version 2 features of a uint8 frame, to add to a tf.Example's feature dict."""
+    frame = np.ascontiguousarray(frame)
+    if frame.dtype != np.uint8:
+        raise ValueError("Frame records store uint8 frames, not {}".format(frame.dtype))
+    if compression not in FRAME_COMPRESSIONS:
+        raise ValueError("Unknown frame compression {}, must be one of {}".format(compression, FRAME_COMPRESSIONS))
+
+    frame_raw = frame.tobytes()
+    if compression == 'ZLIB':
+        frame_raw = zlib.compress(frame_raw)
+
+    return {
+        'format_version': tf.train.Feature(int64_list=tf.train.Int64List(value=[FRAME_RECORD_FORMAT_VERSION])),
+        'frame_raw': tf.train.Feature(bytes_list=tf.train.BytesList(value=[frame_raw])),
+        'frame_shape': tf.train.Feature(int64_list=tf.train.Int64List(value=list(frame.shape))),
+        'frame_dtype': tf.train.Feature(bytes_list=tf.train.BytesList(value=[b'uint8'])),
+        'frame_compression': tf.train.Feature(bytes_list=tf.train.BytesList(value=[compression.encode()]))
+    }
+
+
+def decode_frame_features(feature):
+    """Decodes the uint8 frame of a parsed tf.Example's feature map, of either format version."""
+    if 'format_version' not in feature:
+        return decode_pickled_np_array(feature['frame_bytes'].bytes_list.value[0])
+
+    format_version = feature['format_version'].int64_list.value[0]
+    if format_version != FRAME_RECORD_FORMAT_VERSION:
+        raise ValueError("Unsupported frame record format version {}".format(format_version))
+
+    frame_raw = feature['frame_raw'].bytes_list.value[0]
+    if feature['frame_compression'].bytes_list.value[0] == b'ZLIB':
+        frame_raw = zlib.decompress(frame_raw)
+
+    return np.frombuffer(frame_raw, dtype=np.dtype(feature['frame_dtype'].bytes_list.value[0].decode())).reshape(
+        feature['frame_shape'].int64_list.value)
+
+
+def frame_feature_spec():
+    """tf.parse_single_example features for decode_frame_tensor, covering both format versions."""
+    return {
+        'format_version': tf.FixedLenFeature([], tf.int64, default_value=1),
+        'frame_raw': tf.FixedLenFeature([], tf.string, default_value=''),
+        'frame_shape': tf.VarLenFeature(tf.int64),
+        'frame_compression': tf.FixedLenFeature([], tf.string, default_value=''),
+        'frame_bytes': tf.FixedLenFeature([], tf.string, default_value='')
+    }
+
+
+def decode_frame_tensor(parsed):
+    """uint8 frame tensor from the features of frame_feature_spec.
+
+    Version 2 frames are decoded with decode_raw (and decode_compressed if they are compressed). Only version 1
+    frames go through pickle in a py_func.
+    """
+
+    def decode_raw_frame():
+        frame_raw = tf.cond(tf.equal(parsed['frame_compression'], 'ZLIB'),
+                            lambda: tf.decode_compressed(parsed['frame_raw'], compression_type='ZLIB'),
+                            lambda: parsed['frame_raw'])
+        frame_shape = tf.sparse_tensor_to_dense(parsed['frame_shape'])
+        return tf.reshape(tf.decode_raw(frame_raw, tf.uint8), frame_shape)
+
+    def decode_pickled_frame():
+        return tf.py_func(func=decode_pickled_np_array, inp=[parsed['frame_bytes']],
+                          Tout=tf.uint8, stateful=False, name='decode_np_bytes')
+
+    return tf.cond(tf.equal(parsed['format_version'], 1), decode_pickled_frame, decode_raw_frame)
+
+
+def migrate_frame_record_file(source_file_name, destination_file_name, compression=''):
+    """Rewrites a tfrecord file's frames in the current format, keeping every other feature as it is.
+
+    Returns:
+        number of records written
+    """
+    record_count = 0
+    with tf.python_io.TFRecordWriter(destination_file_name) as writer:
+        for serialized in tf.python_io.tf_record_iterator(source_file_name):
+            example = tf.train.Example.FromString(serialized)
+            feature = example.features.feature
+
+            frame = decode_frame_features(feature)
+
+            for frame_feature_name in frame_feature_spec():
+                if frame_feature_name in feature:
+                    del feature[frame_feature_name]
+            for name, value in frame_features(frame, compression).items():
+                feature[name].CopyFrom(value)
+
+            writer.write(example.SerializeToString())
+            record_count += 1
+
+    return record_count
+
+
+def migrate_frame_record_dir(source_dir, destination_dir, compression=''):
+    """Migrates every .tfrecords file in source_dir to destination_dir, which may be source_dir itself."""
+    file_names = sorted(f for f in os.listdir(source_dir) if f.endswith('.tfrecords'))
+    if len(file_names) <= 0:
+        raise FileNotFoundError("No tfrecords were found at {}".format(source_dir))
+
+    os.makedirs(destination_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    record_count = 0
+    source_bytes = 0
+    destination_bytes = 0
+
+    for file_name in file_names:
+        source_file_name = os.path.join(source_dir, file_name)
+        destination_file_name = os.path.join(destination_dir, file_name)
+
+        # Written next to the destination first, so that an interrupted migration never leaves a partial file.
+        # The name doesn't look like a numbered record file to get_numbered_tfrecord_file_names_from_directory.
+        partial_file_name = os.path.join(destination_dir, '.partial_' + file_name)
+        record_count += migrate_frame_record_file(source_file_name, partial_file_name, compression)
+
+        source_bytes += os.path.getsize(source_file_name)
+        destination_bytes += os.path.getsize(partial_file_name)
+        shutil.move(partial_file_name, destination_file_name)
+
+    seconds = time.perf_counter() - start
+    logger.info("Migrated {} records in {} files from {} to {} in {:.1f}s ({:.0f} records/s), "
+                "{:.1f}MB -> {:.1f}MB".format(record_count, len(file_names), source_dir, destination_dir, seconds,
+                                              record_count / seconds, source_bytes / 1e6, destination_bytes / 1e6))
+
+    return record_count
+
+
+if __name__ == '__main__':
+    from directed_exploration.logging_ops import init_logging
+    init_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source_dir", help="Directory of tfrecords to migrate")
+    parser.add_argument("destination_dir", help="Directory to write the migrated tfrecords to. May be source_dir "
+                                                "to migrate in place")
+    parser.add_argument("--compression", help="Compress each record's frame, 'none' or 'ZLIB'",
+                        type=parse_frame_compression, default='none')
+    args = parser.parse_args()
+
+    migrate_frame_record_dir(args.source_dir, args.destination_dir, compression=args.compression)
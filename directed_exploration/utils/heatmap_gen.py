@@ -1,17 +1,38 @@
 import numpy as np
 import os
 from scipy.stats import gaussian_kde
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.image import imread
+from matplotlib.ticker import NullLocator
+from matplotlib import cm
 from directed_exploration.logging_ops import init_logging
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def get_npy_record_file_names(directory, file_prefix):
+    # Match on the prefix plus a separator so that e.g. 'env_step1' doesn't also pick up 'env_step100000_...'
+    return [file_name for file_name in os.listdir(directory)
+            if file_name.endswith(".npy") and
+            (file_name.startswith(file_prefix + '_') or file_name == file_prefix + '.npy')]
+
+
+def delete_npy_records(directory, file_prefix, file_names=None):
+    if file_names is None:
+        file_names = get_npy_record_file_names(directory, file_prefix)
+
+    for file_name in file_names:
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError:
+            pass
+
+
 def generate_boxpush_heatmap_from_npy_records(directory, file_prefix, delete_records=False):
 
-    file_names = [file_name for file_name in os.listdir(directory)
-                  if file_name.endswith(".npy") and file_name.startswith(file_prefix)]
+    file_names = get_npy_record_file_names(directory, file_prefix)
 
     location_records = np.concatenate([np.load(os.path.join(directory, file_name)) for file_name in file_names], axis=0)
 
@@ -30,27 +51,27 @@ def generate_boxpush_heatmap_from_npy_records(directory, file_prefix, delete_rec
     idx = z.argsort()
     x, y, z = location_records[0, idx], location_records[1, idx], z[idx]
 
-    plt.figure(figsize=(3, 3))
-    plt.scatter(x, y, c=z, s=80, edgecolors='',  cmap=plt.cm.jet, alpha=0.7)
-    plt.xlim(0, 100)
-    plt.ylim(0, 100)
-
-    im = plt.imread(os.path.join(directory, 'level.png'))
-    plt.imshow(im, extent=[0, 100, 0, 100], aspect='auto')
-    plt.axis('equal')
-    plt.axis('off')
-    plt.margins(0, 0)
-    plt.gca().xaxis.set_major_locator(plt.NullLocator())
-    plt.gca().yaxis.set_major_locator(plt.NullLocator())
+    # Uses a standalone Agg figure instead of pyplot so this can run off the main thread
+    # and the figure is freed once it goes out of scope.
+    fig = Figure(figsize=(3, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.scatter(x, y, c=z, s=80, edgecolors='',  cmap=cm.jet, alpha=0.7)
+    ax.set_xlim(0, 100)
+    ax.set_ylim(0, 100)
+
+    im = imread(os.path.join(directory, 'level.png'))
+    ax.imshow(im, extent=[0, 100, 0, 100], aspect='auto')
+    ax.axis('equal')
+    ax.axis('off')
+    ax.margins(0, 0)
+    ax.xaxis.set_major_locator(NullLocator())
+    ax.yaxis.set_major_locator(NullLocator())
     heatmap_image_path = os.path.join(directory, "{}_heatmap.png".format(file_prefix))
-    plt.savefig(heatmap_image_path, transparent=True, bbox_inches='tight', pad_inches=0)
+    fig.savefig(heatmap_image_path, transparent=True, bbox_inches='tight', pad_inches=0)
 
     if delete_records:
-        for file_name in file_names:
-            try:
-                os.remove(os.path.join(directory, file_name))
-            except OSError:
-                pass
+        delete_npy_records(directory, file_prefix, file_names)
 
     return heatmap_image_path
 
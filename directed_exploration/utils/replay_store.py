@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceReplayStore:
+    """Disk-backed ring buffer of fixed length training sequences for the curiosity sim.
+
+    Each row holds one env's sequence in the same batch-major layout as SequenceRingBuffer:
+        observations:   [seq_length + 1, *obs_shape] (obs_dtype, uint8 by default)
+        actions:        [seq_length, action_dim] (float32 one-hot)
+        dones:          [seq_length + 1] (float32)
+        initial_states: [state_size] (float32), the rnn state the sequence was trained from
+
+    Arrays are numpy memmaps under directory, created on the first add. The initial state size isn't known until
+    the first non-None states are added; rows added before that (or with None states) hold zero states.
+
+    Sampling is uniform, or prioritized (proportional to priority ** priority_alpha). New rows get the max priority
+    seen so far so they are sampled at least once soon after being added.
+    """
+
+    def __init__(self, directory, capacity, seq_length, obs_shape, action_dim, obs_dtype=np.uint8,
+                 prioritized=False, priority_alpha=0.6, priority_epsilon=1e-6):
+        assert capacity > 0
+
+        self.directory = directory
+        self.capacity = capacity
+        self.seq_length = seq_length
+        self.obs_shape = tuple(obs_shape)
+        self.action_dim = action_dim
+        self.obs_dtype = obs_dtype
+
+        self.prioritized = prioritized
+        self.priority_alpha = priority_alpha
+        self.priority_epsilon = priority_epsilon
+
+        self.observations = None
+        self.actions = None
+        self.dones = None
+        self.initial_states = None
+
+        self.priorities = np.zeros(shape=capacity, dtype=np.float64)
+        self._max_priority = 1.0
+
+        self.next_index = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _open_memmap(self, name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(self.directory, 'replay_{}.npy'.format(name)),
+                                         mode='w+', dtype=dtype, shape=shape)
+
+    def _allocate(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.observations = self._open_memmap('observations',
+                                              (self.capacity, self.seq_length + 1, *self.obs_shape), self.obs_dtype)
+        self.actions = self._open_memmap('actions', (self.capacity, self.seq_length, self.action_dim), np.float32)
+        self.dones = self._open_memmap('dones', (self.capacity, self.seq_length + 1), np.float32)
+
+        logger.info("Allocated replay store for {} sequences in {}".format(self.capacity, self.directory))
+
+    def add(self, observations, actions, dones, initial_states=None):
+        """Adds a batch of sequences, overwriting the oldest ones once the store is full."""
+        assert observations.shape[1:] == (self.seq_length + 1, *self.obs_shape)
+        assert actions.shape[1:] == (self.seq_length, self.action_dim)
+        assert dones.shape[1:] == (self.seq_length + 1,)
+
+        if self.observations is None:
+            self._allocate()
+
+        if initial_states is not None and self.initial_states is None:
+            self.initial_states = self._open_memmap('initial_states', (self.capacity, initial_states.shape[1]),
+                                                    np.float32)
+
+        num_sequences = len(observations)
+        assert num_sequences <= self.capacity
+
+        indexes = (self.next_index + np.arange(num_sequences)) % self.capacity
+
+        self.observations[indexes] = observations
+        self.actions[indexes] = actions
+        self.dones[indexes] = dones
+
+        if self.initial_states is not None:
+            self.initial_states[indexes] = initial_states if initial_states is not None else 0
+
+        self.priorities[indexes] = self._max_priority
+
+        self.next_index = (self.next_index + num_sequences) % self.capacity
+        self.size = min(self.size + num_sequences, self.capacity)
+
+        return indexes
+
+    def sample(self, batch_size, random_state=np.random):
+        """Returns (indexes, observations, actions, dones, initial_states) for batch_size stored sequences.
+
+        initial_states is None if no states have been stored yet.
+        """
+        assert self.size > 0
+
+        if self.prioritized:
+            probabilities = self.priorities[:self.size] ** self.priority_alpha
+            probabilities /= probabilities.sum()
+            indexes = random_state.choice(self.size, size=batch_size, p=probabilities)
+        else:
+            indexes = random_state.randint(0, self.size, size=batch_size)
+
+        # Reading in index order keeps memmap access mostly sequential.
+        indexes = np.sort(indexes)
+
+        initial_states = None
+        if self.initial_states is not None:
+            initial_states = self.initial_states[indexes]
+
+        return indexes, self.observations[indexes], self.actions[indexes], self.dones[indexes], initial_states
+
+    def update_priorities(self, indexes, priorities):
+        priorities = np.abs(np.broadcast_to(priorities, np.shape(indexes))) + self.priority_epsilon
+        self.priorities[indexes] = priorities
+        self._max_priority = max(self._max_priority, float(np.max(priorities)))
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class SequenceRingBuffer:
+    """Preallocated, batch-major storage for sequential curiosity training minibatches.
+
+    Each of the num_slots slots holds one minibatch:
+        observations: [num_envs, seq_length + 1, *obs_shape] (obs_dtype, uint8 by default)
+        actions:      [num_envs, seq_length, action_dim] (float32 one-hot)
+        dones:        [num_envs, seq_length + 1] (float32)
+
+    Steps are written directly into the current slot. Once a slot is finished, views of it are handed out
+    and writing moves on to the next slot, so a slot is only overwritten num_slots minibatches later.
+    """
+
+    def __init__(self, num_slots, num_envs, seq_length, obs_shape, action_dim, obs_dtype=np.uint8):
+        assert num_slots > 0
+        assert seq_length > 0
+
+        self.num_slots = num_slots
+        self.num_envs = num_envs
+        self.seq_length = seq_length
+        self.action_dim = action_dim
+
+        self.observations = np.zeros(shape=(num_slots, num_envs, seq_length + 1, *obs_shape), dtype=obs_dtype)
+        self.actions = np.zeros(shape=(num_slots, num_envs, seq_length, action_dim), dtype=np.float32)
+        self.dones = np.zeros(shape=(num_slots, num_envs, seq_length + 1), dtype=np.float32)
+
+        self._env_indexes = np.arange(num_envs)
+
+        self.slot = 0
+        self.t = 0
+
+    def __len__(self):
+        return self.t
+
+    def is_full(self):
+        return self.t >= self.seq_length
+
+    def clear(self):
+        self.t = 0
+
+    def write_step(self, obs, actions, dones):
+        """Writes observations, (integer) actions and dones at time t into the current slot."""
+        assert not self.is_full()
+
+        self.observations[self.slot, :, self.t] = obs
+        self.dones[self.slot, :, self.t] = dones
+
+        actions_at_t = self.actions[self.slot, :, self.t]
+        actions_at_t.fill(0)
+        actions_at_t[self._env_indexes, np.asarray(actions, dtype=np.int64)] = 1
+
+        self.t += 1
+
+    def finish(self, final_obs, final_dones):
+        """Writes the final (target only) observations and dones and returns views of the completed slot.
+
+        Returns:
+            (observations, actions, dones) for the completed minibatch, batch-major.
+        """
+        assert self.is_full()
+
+        slot = self.slot
+
+        self.observations[slot, :, self.t] = final_obs
+        self.dones[slot, :, self.t] = final_dones
+
+        self.slot = (self.slot + 1) % self.num_slots
+        self.t = 0
+
+        return self.observations[slot], self.actions[slot], self.dones[slot]
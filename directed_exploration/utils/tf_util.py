@@ -1,10 +1,68 @@
 import tensorflow as tf
+from tensorflow.contrib.rnn.python.ops import lstm_ops
 
+LSTM_BACKENDS = ('scan', 'block_fused')
 
-def log_tensorboard_scalar_summaries(summary_writer, values, tags, step):
 
+def log_tensorboard_scalar_summaries(summary_writer, values, tags, step, flush=False):
+    # add_summary only queues the event. The writer's own thread writes queued events out every flush_secs,
+    # so flushing here is only needed when they have to be on disk right away.
     summary = tf.Summary()
     for tag, value in zip(tags, values):
         summary.value.add(tag=tag, simple_value=value)
     summary_writer.add_summary(summary, step)
-    summary_writer.flush()
+    if flush:
+        summary_writer.flush()
+
+
+def block_fused_lstm(input_sequence_batch, retain_state_mask_sequence_batch, c, h, wx, wh, b, scan_fallback_fn):
+    """Runs an LSTM over a whole time-major sequence with the fused BlockLSTM kernel.
+
+    Computes the same function as the tf.scan LSTM step in dynamic_lstm (gate order i, f, o, u in wx/wh/b, no
+    forget bias, no peepholes or cell clipping) using the existing variables, so checkpoints are interchangeable.
+
+    The kernel can't reset the state partway through a sequence, so the retain state mask is applied to the
+    initial state only. If any later mask entry is zero, the scan_fallback_fn() graph is used for the whole
+    batch instead. Whether the fused kernel was used is written to a 'block_lstm_fused' scalar summary (1 if it
+    was, 0 if the batch fell back to scan), so its smoothed value is the rate of the fused path.
+
+    Args:
+        input_sequence_batch: [time, batch, nin]
+        retain_state_mask_sequence_batch: [time, batch, 1]
+        c, h: [batch, num_hidden] initial states
+        scan_fallback_fn: builds the tf.scan LSTM and returns (c_sequence, h_sequence), each [time, batch, num_hidden]
+
+    Returns:
+        (c_sequence, h_sequence), each [time, batch, num_hidden]
+    """
+    num_hidden = h.get_shape()[1].value
+
+    def _block_lstm():
+        # BlockLSTM expects one [nin + num_hidden, 4 * num_hidden] weight matrix with gates ordered i, u, f, o.
+        def icfo(weights):
+            i, f, o, u = tf.split(weights, num_or_size_splits=4, axis=-1)
+            return tf.concat([i, u, f, o], axis=-1)
+
+        w = icfo(tf.concat([wx, wh], axis=0))
+        no_peephole = tf.zeros(shape=[num_hidden], dtype=tf.float32)
+
+        _, c_sequence, _, _, _, _, h_sequence = lstm_ops.gen_lstm_ops.block_lstm(
+            seq_len_max=tf.cast(tf.shape(input_sequence_batch)[0], tf.int64),
+            x=input_sequence_batch,
+            cs_prev=c * retain_state_mask_sequence_batch[0],
+            h_prev=h * retain_state_mask_sequence_batch[0],
+            w=w,
+            wci=no_peephole,
+            wcf=no_peephole,
+            wco=no_peephole,
+            b=icfo(b),
+            forget_bias=0.0,
+            cell_clip=-1.0,
+            use_peephole=False)
+
+        return c_sequence, h_sequence
+
+    no_resets_after_first_step = tf.reduce_all(tf.equal(retain_state_mask_sequence_batch[1:], 1.0))
+    tf.summary.scalar('block_lstm_fused', tf.cast(no_resets_after_first_step, tf.float32))
+
+    return tf.cond(no_resets_after_first_step, _block_lstm, scan_fallback_fn)
@@ -0,0 +1,85 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer:
+    """Low overhead wall clock timers for named phases, with rolling percentiles over the last window_size samples.
+
+    Samples can be recorded from any thread.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+
+        self._lock = threading.Lock()
+        self._samples = OrderedDict()
+        self._total_seconds = {}
+        self._counts = {}
+
+    @contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            samples = self._samples.get(phase)
+            if samples is None:
+                samples = self._samples[phase] = deque(maxlen=self.window_size)
+                self._total_seconds[phase] = 0.0
+                self._counts[phase] = 0
+
+            samples.append(seconds)
+            self._total_seconds[phase] += seconds
+            self._counts[phase] += 1
+
+    def phases(self):
+        with self._lock:
+            return list(self._samples.keys())
+
+    def percentiles(self, phase):
+        """Returns (p50, p95, p99) in seconds over the current window, or None if nothing was recorded yet."""
+        with self._lock:
+            samples = list(self._samples.get(phase, ()))
+        if len(samples) == 0:
+            return None
+        return tuple(np.percentile(samples, self.PERCENTILES))
+
+    def write_summaries(self, summary_writer, step, tag_prefix='timing'):
+        summary = tf.Summary()
+        for phase in self.phases():
+            phase_percentiles = self.percentiles(phase)
+            if phase_percentiles is None:
+                continue
+            for percentile, seconds in zip(self.PERCENTILES, phase_percentiles):
+                summary.value.add(tag='{}/{}/p{}_ms'.format(tag_prefix, phase, percentile),
+                                  simple_value=seconds * 1000)
+        summary_writer.add_summary(summary, step)
+
+    def report(self):
+        lines = ["{:>16s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+            'phase', 'count', 'total s', 'p50 ms', 'p95 ms', 'p99 ms')]
+
+        for phase in self.phases():
+            phase_percentiles = self.percentiles(phase)
+            if phase_percentiles is None:
+                continue
+            p50, p95, p99 = (seconds * 1000 for seconds in phase_percentiles)
+            with self._lock:
+                count, total_seconds = self._counts[phase], self._total_seconds[phase]
+            lines.append("{:>16s} {:>8d} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                phase, count, total_seconds, p50, p95, p99))
+
+        return "\n".join(lines)
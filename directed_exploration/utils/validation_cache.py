@@ -0,0 +1,210 @@
+"""
+Decodes a directory of validation tfrecords once into memory-mapped uint8 frame and action index arrays.
+
+Validation sequences are read back as zero-copy slices of the arrays, split exactly like the tfrecord input pipeline
+splits them (consecutive runs of VALIDATION_SEQUENCE_LENGTH frames of one record file). The cache records the size
+and modification time of every record file it was built from and is ignored once they change.
+
+    python -m directed_exploration.utils.validation_cache <validation data dir> --action-dim 5
+"""
+
+from directed_exploration.utils.frame_records import decode_frame_features
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Frames per validation sequence. The rnn state is reset at the start of each.
+VALIDATION_SEQUENCE_LENGTH = 1000
+
+VALIDATION_CACHE_FOLDER_NAME = 'validation_cache'
+VALIDATION_CACHE_VERSION = 1
+
+INDEX_FILE = 'index.json'
+FRAMES_FILE = 'frames.npy'
+ACTIONS_FILE = 'actions.npy'
+SEQUENCES_FILE = 'sequences.npy'
+
+
+def get_numbered_tfrecord_file_names_from_directory(dir, prefix):
+    dir_files = os.listdir(dir)
+    dir_files = sorted(filter(lambda f: str.isdigit(re.split('[_.]+', f)[1]) and f.startswith(prefix), dir_files),
+                       key=lambda f: int(re.split('[_.]+', f)[1]))
+    return list(map(lambda f: os.path.join(dir, f), dir_files))
+
+
+def read_validation_record_file(file_name, action_dim):
+    """Yields (uint8 frame, action index) for each record of a validation tfrecord file, outside of any graph."""
+    for serialized in tf.python_io.tf_record_iterator(file_name):
+        features = tf.train.Example.FromString(serialized).features.feature
+
+        one_hot_action = features['action_at_frame'].float_list.value
+        assert len(one_hot_action) == action_dim
+
+        yield decode_frame_features(features), int(np.argmax(one_hot_action))
+
+
+def _record_fingerprints(record_files):
+    fingerprints = []
+    for file_name in record_files:
+        stat = os.stat(file_name)
+        fingerprints.append({'file': os.path.basename(file_name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    return fingerprints
+
+
+def default_cache_dir(data_dir):
+    return os.path.join(data_dir, VALIDATION_CACHE_FOLDER_NAME)
+
+
+def build_validation_cache(data_dir, action_dim, cache_dir=None):
+    """Decodes every numbered tfrecord in data_dir into a validation cache at cache_dir, replacing any old one.
+
+    Returns:
+        the ValidationCache
+    """
+    cache_dir = cache_dir if cache_dir is not None else default_cache_dir(data_dir)
+
+    record_files = get_numbered_tfrecord_file_names_from_directory(data_dir, '')
+    if len(record_files) <= 0:
+        raise FileNotFoundError("No usable tfrecords were found at {}".format(data_dir))
+
+    start = time.perf_counter()
+    fingerprints = _record_fingerprints(record_files)
+
+    # Records are counted first so that the frame array can be allocated at its final size.
+    record_counts = [sum(1 for _ in tf.python_io.tf_record_iterator(file_name)) for file_name in record_files]
+    if sum(record_counts) <= 0:
+        raise ValueError("The tfrecords at {} are all empty".format(data_dir))
+    first_record_file = next(file_name for file_name, count in zip(record_files, record_counts) if count > 0)
+    frame_shape = next(read_validation_record_file(first_record_file, action_dim))[0].shape
+
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '_partial_', dir=parent_dir)
+
+    try:
+        frames = np.lib.format.open_memmap(os.path.join(build_dir, FRAMES_FILE), mode='w+', dtype=np.uint8,
+                                           shape=(sum(record_counts), *frame_shape))
+        actions = np.lib.format.open_memmap(os.path.join(build_dir, ACTIONS_FILE), mode='w+', dtype=np.int32,
+                                            shape=(sum(record_counts),))
+
+        # (record file index, first frame, end frame) of each sequence
+        sequences = []
+        offset = 0
+        for record_index, (file_name, record_count) in enumerate(zip(record_files, record_counts)):
+            for i, (frame, action) in enumerate(read_validation_record_file(file_name, action_dim)):
+                frames[offset + i] = frame
+                actions[offset + i] = action
+
+            for sequence_start in range(0, record_count, VALIDATION_SEQUENCE_LENGTH):
+                sequences.append((record_index, offset + sequence_start,
+                                  offset + min(sequence_start + VALIDATION_SEQUENCE_LENGTH, record_count)))
+            offset += record_count
+
+        frames.flush()
+        actions.flush()
+        del frames, actions
+
+        np.save(os.path.join(build_dir, SEQUENCES_FILE), np.asarray(sequences, dtype=np.int64).reshape(-1, 3))
+
+        with open(os.path.join(build_dir, INDEX_FILE), 'w') as index_file:
+            json.dump({'version': VALIDATION_CACHE_VERSION,
+                       'action_dim': action_dim,
+                       'frame_shape': list(frame_shape),
+                       'sequence_length': VALIDATION_SEQUENCE_LENGTH,
+                       'records': fingerprints}, index_file, indent=2)
+
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(build_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    logger.info("Built validation cache of {} frames in {} sequences from {} record files at {} in {:.1f}s".format(
+        offset, len(sequences), len(record_files), cache_dir, time.perf_counter() - start))
+
+    return ValidationCache(cache_dir)
+
+
+def open_validation_cache(data_dir, action_dim, cache_dir=None):
+    """Returns the ValidationCache of data_dir, or None if there isn't one that matches its current record files."""
+    cache_dir = cache_dir if cache_dir is not None else default_cache_dir(data_dir)
+
+    if not os.path.exists(os.path.join(cache_dir, INDEX_FILE)):
+        return None
+
+    cache = ValidationCache(cache_dir)
+
+    record_files = get_numbered_tfrecord_file_names_from_directory(data_dir, '')
+    if cache.version != VALIDATION_CACHE_VERSION or cache.action_dim != action_dim or \
+            cache.sequence_length != VALIDATION_SEQUENCE_LENGTH or \
+            cache.record_fingerprints != _record_fingerprints(record_files):
+        logger.warning("Ignoring out of date validation cache at {}".format(cache_dir))
+        return None
+
+    return cache
+
+
+def open_or_build_validation_cache(data_dir, action_dim, cache_dir=None):
+    cache = open_validation_cache(data_dir, action_dim, cache_dir)
+    if cache is None:
+        cache = build_validation_cache(data_dir, action_dim, cache_dir)
+    return cache
+
+
+class ValidationCache:
+    """Read-only view of a cache written by build_validation_cache.
+
+    frames: [total frames, *frame_shape] uint8 memmap
+    actions: [total frames] int32 memmap of action indexes
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+        with open(os.path.join(cache_dir, INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+
+        self.version = index['version']
+        self.action_dim = index['action_dim']
+        self.frame_shape = tuple(index['frame_shape'])
+        self.sequence_length = index['sequence_length']
+        self.record_fingerprints = index['records']
+
+        self.frames = np.load(os.path.join(cache_dir, FRAMES_FILE), mmap_mode='r')
+        self.actions = np.load(os.path.join(cache_dir, ACTIONS_FILE), mmap_mode='r')
+        self.sequence_bounds = np.load(os.path.join(cache_dir, SEQUENCES_FILE))
+
+    def __len__(self):
+        return len(self.sequence_bounds)
+
+    def iterate_sequences(self, data_dir):
+        """Yields (record file name in data_dir, frames, actions) for each sequence, as slices of the memmaps."""
+        for record_index, start, end in self.sequence_bounds:
+            file_name = os.path.join(data_dir, self.record_fingerprints[record_index]['file'])
+            yield file_name, self.frames[start:end], self.actions[start:end]
+
+
+if __name__ == '__main__':
+    from directed_exploration.logging_ops import init_logging
+    init_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="Directory of numbered validation tfrecords")
+    parser.add_argument("--action-dim", help="Number of actions the records' one-hot actions have",
+                        type=int, required=True)
+    parser.add_argument("--cache-dir", help="Where to write the cache. Defaults to a '{}' folder in data_dir".format(
+                        VALIDATION_CACHE_FOLDER_NAME), default=None)
+    args = parser.parse_args()
+
+    build_validation_cache(args.data_dir, args.action_dim, args.cache_dir)
@@ -1,17 +1,24 @@
 from directed_exploration.sep_vae_rnn.vae import VAE
 from directed_exploration.sep_vae_rnn.state_rnn import StateRNN
-import os
-import re
+from directed_exploration.utils.frame_records import frame_feature_spec, decode_frame_tensor
+from directed_exploration.utils.validation_cache import VALIDATION_SEQUENCE_LENGTH, \
+    get_numbered_tfrecord_file_names_from_directory, open_validation_cache
+from collections import OrderedDict
 import tensorflow as tf
-import pickle
 import numpy as np
 import multiprocessing
+import threading
+import weakref
 import logging
 
 import cv2
 
 logger = logging.getLogger(__name__)
 
+# graph -> {number of actions: validation input pipeline}, see get_validation_pipeline.
+_validation_pipelines = weakref.WeakKeyDictionary()
+_validation_pipelines_lock = threading.Lock()
+
 
 def debug_imshow_image_with_action(window_label, frame, action):
     font = cv2.FONT_HERSHEY_SIMPLEX
@@ -32,31 +39,18 @@ def debug_imshow_image_with_action(window_label, frame, action):
     cv2.imshow(window_label, frame[:, :, ::-1])
 
 
-def get_numbered_tfrecord_file_names_from_directory(dir, prefix):
-    dir_files = os.listdir(dir)
-    dir_files = sorted(filter(lambda f: str.isdigit(re.split('[_.]+', f)[1]) and f.startswith(prefix), dir_files),
-                       key=lambda f: int(re.split('[_.]+', f)[1]))
-    return list(map(lambda f: os.path.join(dir, f), dir_files))
-
-
 def get_validation_tfrecord_input_fn(allowed_action_space):
 
-    def decode_pickled_np_array(np_bytes):
-        return pickle.loads(np_bytes).astype(np.float32)
-
     def parse_fn(example):
         example_fmt = {
             "action_at_frame": tf.FixedLenFeature([allowed_action_space.n], tf.float32),
-            "frame_bytes": tf.FixedLenFeature([], tf.string)
+            **frame_feature_spec()
         }
 
         parsed = tf.parse_single_example(example, example_fmt)
 
         action = parsed["action_at_frame"]
-        frame_bytes = parsed["frame_bytes"]
-
-        frame = tf.py_func(func=decode_pickled_np_array, inp=[frame_bytes],
-                           Tout=tf.float32, stateful=False, name='decode_np_bytes')
+        frame = decode_frame_tensor(parsed)
 
         return frame, action
 
@@ -64,7 +58,7 @@ def get_validation_tfrecord_input_fn(allowed_action_space):
         file_name_placeholder = tf.placeholder(dtype=tf.string, shape=[], name='file_name')
         dataset = tf.data.TFRecordDataset(file_name_placeholder)
         dataset = dataset.map(map_func=parse_fn, num_parallel_calls=multiprocessing.cpu_count())
-        dataset = dataset.batch(1000)
+        dataset = dataset.batch(VALIDATION_SEQUENCE_LENGTH)
         dataset = dataset.prefetch(buffer_size=4)
         iterator = dataset.make_initializable_iterator()
         return iterator.get_next(), iterator.initializer, file_name_placeholder
@@ -72,145 +66,277 @@ def get_validation_tfrecord_input_fn(allowed_action_space):
     return input_fn
 
 
-def validate_vae_state_rnn_pair_on_tf_records(data_dir, vae, state_rnn, sess, allowed_action_space):
-    with sess.as_default():
-        with tf.name_scope('input_functions'):
-            val_input_fn_iter, val_input_fn_init_op, file_name_placeholder = get_validation_tfrecord_input_fn(allowed_action_space)()
+def get_validation_pipeline(sess, allowed_action_space):
+    """Returns (next batch, iterator initializer, file name placeholder) of the validation input pipeline in
+    sess.graph, building it on first use.
 
-        tfrecord_prefix = ''
-        tfrecord_files = get_numbered_tfrecord_file_names_from_directory(data_dir, tfrecord_prefix)
+    The pipeline is built once per graph and action space. Its iterator is reinitialized with each record file, so
+    validation rounds don't add ops to the graph. To validate on a graph after graph.finalize(), call this first.
+    """
+    graph = sess.graph
 
-        if len(tfrecord_files) <= 0:
-            raise FileNotFoundError("No usable tfrecords with prefix \'{}\' were found at {}".format(
-                tfrecord_prefix, data_dir)
-            )
+    with _validation_pipelines_lock:
+        graph_pipelines = _validation_pipelines.setdefault(graph, {})
 
-        avg_loss = 0
-        frames_tested_on = 0
+        if allowed_action_space.n not in graph_pipelines:
+            if graph.finalized:
+                raise RuntimeError("The validation input pipeline for {} actions wasn't built before the graph was "
+                                   "finalized".format(allowed_action_space.n))
 
-        for file_name in tfrecord_files:
-            sess.run(val_input_fn_init_op, feed_dict={file_name_placeholder: file_name})
+            with graph.as_default(), tf.name_scope('input_functions'):
+                graph_pipelines[allowed_action_space.n] = get_validation_tfrecord_input_fn(allowed_action_space)()
 
-            while True:
-                try:
-                    batch_frames, batch_actions = sess.run(val_input_fn_iter)
-                except tf.errors.OutOfRangeError:
-                    break
+        return graph_pipelines[allowed_action_space.n]
 
-                if batch_actions.shape[1] == allowed_action_space.n:
-                    # convert from one hot
-                    batch_actions = np.argmax(batch_actions, axis=1)
 
-                batch_actions = np.squeeze(batch_actions)
+def iterate_validation_sequences(data_dir, sess, allowed_action_space):
+    """Yields (file name, frames, actions) validation sequences from the numbered tfrecords in data_dir.
 
-                assert len(batch_actions.shape) == 1
+    Each sequence is a batch of consecutive frames from one record file, with actions as action indexes. If data_dir
+    has an up to date validation cache (see utils.validation_cache), sequences are read-only slices of it and the
+    records aren't decoded again.
+    """
+    cache = open_validation_cache(data_dir, allowed_action_space.n)
+    if cache is not None:
+        logger.debug("Validating on the validation cache at {}".format(cache.cache_dir))
+        yield from cache.iterate_sequences(data_dir)
+        return
 
-                for action in batch_actions:
-                    assert allowed_action_space.contains(action)
+    val_input_fn_iter, val_input_fn_init_op, file_name_placeholder = get_validation_pipeline(sess,
+                                                                                            allowed_action_space)
 
-                input_frames = batch_frames[:-1]
-                input_actions = batch_actions[:-1]
+    tfrecord_prefix = ''
+    tfrecord_files = get_numbered_tfrecord_file_names_from_directory(data_dir, tfrecord_prefix)
 
-                input_frames_encoded = vae.encode_frames(input_frames)
+    if len(tfrecord_files) <= 0:
+        raise FileNotFoundError("No usable tfrecords with prefix \'{}\' were found at {}".format(
+            tfrecord_prefix, data_dir)
+        )
 
-                # frame_predictions_encoded = state_rnn.predict_on_frames(
-                #     z_sequences=np.expand_dims(input_frames_encoded, 0),
-                #     action_sequences=np.expand_dims(input_actions, 0),
-                #     states_mask=[True for _ in range(len(input_frames_encoded))]
-                #
-                # )
+    for file_name in tfrecord_files:
+        sess.run(val_input_fn_init_op, feed_dict={file_name_placeholder: file_name})
 
-                frame_predictions_encoded = np.empty_like(input_frames_encoded)
-                state = None
-                for i, (input_code, action) in enumerate(zip(input_frames_encoded, input_actions)):
-                    predicted_code, state = state_rnn.predict_on_frame_batch(
-                        z_codes=np.expand_dims(input_code, 0),
-                        actions=np.expand_dims(action, 0),
-                        states_mask=[[True]],
-                        states_in=state
-                    )
+        while True:
+            try:
+                batch_frames, batch_actions = sess.run(val_input_fn_iter)
+            except tf.errors.OutOfRangeError:
+                break
 
-                    frame_predictions_encoded[i] = np.reshape(predicted_code, newshape=vae.latent_dim)
+            if batch_actions.shape[1] == allowed_action_space.n:
+                # convert from one hot
+                batch_actions = np.argmax(batch_actions, axis=1)
 
-                losses = vae.get_loss_for_decoded_frames(z_codes=np.reshape(frame_predictions_encoded,
-                                                        newshape=[-1, vae.latent_dim]),
-                                                         target_frames=batch_frames[1:])
-                sequence_mean_loss = np.mean(losses)
+            batch_actions = np.squeeze(batch_actions)
 
-                logger.debug('loss of {} on sequence of length {}'.format(sequence_mean_loss, len(losses)))
+            assert len(batch_actions.shape) == 1
 
-                new_total_frames = frames_tested_on + len(losses)
-                avg_loss = (avg_loss*frames_tested_on + sequence_mean_loss * len(losses)) / new_total_frames
-                frames_tested_on = new_total_frames
+            for action in batch_actions:
+                assert allowed_action_space.contains(action)
 
-        return avg_loss
+            yield file_name, batch_frames, batch_actions
 
-def validate_full_rnn_on_tf_records(data_dir, rnn, sess, allowed_action_space):
-    with sess.as_default():
-        with tf.name_scope('input_functions'):
-            val_input_fn_iter, val_input_fn_init_op, file_name_placeholder = get_validation_tfrecord_input_fn(allowed_action_space)()
 
-        tfrecord_prefix = ''
-        tfrecord_files = get_numbered_tfrecord_file_names_from_directory(data_dir, tfrecord_prefix)
+def validate_vae_state_rnn_pair_on_tf_records(data_dir, vae, state_rnn, sess, allowed_action_space,
+                                              sequences_per_batch=16):
+    """Loss of the VAE decoding the StateRNN's prediction of each next frame's code, against that frame.
+
+    Up to sequences_per_batch sequences, across record files, are predicted together. The input frames of all of them
+    are encoded in one VAE run, the codes are zero padded into one batch for a single StateRNN.predict_on_sequences
+    call, and all of the predictions are decoded and scored in one more VAE run. Padding only follows a sequence, so
+    it never changes its predictions.
+
+    Returns:
+        (average loss over all frames, OrderedDict of record file name -> average loss over that file's frames)
+        The average loss is nan if no sequence has a frame to predict.
+    """
+    loss_sums = OrderedDict()
+    frame_counts = OrderedDict()
+
+    def score_sequences(sequences):
+        lengths = [len(frames) - 1 for _, frames, _ in sequences]
+        starts = np.cumsum([0] + lengths[:-1])
+
+        input_codes = vae.encode_frames(np.concatenate([frames[:-1] for _, frames, _ in sequences]))
+
+        z_sequences = np.zeros(shape=(len(sequences), max(lengths), vae.latent_dim), dtype=np.float32)
+        action_sequences = np.zeros(shape=(len(sequences), max(lengths)), dtype=np.int64)
+        for i, ((_, _, actions), start, length) in enumerate(zip(sequences, starts, lengths)):
+            z_sequences[i, :length] = input_codes[start:start + length]
+            action_sequences[i, :length] = actions[:-1]
+
+        # The state is never reset within a sequence, and the zero initial state is the same as a reset.
+        code_predictions, _ = state_rnn.predict_on_sequences(z_sequences=z_sequences,
+                                                             action_sequences=action_sequences,
+                                                             states_mask_sequences=np.ones(action_sequences.shape))
+
+        losses = vae.get_loss_for_decoded_frames(
+            z_codes=np.concatenate([predictions[:length] for predictions, length in zip(code_predictions, lengths)]),
+            target_frames=np.concatenate([frames[1:] for _, frames, _ in sequences]))
+
+        for (file_name, _, _), start, length in zip(sequences, starts, lengths):
+            sequence_losses = losses[start:start + length]
+
+            logger.debug('loss of {} on sequence of length {}'.format(np.mean(sequence_losses), length))
+
+            loss_sums[file_name] = loss_sums.get(file_name, 0.0) + np.sum(sequence_losses, dtype=np.float64)
+            frame_counts[file_name] = frame_counts.get(file_name, 0) + length
+
+    sequences = []
+    for file_name, batch_frames, batch_actions in iterate_validation_sequences(data_dir, sess, allowed_action_space):
+        if len(batch_frames) < 2:
+            logger.warning("zero length sequence")
+            continue
+
+        sequences.append((file_name, batch_frames, batch_actions))
+
+        if len(sequences) == sequences_per_batch:
+            score_sequences(sequences)
+            sequences = []
+
+    if sequences:
+        score_sequences(sequences)
 
-        if len(tfrecord_files) <= 0:
-            raise FileNotFoundError("No usable tfrecords with prefix \'{}\' were found at {}".format(
-                tfrecord_prefix, data_dir)
+    file_losses = OrderedDict((file_name, loss_sums[file_name] / frame_counts[file_name]) for file_name in loss_sums)
+    for file_name, file_loss in file_losses.items():
+        logger.info("Validation loss {} on {} ({} frames)".format(file_loss, file_name, frame_counts[file_name]))
+
+    if sum(frame_counts.values()) == 0:
+        logger.warning("No validation sequences at {} have frames to predict".format(data_dir))
+        return float('nan'), file_losses
+
+    avg_loss = sum(loss_sums.values()) / sum(frame_counts.values())
+
+    return avg_loss, file_losses
+
+
+def validate_full_rnn_on_tf_records(data_dir, rnn, sess, allowed_action_space):
+    """Reference validation, one single step prediction per frame. See validate_full_rnn_on_tf_records_batched."""
+    avg_loss = 0
+    frames_tested_on = 0
+
+    for _, batch_frames, batch_actions in iterate_validation_sequences(data_dir, sess, allowed_action_space):
+        input_frames = batch_frames[:-1]
+        target_frames = batch_frames[1:]
+        input_actions = batch_actions[:-1]
+
+        losses = np.empty(shape=(len(input_frames)))
+
+        state = None
+        for i, (input_frame, action, target_frame) in enumerate(zip(input_frames, input_actions, target_frames)):
+            predicted_frame, state, loss = rnn.predict_on_frame_batch_with_loss(
+                frames=np.reshape(input_frame, newshape=(1, *input_frame.shape)),
+                actions=np.reshape(action, newshape=(1, *action.shape)),
+                states_mask=[[True]],
+                valid_prediction_mask=[True],
+                states_in=state,
+                target_predictions=np.reshape(target_frame, newshape=(1, *target_frame.shape)),
             )
 
-        avg_loss = 0
-        frames_tested_on = 0
+            losses[i] = loss
+
+        if len(losses) == 0:
+            logger.warning("zero length sequence")
+        sequence_mean_loss = np.mean(losses)
+
+        logger.debug('loss of {} on sequence of length {}'.format(sequence_mean_loss, len(losses)))
+
+        new_total_frames = frames_tested_on + len(losses)
+        avg_loss = (avg_loss*frames_tested_on + sequence_mean_loss * len(losses)) / new_total_frames
+        frames_tested_on = new_total_frames
+
+    return avg_loss
 
-        for file_name in tfrecord_files:
-            sess.run(val_input_fn_init_op, feed_dict={file_name_placeholder: file_name})
 
-            while True:
-                try:
-                    batch_frames, batch_actions = sess.run(val_input_fn_iter)
-                except tf.errors.OutOfRangeError:
-                    break
+def sequence_batch_losses(rnn, sess, sequences, action_dim, chunk_length):
+    """Summed per-frame losses of each (frames, actions) sequence, run together through rnn's sequence graph.
+
+    Sequences are zero padded to the longest one and the padding is masked out of the losses with
+    state_reset_between_input_and_target_mask. The rnn state is carried from chunk to chunk of chunk_length steps,
+    so results don't depend on chunk_length.
+
+    Returns:
+        NDArray of loss sums, one per sequence
+    """
+    prediction_lengths = [len(frames) - 1 for frames, _ in sequences]
+    batch_size = len(sequences)
+    max_length = max(prediction_lengths)
+    frame_shape = sequences[0][0].shape[1:]
+
+    frames_batch = np.zeros(shape=(batch_size, max_length + 1, *frame_shape), dtype=np.uint8)
+    actions_batch = np.zeros(shape=(batch_size, max_length, action_dim), dtype=np.float32)
+    valid_mask = np.zeros(shape=(batch_size, max_length), dtype=np.float32)
+
+    for i, ((frames, actions), length) in enumerate(zip(sequences, prediction_lengths)):
+        frames_batch[i, :length + 1] = frames
+        actions_batch[i, np.arange(length), actions[:length]] = 1.0
+        valid_mask[i, :length] = 1.0
+
+    # The state is never reset within a sequence, and the zero initial state is the same as a reset.
+    retain_state_mask = np.ones(shape=(batch_size, chunk_length), dtype=np.float32)
+
+    loss_sums = np.zeros(shape=batch_size, dtype=np.float64)
+    states = None
+
+    for start in range(0, max_length, chunk_length):
+        end = min(start + chunk_length, max_length)
+
+        feed_dict = {
+            rnn.sequence_frame_inputs: frames_batch[:, start:end],
+            rnn.sequence_frame_targets: frames_batch[:, start + 1:end + 1],
+            rnn.sequence_action_inputs: actions_batch[:, start:end],
+            rnn.state_reset_before_prediction_mask: retain_state_mask[:, :end - start],
+            rnn.state_reset_between_input_and_target_mask: valid_mask[:, start:end]
+        }
+
+        if states is not None:
+            feed_dict[rnn.states_in] = states
 
-                if batch_actions.shape[1] == allowed_action_space.n:
-                    # convert from one hot
-                    batch_actions = np.argmax(batch_actions, axis=1)
+        frame_losses, states = sess.run([rnn.masked_frame_mean_squared_errors, rnn.states_out], feed_dict=feed_dict)
+        loss_sums += np.sum(frame_losses, axis=1, dtype=np.float64)
 
-                batch_actions = np.squeeze(batch_actions)
+    return loss_sums
 
-                assert len(batch_actions.shape) == 1
 
-                for action in batch_actions:
-                    assert allowed_action_space.contains(action)
+def validate_full_rnn_on_tf_records_batched(data_dir, rnn, sess, allowed_action_space, sequences_per_batch=16,
+                                            chunk_length=64):
+    """Same average loss as validate_full_rnn_on_tf_records, with sequences_per_batch validation sequences at a
+    time run through the rnn's sequence graph in chunks of chunk_length steps instead of one frame per session run.
 
-                input_frames = batch_frames[:-1]
-                target_frames = batch_frames[1:]
-                input_actions = batch_actions[:-1]
+    Returns nan if no sequence has a frame to predict.
+    """
+    total_loss = 0.0
+    frames_tested_on = 0
+    sequences = []
 
-                losses = np.empty(shape=(len(input_frames)))
+    def run_sequences():
+        loss_sums = sequence_batch_losses(rnn, sess, sequences, allowed_action_space.n, chunk_length)
+        for (frames, _), loss_sum in zip(sequences, loss_sums):
+            logger.debug('loss of {} on sequence of length {}'.format(loss_sum / (len(frames) - 1), len(frames) - 1))
+        return np.sum(loss_sums), sum(len(frames) - 1 for frames, _ in sequences)
 
-                state = None
-                for i, (input_frame, action, target_frame) in enumerate(zip(input_frames, input_actions, target_frames)):
-                    predicted_frame, state, loss = rnn.predict_on_frame_batch_with_loss(
-                        frames=np.reshape(input_frame, newshape=(1, *input_frame.shape)),
-                        actions=np.reshape(action, newshape=(1, *action.shape)),
-                        states_mask=[[True]],
-                        valid_prediction_mask=[True],
-                        states_in=state,
-                        target_predictions=np.reshape(target_frame, newshape=(1, *target_frame.shape)),
-                    )
+    for _, batch_frames, batch_actions in iterate_validation_sequences(data_dir, sess, allowed_action_space):
+        if len(batch_frames) < 2:
+            logger.warning("zero length sequence")
+            continue
 
-                    losses[i] = loss
+        sequences.append((batch_frames, batch_actions))
 
-                if len(losses) == 0:
-                    logger.warning("zero length sequence")
-                sequence_mean_loss = np.mean(losses)
+        if len(sequences) == sequences_per_batch:
+            batch_loss, batch_frame_count = run_sequences()
+            total_loss += batch_loss
+            frames_tested_on += batch_frame_count
+            sequences = []
 
-                logger.debug('loss of {} on sequence of length {}'.format(sequence_mean_loss, len(losses)))
+    if sequences:
+        batch_loss, batch_frame_count = run_sequences()
+        total_loss += batch_loss
+        frames_tested_on += batch_frame_count
 
-                new_total_frames = frames_tested_on + len(losses)
-                avg_loss = (avg_loss*frames_tested_on + sequence_mean_loss * len(losses)) / new_total_frames
-                frames_tested_on = new_total_frames
+    if frames_tested_on == 0:
+        logger.warning("No validation sequences at {} have frames to predict".format(data_dir))
+        return float('nan')
 
-        return avg_loss
+    return total_loss / frames_tested_on
 
 
 if __name__ == '__main__':